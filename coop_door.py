@@ -1,91 +1,316 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import RPi.GPIO as gpio
-import paho.mqtt.client as mqtt
 import logging
-import logging.handlers
+import threading
+from functools import partial
+from signal import pause
 
-from misc.config_loader import Config
+from misc.command_ack import (
+    ACK_ACCEPTED,
+    ACK_ALREADY,
+    ACK_REJECTED,
+    DONE_COMPLETED,
+    DONE_FAULT,
+    DONE_INTERRUPTED,
+    reply_of,
+    reply_properties,
+    ReplyCache
+)
+from misc.config_loader import Config, FLEET_DOOR_PLACEHOLDER
 from misc.coop_door_command import CoopDoorCommand
+from misc.coop_door_motor import CoopDoorMotor
+from misc.coop_door_state import CoopDoorState
+from misc.door_state_machine import DoorAction
+from misc.event_bus import EventBus, EVENT_END_STOP
+from misc.hardware import create_gpio_probe, create_pwm, load_gpio
+from misc.heartbeat import create_heartbeat, create_mqtt_probe, gpio_callbacks
+from misc.journal import create_journal, EVENT_COMMAND, MOTOR_OFF_END_STOP, MOTOR_OFF_TRAVEL_TIMEOUT
+from misc.local_control import LocalControlServer, REPLY_ERROR, REPLY_OK
+from misc.metrics import metrics, register_tracer, start_metrics_server
+from misc.motion_profile import create_motion_control
+from misc.mqtt_client import connect_client, create_client, RecoveryTimer
+from misc.mqtt_publisher import create_publisher
+from misc.queued_logging import setup_queued_logging
+from misc.startup import PHASE_CONFIG, PHASE_CONNECT, PHASE_GPIO, PHASE_IMPORTS, PHASE_SUBSCRIBE, StartupTimer
+from misc.state_payload import (
+    CAUSE_WATCHDOG,
+    decode_state,
+    STATE_OUT_OF_ORDER,
+    STATE_STALE,
+    StateEncoder,
+    StateOrdering,
+    STRUCTURED_TOPIC_SUFFIX
+)
+from misc.tracing import (
+    create_tracer,
+    STAGE_END_STOP_TO_RESET_PINS,
+    STAGE_GPIO_HIGH_TO_END_STOP,
+    STAGE_PUBLISH_TO_GPIO_HIGH
+)
+from misc.travel_watchdog import create_travel_watchdog
 
+# Ready for systemd, once the pins are safe and the subscriptions are active
+startup = StartupTimer('coop_door', (PHASE_GPIO, PHASE_SUBSCRIBE))
+startup.mark(PHASE_IMPORTS)
 cfg = Config()
+startup.mark(PHASE_CONFIG)
+tracer = create_tracer(cfg)
+# RPi.GPIO is loaded by init_hardware, while the Mqtt connect is already on its way
+gpio = None
+journal = create_journal(cfg, 'coop_door')
 
-COOP_DOOR_OPEN_PIN = cfg.get_coop_door_open_pin()
-COOP_DOOR_CLOSE_PIN = cfg.get_coop_door_close_pin()
-COOP_DOOR_SPEED_PIN = cfg.get_coop_door_speed_pin()
+# All doors driven by this process, by door name
+doors = {}
+# Every topic of every door mapped to its handler and door, so on_message only needs a single lookup
+topic_index = {}
+# Topics to subscribe on connect, in fleet mode these contain + wildcards instead of one topic per door
+subscriptions = []
+# Plain state topic per door, the travel watchdog publishes FAULT there
+state_topics = {}
 
-MQTT_COMMAND_TOPIC = cfg.get_mqtt_topic_command()
-MQTT_COOP_DOOR_STATE_TOPIC = cfg.get_mqtt_topic_state()
+client = None
+recovery = RecoveryTimer()
+# Set once the pins are initialized, nothing is subscribed before
+hardware_ready = threading.Event()
+# Message ids of subscriptions not acknowledged by the broker yet
+pending_subscriptions = set()
+# Only used for the sensor states, when the sensors run in this process
+publisher = None
+# Unix domain socket for the scripts and automations on this host, see handle_local_request
+control_server = None
+# Withholds the systemd watchdog while the Mqtt loop or a combined sensor callback hangs, if enabled
+heartbeat = None
+mqtt_probe = None
+event_bus = EventBus()
+motion = create_motion_control(cfg)
+watchdog = create_travel_watchdog(cfg)
+state_encoder = StateEncoder('coop_door')
+state_ordering = StateOrdering(cfg.get_mqtt_max_state_age())
+# Last replies to commands asking for them and the reply for the completion of the run a command started, per door
+replies = ReplyCache()
+pending_completions = {}
 
-DUTY_CYCLE_MIN = 0
-# 100% performance, so the full power goes to the motor. At 12 V with 75% it would only be 9 V given to the motor, e.g.;
-# to be tried out, if 75% would also be enough!
-DUTY_CYCLE_MAX = 100
 
-pwm_speed = None
+def handle_state(door, payload, trace, reply):
+    state = CoopDoorState.__members__.get(payload)
+    if state is None:
+        log('Unknown state %s for %s', payload, door.door_id, level=logging.WARNING)
+        return
+    apply_state(door, state, trace)
 
-def reset_pins():
-    log('Resetting pins to original state')
-    gpio.output(COOP_DOOR_OPEN_PIN, gpio.LOW)
-    gpio.output(COOP_DOOR_CLOSE_PIN, gpio.LOW)
-    pwm_speed.ChangeDutyCycle(DUTY_CYCLE_MIN)  # stop motor
-    log('Reset pins to original state')
 
+def handle_structured_state(door, payload, trace, reply):
+    # Structured states tell their order and age, so neither a redelivered nor a late end stop stops a door, which
+    # started moving again in the meantime. A late state still tells a standing door where it is.
+    decoded = decode_state(payload)
+    state = CoopDoorState.__members__.get(decoded.state) if decoded else None
+    if state is None:
+        log('Unknown state %s for %s', payload, door.door_id, level=logging.WARNING)
+        return
+    verdict = state_ordering.check(door.door_id, decoded)
+    if verdict == STATE_OUT_OF_ORDER or (verdict == STATE_STALE and door.moving_pin is not None):
+        log('Ignored %s state %s #%s from %s for %s', verdict, decoded.state, decoded.seq, decoded.source,
+            door.door_id, level=logging.WARNING)
+        metrics.inc('coop_door_states_ignored_total', door=door.door_id, reason=verdict.replace(' ', '_'))
+        return
+    apply_state(door, state, trace)
 
-def move_door(pin, position):
-    reset_pins()
-    pwm_speed.ChangeDutyCycle(DUTY_CYCLE_MAX)
-    log(f'Setting pin {pin} to HIGH for {position} coop door')
-    gpio.output(pin, gpio.HIGH)
-    log(f'Set pin {pin} to HIGH')
 
+def apply_state(door, state, trace):
+    # When the sensors deliver the end stop the door is moving to, the pins will be reset. Every other state, e.g.
+    # RUNNING or the retained state on connect, only tells the door where it is.
+    moved_at_ns = door.moved_at_ns
+    if door.handle(state) != DoorAction.END_STOP:
+        return
+    log('Pins for %s reset', door.door_id)
 
-def stop_door_move():
-    log('Stopping coop door move')
-    reset_pins()
-    log('Stopped coop door move')
+    # The trace of a state message carries the time the sensor detected the end stop
+    if trace and moved_at_ns:
+        tracer.record(STAGE_GPIO_HIGH_TO_END_STOP, moved_at_ns, trace.timestamp_ns, door.trace_id)
+        tracer.record(STAGE_END_STOP_TO_RESET_PINS, trace.timestamp_ns, door.reset_at_ns, door.trace_id)
+
+
+def publish_fault(door):
+    # Not retained, so the last end stop the sensors reported stays the retained state for OpenHAB and for this
+    # script after a restart
+    state_topic = state_topics[door.door_id]
+    log('Publishing %s for %s to %s', CoopDoorState.FAULT.name, door.door_id, state_topic, level=logging.ERROR)
+    messages = [(state_topic, CoopDoorState.FAULT.name)]
+    if cfg.get_mqtt_structured_payloads():
+        structured_topic = state_topic + STRUCTURED_TOPIC_SUFFIX
+        messages.append((structured_topic, state_encoder.encode(structured_topic, door.door_id,
+                                                                CoopDoorState.FAULT.name, CAUSE_WATCHDOG)))
+    for topic, payload in messages:
+        if publisher:
+            publisher.publish(topic, payload)
+        elif client:
+            client.publish(topic, payload, qos=cfg.get_mqtt_qos())
+
+
+def handle_command(door, payload, trace, reply):
+    # if it's the command topic, the door will be changed
+    log('Received command %s for %s from broker', payload, door.door_id)
+    if reply:
+        replied = replies.get(reply)
+        if replied:
+            # A retry of a command, whose ack didn't reach the sender in time, it was executed already
+            log('Repeating reply %s to %s', replied, reply.topic)
+            publish_reply(reply, replied)
+            return
+    command = CoopDoorCommand.__members__.get(payload)
+    if command is None:
+        log('Unknown command %s for %s', payload, door.door_id, level=logging.WARNING)
+        if reply:
+            publish_reply(reply, f'{ACK_REJECTED} unknown command', remember=True)
+        return
+    action = execute_command(door, command, trace)
+    if not reply:
+        return
+    # The pins are driven now, the completion follows once the run ends, see finish_command
+    if action == DoorAction.NONE:
+        publish_reply(reply, f'{ACK_ALREADY} {door.phase.name}', remember=True)
+        return
+    if action in (DoorAction.OPEN, DoorAction.CLOSE):
+        pending_completions[door.door_id] = reply
+    publish_reply(reply, f'{ACK_ACCEPTED} {door.phase.name}', remember=True)
+
+
+def finish_command(door, direction, motor_off):
+    reply = pending_completions.pop(door.door_id, None)
+    if reply is None:
+        return
+    if motor_off == MOTOR_OFF_END_STOP:
+        status = DONE_COMPLETED
+    elif motor_off == MOTOR_OFF_TRAVEL_TIMEOUT:
+        status = DONE_FAULT
+    else:
+        status = DONE_INTERRUPTED
+    publish_reply(reply, f'{status} {direction}')
+
+
+def publish_reply(reply, payload, remember=False):
+    if remember:
+        replies.put(reply, payload)
+    if client:
+        client.publish(reply.topic, payload, qos=cfg.get_mqtt_qos(),
+                       properties=reply_properties(reply.correlation_data))
+
+
+def execute_command(door, command, trace=None) -> DoorAction:
+    trace_id = trace.trace_id if trace else None
+    journal.record(EVENT_COMMAND, command.value, door.door_id)
+    metrics.inc('coop_door_commands_total', door=door.door_id, command=command.name)
+
+    action = door.handle(command, trace_id)
+    if action == DoorAction.NONE:
+        log('Ignored command %s for %s, it is already %s', command.name, door.door_id, door.phase.name)
+        return action
+    if trace and action != DoorAction.STOP:
+        tracer.record(STAGE_PUBLISH_TO_GPIO_HIGH, trace.timestamp_ns, door.moved_at_ns, trace_id)
+    return action
+
+
+def handle_local_request(line):
+    # One line per request, the door may be left out with a single door:
+    # OPEN|CLOSE|STOP [door], END OPEN|CLOSED [door] for the end stop sensors, STATE [door] and PING
+    request, _, argument = line.partition(' ')
+    request = request.upper()
+    if request == 'PING':
+        return REPLY_OK
+    state = None
+    if request == 'END':
+        state_name, _, argument = argument.partition(' ')
+        state = CoopDoorState.__members__.get(state_name.upper())
+        if state not in (CoopDoorState.OPEN, CoopDoorState.CLOSED):
+            return f'{REPLY_ERROR} unknown end stop {state_name}'
+    door = doors.get(argument) if argument else (next(iter(doors.values())) if len(doors) == 1 else None)
+    if door is None:
+        return f'{REPLY_ERROR} unknown door {argument}'
+    if request == 'STATE':
+        return f'{REPLY_OK} {door.phase.name}'
+    metrics.inc('coop_door_local_requests_total', request=request)
+    if state:
+        action = door.handle(state)
+        if action == DoorAction.END_STOP:
+            log('Stopped %s at end stop %s over local control', door.door_id, state.name)
+        return f'{REPLY_OK} {action.name} {door.phase.name}'
+    command = CoopDoorCommand.__members__.get(request)
+    if command is None:
+        return f'{REPLY_ERROR} unknown request {request}'
+    log('Received command %s for %s over local control', command.name, door.door_id)
+    action = execute_command(door, command)
+    return f'{REPLY_OK} {action.name} {door.phase.name}'
 
 
 def on_message(client, userdata, message):
     topic = message.topic
+    if mqtt_probe and topic == mqtt_probe.topic:
+        mqtt_probe.answer()
+        return
     payload = str(message.payload.decode("utf-8"))
-    log(f'Message received from topic {topic} with payload {payload}')
+    log('Message received from topic %s with payload %s', topic, payload)
 
-    # When the sensors deliver a closed or open state from the state topic, the pins will be reset
-    if topic == MQTT_COOP_DOOR_STATE_TOPIC:
-        reset_pins()
-        log('Pins for Coop Door reset')
-    # if it's the command topic, the door will be changed
-    elif topic == MQTT_COMMAND_TOPIC:
-        command = payload
-        log(f'Received command {command} from broker')
-        if CoopDoorCommand.OPEN.name == command:
-            log('In OPEN')
-            move_door(COOP_DOOR_OPEN_PIN, 'opening')
-        elif CoopDoorCommand.CLOSE.name == command:
-            log('In CLOSE')
-            move_door(COOP_DOOR_CLOSE_PIN, 'closing')
-        elif CoopDoorCommand.STOP.name == command:
-            stop_door_move()
+    entry = topic_index.get(topic)
+    # Only the configured topics are labels of their own, so the metrics stay bounded
+    metrics.inc('coop_door_messages_received_total', topic=topic if entry is not None else 'other')
+    if entry is None:
+        log('No coop door configured for topic %s', topic, level=logging.WARNING)
+        return
+
+    handler, door = entry
+    handler(door, payload, tracer.from_message(message), reply_of(message))
 
 
 def on_connect(client, userdata, flags, result_code, properties):
-    client.subscribe(MQTT_COMMAND_TOPIC)
-    client.subscribe(MQTT_COOP_DOOR_STATE_TOPIC)
-    log(f'Connected to mqtt broker and topic {MQTT_COMMAND_TOPIC}')
+    if result_code != 0:
+        log(f'Mqtt Broker connection failed with error code {result_code}', level=logging.WARNING)
+        return
+    recovery.connected()
+    startup.mark(PHASE_CONNECT)
+    # Only blocks on the first connect, if it was faster than setting up the pins
+    hardware_ready.wait()
+    if PHASE_GPIO not in startup.done:
+        return
+    for topic in subscriptions:
+        _, mid = client.subscribe(topic, qos=cfg.get_mqtt_qos())
+        pending_subscriptions.add(mid)
+    if mqtt_probe:
+        pending_subscriptions.add(mqtt_probe.subscribe())
+    log(f'Connected to mqtt broker and topics {subscriptions}')
+    resync()
+
+
+def on_subscribe(client, userdata, mid, reason_code_list, properties):
+    if any(reason_code.is_failure for reason_code in reason_code_list):
+        log('Subscription %s was rejected by the broker: %s', mid, reason_code_list, level=logging.WARNING)
+    if mqtt_probe:
+        mqtt_probe.on_subscribe(mid, reason_code_list)
+    pending_subscriptions.discard(mid)
+    if not pending_subscriptions:
+        startup.mark(PHASE_SUBSCRIBE)
+
+
+def resync():
+    # Whatever happened while the broker was unreachable, a door not moving on purpose must have its motor off
+    for door in doors.values():
+        door.resync_pins()
+    if publisher:
+        # The sensors run in this process, see start_combined_sensors
+        import coop_door_sensors
+        coop_door_sensors.resync_state()
+        publisher.notify_connected()
 
 
 def setup_logging():
-    log_handler = logging.handlers.WatchedFileHandler(cfg.get_coop_door_logging_logfile())
-    formatter = logging.Formatter(
+    setup_queued_logging(
+        cfg.get_coop_door_logging_logfile(),
         cfg.get_coop_door_logging_message_format(),
-        cfg.get_coop_door_logging_date_time_format()
+        cfg.get_coop_door_logging_date_time_format(),
+        cfg.get_coop_door_logging_level(),
+        cfg.get_coop_door_logging_burst_limit(),
+        cfg.get_coop_door_logging_burst_window()
     )
-    log_handler.setFormatter(formatter)
-    logger = logging.getLogger()
-    logger.addHandler(log_handler)
-    logger.setLevel(cfg.get_coop_door_logging_level())
 
 
 def log(message: str, *args, level: int = logging.INFO, exc=None) -> None:
@@ -95,46 +320,249 @@ def log(message: str, *args, level: int = logging.INFO, exc=None) -> None:
         logging.log(level, message, *args)
 
 
+def add_door(new_doors, new_topic_index, new_state_topics, door_id, pins, command_topic, state_topic):
+    door = doors.get(door_id)
+    # A door keeps its motor through a config reload as long as its pins didn't change
+    if door is None or (door.open_pin, door.close_pin, door.speed_pin) != (pins['open'], pins['close'], pins['speed']):
+        door = CoopDoorMotor(gpio, door_id, pins['open'], pins['close'], pins['speed'], motion, journal,
+                             partial(create_pwm, cfg, gpio), watchdog)
+        door.on_run_end = finish_command
+    new_doors[door_id] = door
+    new_topic_index[command_topic] = (handle_command, door)
+    new_state_topics[door_id] = state_topic
+    if cfg.get_mqtt_structured_payloads():
+        new_topic_index[state_topic + STRUCTURED_TOPIC_SUFFIX] = (handle_structured_state, door)
+    else:
+        new_topic_index[state_topic] = (handle_state, door)
+
+
+def init_doors():
+    global doors, topic_index, subscriptions, state_topics
+    new_doors = {}
+    new_topic_index = {}
+    new_state_topics = {}
+    # With structured payloads only the /v1 state topic is followed, the plain one carries the same states
+    state_suffix = STRUCTURED_TOPIC_SUFFIX if cfg.get_mqtt_structured_payloads() else ''
+    if cfg.has_coop_door_fleet():
+        command_topic = cfg.get_coop_door_fleet_topic_command()
+        state_topic = cfg.get_coop_door_fleet_topic_state()
+        for door_id in cfg.get_coop_door_fleet_doors():
+            add_door(
+                new_doors,
+                new_topic_index,
+                new_state_topics,
+                door_id,
+                cfg.get_coop_door_fleet_pins(door_id),
+                command_topic.replace(FLEET_DOOR_PLACEHOLDER, door_id),
+                state_topic.replace(FLEET_DOOR_PLACEHOLDER, door_id)
+            )
+        new_subscriptions = [
+            command_topic.replace(FLEET_DOOR_PLACEHOLDER, '+'),
+            state_topic.replace(FLEET_DOOR_PLACEHOLDER, '+') + state_suffix
+        ]
+    else:
+        command_topic = cfg.get_mqtt_topic_command()
+        state_topic = cfg.get_mqtt_topic_state()
+        add_door(new_doors, new_topic_index, new_state_topics, 'coop door', cfg.get_coop_door_pins(), command_topic,
+                 state_topic)
+        new_subscriptions = [command_topic, state_topic + state_suffix]
+
+    # Swapped as a whole, so on_message never sees a half built index
+    doors, topic_index, subscriptions, state_topics = new_doors, new_topic_index, new_subscriptions, new_state_topics
+    log(f'Initialized coop doors {list(doors)}')
+
+
 def init_pins():
-    global pwm_speed
     gpio.setmode(gpio.BCM)
-    gpio.setup([COOP_DOOR_OPEN_PIN, COOP_DOOR_CLOSE_PIN], gpio.OUT, initial=gpio.LOW)
-    gpio.setup(COOP_DOOR_SPEED_PIN, gpio.OUT)
+    for door in doors.values():
+        if door.pwm_speed is None:
+            door.init_pins()
+            metrics.gauge('coop_door_pwm_running', partial(pwm_running, door), door=door.door_id)
 
-    pwm_speed = gpio.PWM(COOP_DOOR_SPEED_PIN, DUTY_CYCLE_MAX)  # 100 Hz
-    pwm_speed.start(DUTY_CYCLE_MIN)  # start with switched off motor (= 0%)
 
+def pwm_running(door) -> int:
+    return int(door.pwm_speed is not None and door.pwm_speed.running)
 
-def main():
-    setup_logging()
-    client = None
+
+def start_control_server():
+    global control_server
+    path = cfg.get_coop_door_control_socket()
+    if path and PHASE_GPIO in startup.done:
+        control_server = LocalControlServer(path, handle_local_request)
+        control_server.start()
+
+
+def format_local_control_stats():
+    return control_server.format() if control_server else 'Local control disabled'
+
+
+def format_heartbeat_stats():
+    return heartbeat.format() if heartbeat else 'Heartbeat disabled'
+
+
+def format_watchdog_stats():
+    return watchdog.format() if watchdog else 'Travel watchdog disabled'
+
+
+def format_pwm_stats():
+    return 'Motor PWM: ' + ', '.join(
+        f'{door_id} {door.pwm_speed.format()}' for door_id, door in doors.items() if door.pwm_speed
+    )
+
+
+def init_hardware():
+    global gpio
     try:
+        gpio = load_gpio(cfg)
+        init_doors()
         init_pins()
+        if cfg.get_coop_door_combined_sensors():
+            start_combined_sensors()
+        startup.mark(PHASE_GPIO)
+    finally:
+        # Also when it failed, so on_connect doesn't block the shutdown
+        hardware_ready.set()
+
+
+def reload_config(changed_sections):
+    global motion, watchdog
+    if 'COOP_DOOR_LOGGING' in changed_sections:
+        logging.getLogger().setLevel(cfg.get_coop_door_logging_level())
+
+    if 'COOP_DOOR_MOTION' in changed_sections:
+        # Runs in progress finish with the profile they were started with
+        motion = create_motion_control(cfg)
+        for door in doors.values():
+            door.motion = motion
+        log('Applied reloaded motion profile')
+
+    if 'COOP_DOOR_WATCHDOG' in changed_sections:
+        # Runs in progress keep the limit they were started with
+        watchdog = create_travel_watchdog(cfg)
+        if watchdog:
+            watchdog.on_fault = publish_fault
+        for door in doors.values():
+            door.watchdog = watchdog
+        log('Applied reloaded travel watchdog')
+
+    if not any(section == 'MQTT' or section.startswith('COOP_DOOR_FLEET') or section == 'COOP_DOOR'
+               for section in changed_sections):
+        return
 
+    state_ordering.max_age = cfg.get_mqtt_max_state_age()
+    old_doors = doors
+    old_subscriptions = subscriptions
+    init_doors()
+    for door in old_doors.values():
+        if door not in doors.values():
+            door.release_pins()
+    init_pins()
+
+    if client:
+        for topic in old_subscriptions:
+            if topic not in subscriptions:
+                client.unsubscribe(topic)
+        for topic in subscriptions:
+            if topic not in old_subscriptions:
+                client.subscribe(topic, qos=cfg.get_mqtt_qos())
+    log(f'Applied reloaded config, subscribed to {subscriptions}')
+
+
+def stop_at_end_stop(state, detected_at_ns):
+    door = next(iter(doors.values()))
+    # Only the end stop the door is moving to stops it, bounces of the one it leaves are ignored
+    if door.handle(CoopDoorState[state]) == DoorAction.END_STOP:
+        tracer.record(STAGE_END_STOP_TO_RESET_PINS, detected_at_ns, door.reset_at_ns, door.trace_id)
+        log('Stopped %s at end stop %s in process', door.door_id, state)
+
+
+def start_combined_sensors():
+    global publisher
+    # The sensors run in this process and stop the motor over the event bus as soon as an end stop is debounced,
+    # their states are still published to Mqtt for the observers
+    if cfg.has_coop_door_fleet():
+        raise ValueError('Sensors can only be combined with a single coop door, not with a fleet')
+
+    import coop_door_sensors
+
+    # Shares the config, journal and tracer of this process, so the reloads are only watched once
+    coop_door_sensors.configure(cfg, journal, tracer)
+    event_bus.subscribe(EVENT_END_STOP, stop_at_end_stop)
+    coop_door_sensors.event_bus = event_bus
+    coop_door_sensors.client = client
+    coop_door_sensors.publisher = publisher = create_publisher(cfg, client)
+    coop_door_sensors.init_sensors()
+    coop_door_sensors.register_sensor_callbacks()
+    cfg.add_reload_listener(coop_door_sensors.reload_config)
+    log('Coop door sensors running in process')
+
+
+def main():
+    global client, heartbeat, mqtt_probe
+    setup_logging()
+    tracer.install_dump_handler(recovery.format, format_pwm_stats, format_watchdog_stats, state_ordering.format,
+                                format_local_control_stats, format_heartbeat_stats)
+    if watchdog:
+        watchdog.on_fault = publish_fault
+    register_tracer(tracer)
+    metrics.histogram('coop_door_mqtt_recovery_seconds', recovery.recoveries)
+    start_metrics_server(cfg, 'coop_door')
+    try:
         log('Connecting to mqtt')
-        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        client = create_client(cfg, 'coop_door')
         log('Mqtt client created')
         client.username_pw_set(cfg.get_mqtt_username(), cfg.get_mqtt_password())
         log('Mqtt username and password set')
         client.on_connect = on_connect
+        client.on_disconnect = recovery.on_disconnect
         client.on_message = on_message
+        client.on_subscribe = on_subscribe
+        heartbeat = create_heartbeat(cfg)
+        if heartbeat:
+            mqtt_probe = create_mqtt_probe(cfg, client, 'coop_door')
+            heartbeat.add(mqtt_probe)
         log('Trying to connect to Mqtt server')
-        client.connect(cfg.get_mqtt_broker())
-        log('Connected to Mqtt server')
-        client.loop_forever(retry_first_connection=False)
+        # Retries until the broker is reachable, also when it's still down at boot. The connect runs on the network
+        # thread while the pins are set up, on_connect only subscribes once they are.
+        connect_client(client, cfg)
+        client.loop_start()
+
+        init_hardware()
+        start_control_server()
+        if heartbeat:
+            # Edges only arrive here with combined sensors
+            heartbeat.add(create_gpio_probe())
+            heartbeat.add(gpio_callbacks)
+            heartbeat.start()
+        cfg.add_reload_listener(reload_config)
+        cfg.start_watching()
+
+        pause()
     except KeyboardInterrupt:
         pass
     except Exception as err:
         pass
         log('coop_door.py broke with exception', level=logging.ERROR, exc=err)
     finally:
+        if heartbeat:
+            heartbeat.stop()
         if client:
-            client.unsubscribe(MQTT_COMMAND_TOPIC)
-            client.unsubscribe(MQTT_COOP_DOOR_STATE_TOPIC)
+            # With a persistent session the broker keeps the commands for the restarted script
+            if not cfg.get_mqtt_persistent_session():
+                for topic in subscriptions:
+                    client.unsubscribe(topic)
             client.disconnect()
-        gpio.cleanup()  # this ensures a clean exit
+            client.loop_stop()
+        if control_server:
+            control_server.close()
+        if gpio:
+            for door in doors.values():
+                if door.pwm_speed is not None:
+                    # Also unexports a hardware PWM channel, which gpio.cleanup doesn't know about
+                    door.release_pins()
+            gpio.cleanup()  # this ensures a clean exit
+        journal.close()
         log('Finishing coop door script')
 
 if __name__ == '__main__':
     main()
-
@@ -1,95 +1,215 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-from gpiozero import Button
+from functools import partial
 from signal import pause
-import paho.mqtt.client as mqtt
 import logging
-import logging.handlers
-import datetime as dt
+import time
 
+from misc.command_ack import create_command_sender
 from misc.config_loader import Config
+from misc.hardware import create_gpio_probe, edge_timestamp_ns, format_input_stats, load_button_class
+from misc.heartbeat import create_heartbeat, create_mqtt_probe, gpio_callbacks
+from misc.journal import create_journal, DEFAULT_DOOR, EVENT_BUTTON_PRESS, EVENT_OPEN_BLOCKED, EVENT_PRESS_REJECTED
+from misc.local_control import create_local_control_client, REPLY_ERROR
+from misc.metrics import metrics, register_tracer, start_metrics_server
+from misc.mqtt_client import connect_client, create_client, RecoveryTimer
+from misc.mqtt_publisher import create_publisher
+from misc.press_confirmation import PressConfirmation
+from misc.queued_logging import setup_queued_logging
+from misc.solar_schedule import create_schedule, ScheduleRunner
+from misc.startup import PHASE_CONFIG, PHASE_CONNECT, PHASE_GPIO, PHASE_IMPORTS, PHASE_SUBSCRIBE, StartupTimer
+from misc.state_payload import CAUSE_BUTTON, CAUSE_SCHEDULE, StateEncoder, STRUCTURED_TOPIC_SUFFIX
+from misc.tracing import create_tracer, STAGE_PRESS_TO_PUBLISH
 from misc.coop_door_state import CoopDoorState
 from misc.coop_door_command import CoopDoorCommand
 
+# Ready for systemd, once the buttons are set up and the subscription is active
+startup = StartupTimer('coop_door_buttons', (PHASE_GPIO, PHASE_SUBSCRIBE))
+startup.mark(PHASE_IMPORTS)
 cfg = Config()
+startup.mark(PHASE_CONFIG)
+tracer = create_tracer(cfg)
+journal = create_journal(cfg, 'coop_door_buttons')
+state_encoder = StateEncoder('coop_door_buttons')
+schedule = create_schedule(cfg)
 
 UP_PIN = cfg.get_coop_door_buttons_open_pin()
 STOP_PIN = cfg.get_coop_door_buttons_stop_pin()
 DOWN_PIN = cfg.get_coop_door_buttons_close_pin()
 
-BROKER_ADDRESS = cfg.get_mqtt_broker()
 MQTT_COMMAND_TOPIC = cfg.get_mqtt_topic_command()
 MQTT_COOP_DOOR_REALTIME_STATE_TOPIC = cfg.get_mqtt_topic_realtime_state()
 
-BUTTON_BOUNCE_TIME = 0.1
+BUTTON_BOUNCE_TIME = cfg.get_coop_door_buttons_bounce_time()
+
+press_confirmation = PressConfirmation(
+    cfg.get_coop_door_buttons_confirm_hold_time(),
+    cfg.get_coop_door_buttons_confirm_samples(),
+    cfg.get_coop_door_buttons_confirm_required()
+)
 
 client = None
+recovery = RecoveryTimer()
+# Message ids of subscriptions not acknowledged by the broker yet
+pending_subscriptions = set()
+publisher = None
+# Control socket of coop_door.py, if it runs on this host
+local_control = None
+# Sends the commands over the broker with request ids and retries them until coop_door.py acks, if configured
+command_sender = None
+# Withholds the systemd watchdog while the Mqtt loop or a button callback hangs, if enabled
+heartbeat = None
+mqtt_probe = None
 up_button = None
 stop_button = None
 down_button = None
+schedule_runner = None
 
-def coop_door_open():
-    log(f'Button up pressed (confirmed)')
-    current_date_and_time = dt.datetime.now()
-    earliest_open_datetime = dt.datetime(
-        current_date_and_time.year,
-        current_date_and_time.month,
-        current_date_and_time.day,
-        7, 30, 0, 0
-    )
-    latest_open_datetime = dt.datetime(
-        current_date_and_time.year,
-        current_date_and_time.month,
-        current_date_and_time.day,
-        22, 0, 0, 0
-    )
-
-    if earliest_open_datetime < current_date_and_time < latest_open_datetime:
-        publish_button_press(client, CoopDoorCommand.OPEN)
-        publish_realtime_state(client, CoopDoorState.RUNNING)
+def coop_door_open(pressed_at_ns):
+    log('Button up pressed (confirmed)')
+    # Ghost presses at night must not open the door
+    if schedule.opening_allowed():
+        publish_button_press(CoopDoorCommand.OPEN, pressed_at_ns)
+        publish_realtime_state(CoopDoorState.RUNNING)
     else:
-        log(f'Prevented coop door from opening at {current_date_and_time}')
+        journal.record(EVENT_OPEN_BLOCKED)
+        log('Prevented coop door from opening outside of the opening window %s', format_window())
 
-def coop_door_stop():
-    log(f'Button stop pressed (confirmed)')
-    publish_button_press(client, CoopDoorCommand.STOP)
-    publish_realtime_state(client, CoopDoorState.STOPPED)
+def coop_door_stop(pressed_at_ns):
+    log('Button stop pressed (confirmed)')
+    publish_button_press(CoopDoorCommand.STOP, pressed_at_ns)
+    publish_realtime_state(CoopDoorState.STOPPED)
 
-def coop_door_close():
-    log(f'Button down pressed (confirmed)')
-    publish_button_press(client, CoopDoorCommand.CLOSE)
-    publish_realtime_state(client, CoopDoorState.RUNNING)
+def coop_door_close(pressed_at_ns):
+    log('Button down pressed (confirmed)')
+    publish_button_press(CoopDoorCommand.CLOSE, pressed_at_ns)
+    publish_realtime_state(CoopDoorState.RUNNING)
 
-def publish_button_press(client, button_action):
+def publish_button_press(button_action, pressed_at_ns=None):
     button_action_name = button_action.name
-    log(f'Publishing coop door button {button_action_name}')
-    state_info = client.publish(MQTT_COMMAND_TOPIC, button_action_name)
-    log(f'Published coop door button {button_action_name} with rc {state_info.rc}')
+    journal.record(EVENT_BUTTON_PRESS, button_action.value, monotonic_ns=pressed_at_ns)
+    metrics.inc('coop_door_button_presses_total', command=button_action_name)
+    if send_local_command(button_action_name):
+        return
+    trace = tracer.start_trace()
+    publish_command(button_action_name, tracer.properties(trace))
+    tracer.record(STAGE_PRESS_TO_PUBLISH, pressed_at_ns, trace.timestamp_ns, trace.trace_id)
+    log('Queued coop door button %s', button_action_name)
+
+def publish_scheduled_command(command):
+    if not send_local_command(command.name):
+        publish_command(command.name)
+        log('Queued scheduled coop door command %s', command.name)
+    publish_realtime_state(CoopDoorState.RUNNING, CAUSE_SCHEDULE)
+
+def publish_command(command_name, properties=None):
+    if command_sender:
+        command_sender.send(MQTT_COMMAND_TOPIC, command_name, properties)
+    else:
+        publisher.publish(MQTT_COMMAND_TOPIC, command_name, properties=properties)
 
-def publish_realtime_state(client, state):
+def send_local_command(command_name):
+    # Straight to coop_door.py, if it runs on this host, so the buttons also work while the broker is down. Only when
+    # it isn't reachable or refuses the request, e.g. for an unknown door, the command goes over the broker, never both
+    # ways, as they could overtake each other.
+    door_id = cfg.get_coop_door_buttons_door()
+    reply = local_control.request(f'{command_name} {door_id}') if local_control else None
+    if reply is None:
+        return False
+    if reply.startswith(REPLY_ERROR):
+        log('Coop door command %s for %s refused over local control: %s', command_name, door_id, reply,
+            level=logging.WARNING)
+        return False
+    log('Sent coop door command %s over local control: %s', command_name, reply)
+    return True
+
+def format_window():
+    open_at, close_at = schedule.window()
+    return f"{time.strftime('%H:%M', time.localtime(open_at))}-{time.strftime('%H:%M', time.localtime(close_at))}"
+
+def start_schedule():
+    global schedule_runner
+    if schedule_runner:
+        schedule_runner.stop()
+        schedule_runner = None
+    log('Opening window today %s', format_window())
+    auto_open = cfg.get_schedule_auto_open()
+    auto_close = cfg.get_schedule_auto_close()
+    if auto_open or auto_close:
+        schedule_runner = ScheduleRunner(
+            schedule,
+            partial(publish_scheduled_command, CoopDoorCommand.OPEN) if auto_open else None,
+            partial(publish_scheduled_command, CoopDoorCommand.CLOSE) if auto_close else None
+        )
+        schedule_runner.start()
+
+def publish_realtime_state(state, cause=CAUSE_BUTTON):
     state_name = state.name
-    log(f'Publishing coop door real state {state_name}')
-    state_info = client.publish(MQTT_COOP_DOOR_REALTIME_STATE_TOPIC, state_name)
-    log(f'Published coop door real state {state_name} with rc {state_info.rc}')
+    # Only the latest realtime state matters, older ones still waiting for the broker are dropped
+    publisher.publish(MQTT_COOP_DOOR_REALTIME_STATE_TOPIC, state_name, coalesce=True)
+    if cfg.get_mqtt_structured_payloads():
+        topic = MQTT_COOP_DOOR_REALTIME_STATE_TOPIC + STRUCTURED_TOPIC_SUFFIX
+        publisher.publish(topic, state_encoder.encode(topic, DEFAULT_DOOR, state_name, cause), coalesce=True)
+    log('Queued coop door real state %s', state_name)
+
+def format_publisher_stats():
+    return publisher.stats() if publisher else 'Publisher not started'
+
+def format_press_confirmation():
+    return press_confirmation.format()
+
+def format_command_stats():
+    return command_sender.format() if command_sender else 'Command acks disabled'
+
+def format_heartbeat_stats():
+    return heartbeat.format() if heartbeat else 'Heartbeat disabled'
 
 def on_connect(client, userdata, flags, result_code, properties):
     if result_code == 0:
-        client.subscribe(MQTT_COMMAND_TOPIC)
-        log(f'Connected to mqtt broker and topic {MQTT_COMMAND_TOPIC}')
+        recovery.connected()
+        startup.mark(PHASE_CONNECT)
+        # The buttons only publish commands, a subscription of the command topic left in the persistent session by an
+        # older version would make the broker queue every command for them while they are away
+        client.unsubscribe(MQTT_COMMAND_TOPIC)
+        if command_sender:
+            _, mid = client.subscribe(command_sender.reply_topic, qos=cfg.get_mqtt_qos())
+            pending_subscriptions.add(mid)
+        if mqtt_probe:
+            pending_subscriptions.add(mqtt_probe.subscribe())
+        if not pending_subscriptions:
+            startup.mark(PHASE_SUBSCRIBE)
+        publisher.notify_connected()
+        log(f'Connected to mqtt broker, publishing commands to {MQTT_COMMAND_TOPIC}')
     else:
         log(f'Mqtt Broker connection failed with error code {result_code}')
 
+def on_message(client, userdata, message):
+    # Only the replies of coop_door.py to the own commands and the own heartbeat probes are handled
+    if command_sender and message.topic == command_sender.reply_topic:
+        command_sender.on_reply(message)
+    elif mqtt_probe and message.topic == mqtt_probe.topic:
+        mqtt_probe.answer()
+
+def on_subscribe(client, userdata, mid, reason_code_list, properties):
+    if any(reason_code.is_failure for reason_code in reason_code_list):
+        log('Subscription %s was rejected by the broker: %s', mid, reason_code_list, level=logging.WARNING)
+    if mqtt_probe:
+        mqtt_probe.on_subscribe(mid, reason_code_list)
+    pending_subscriptions.discard(mid)
+    if not pending_subscriptions:
+        startup.mark(PHASE_SUBSCRIBE)
+
+
 def setup_logging():
-    log_handler = logging.handlers.WatchedFileHandler(cfg.get_coop_door_buttons_logging_logfile())
-    formatter = logging.Formatter(
+    setup_queued_logging(
+        cfg.get_coop_door_buttons_logging_logfile(),
         cfg.get_coop_door_logging_message_format(),
-        cfg.get_coop_door_buttons_logging_date_time_format()
+        cfg.get_coop_door_buttons_logging_date_time_format(),
+        cfg.get_coop_door_buttons_logging_level(),
+        cfg.get_coop_door_buttons_logging_burst_limit(),
+        cfg.get_coop_door_buttons_logging_burst_window()
     )
-    log_handler.setFormatter(formatter)
-    logger = logging.getLogger()
-    logger.addHandler(log_handler)
-    logger.setLevel(cfg.get_coop_door_buttons_logging_level())
 
 def log(message: str, *args, level: int = logging.INFO, exc=None) -> None:
     if exc:
@@ -99,31 +219,116 @@ def log(message: str, *args, level: int = logging.INFO, exc=None) -> None:
 
 def init_buttons():
     global up_button, stop_button, down_button
+    # gpiozero is only imported here, as it takes a while on a Pi Zero
+    Button = load_button_class(cfg)
     up_button = Button(UP_PIN, pull_up=True, bounce_time=BUTTON_BOUNCE_TIME)
     stop_button = Button(STOP_PIN, pull_up=True, bounce_time=BUTTON_BOUNCE_TIME)
     down_button = Button(DOWN_PIN, pull_up=True, bounce_time=BUTTON_BOUNCE_TIME)
 
+def confirmed_press(button, command, on_press):
+    # Runs on the gpiozero callback thread, which is blocked for at most the confirmation hold time
+    def when_pressed():
+        pressed_at_ns = edge_timestamp_ns(button)
+        if press_confirmation.confirm(button, pressed_at_ns):
+            on_press(pressed_at_ns)
+        else:
+            journal.record(EVENT_PRESS_REJECTED, command.value, monotonic_ns=pressed_at_ns)
+            metrics.inc('coop_door_button_presses_rejected_total', command=command.name)
+            log('Rejected press of button %s, it was not held long enough', command.name, level=logging.WARNING)
+    return gpio_callbacks.wrap(when_pressed)
+
+def register_button_callbacks():
+    stop_button.when_pressed = confirmed_press(stop_button, CoopDoorCommand.STOP, coop_door_stop)
+    up_button.when_pressed = confirmed_press(up_button, CoopDoorCommand.OPEN, coop_door_open)
+    down_button.when_pressed = confirmed_press(down_button, CoopDoorCommand.CLOSE, coop_door_close)
+
+def reload_config(changed_sections):
+    global UP_PIN, STOP_PIN, DOWN_PIN, BUTTON_BOUNCE_TIME, MQTT_COMMAND_TOPIC, MQTT_COOP_DOOR_REALTIME_STATE_TOPIC
+    global schedule, press_confirmation, command_sender
+
+    if 'COOP_DOOR_BUTTONS_LOGGING' in changed_sections:
+        logging.getLogger().setLevel(cfg.get_coop_door_buttons_logging_level())
+
+    if 'MQTT' in changed_sections:
+        MQTT_COMMAND_TOPIC = cfg.get_mqtt_topic_command()
+        MQTT_COOP_DOOR_REALTIME_STATE_TOPIC = cfg.get_mqtt_topic_realtime_state()
+        # The reply topic follows the command topic, commands waiting for their ack are given up
+        old_command_sender = command_sender
+        command_sender = create_command_sender(cfg, publisher.publish, MQTT_COMMAND_TOPIC, 'coop_door_buttons',
+                                               client.is_connected)
+        if old_command_sender:
+            old_command_sender.close()
+            if client:
+                client.unsubscribe(old_command_sender.reply_topic)
+        if client and command_sender:
+            client.subscribe(command_sender.reply_topic, qos=cfg.get_mqtt_qos())
+        log('Publishing commands to %s', MQTT_COMMAND_TOPIC)
+
+    if 'COOP_DOOR_BUTTONS' in changed_sections:
+        UP_PIN = cfg.get_coop_door_buttons_open_pin()
+        STOP_PIN = cfg.get_coop_door_buttons_stop_pin()
+        DOWN_PIN = cfg.get_coop_door_buttons_close_pin()
+        BUTTON_BOUNCE_TIME = cfg.get_coop_door_buttons_bounce_time()
+        press_confirmation = PressConfirmation(
+            cfg.get_coop_door_buttons_confirm_hold_time(),
+            cfg.get_coop_door_buttons_confirm_samples(),
+            cfg.get_coop_door_buttons_confirm_required()
+        )
+        metrics.histogram('coop_door_press_confirm_seconds', press_confirmation.latency)
+        for button in (up_button, stop_button, down_button):
+            button.close()
+        init_buttons()
+        register_button_callbacks()
+        log('Buttons reinitialized with bounce time %s', BUTTON_BOUNCE_TIME)
+
+    if 'SCHEDULE' in changed_sections:
+        schedule = create_schedule(cfg)
+        start_schedule()
+
 def main():
-    global client
+    global client, publisher, local_control, command_sender, heartbeat, mqtt_probe
     setup_logging()
+    tracer.install_dump_handler(format_publisher_stats, recovery.format, format_press_confirmation,
+                                format_input_stats, format_command_stats, format_heartbeat_stats)
+    register_tracer(tracer)
+    metrics.histogram('coop_door_press_confirm_seconds', press_confirmation.latency)
+    metrics.histogram('coop_door_mqtt_recovery_seconds', recovery.recoveries)
+    start_metrics_server(cfg, 'coop_door_buttons')
+    local_control = create_local_control_client(cfg)
     try:
-        init_buttons()
-
         log('Connecting to mqtt')
-        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        client = create_client(cfg, 'coop_door_buttons')
         log('Mqtt client created')
         client.username_pw_set(cfg.get_mqtt_username(), cfg.get_mqtt_password())
         log('Mqtt username and password set')
         client.on_connect = on_connect
+        client.on_disconnect = recovery.on_disconnect
+        client.on_message = on_message
+        client.on_subscribe = on_subscribe
+        publisher = create_publisher(cfg, client)
+        command_sender = create_command_sender(cfg, publisher.publish, MQTT_COMMAND_TOPIC, 'coop_door_buttons',
+                                               client.is_connected)
+        heartbeat = create_heartbeat(cfg)
+        if heartbeat:
+            mqtt_probe = create_mqtt_probe(cfg, client, 'coop_door_buttons')
+            heartbeat.add(mqtt_probe)
         log('Trying to connect to Mqtt server')
-        client.connect(BROKER_ADDRESS)
-        log('Connected to Mqtt server')
+        # Retries until the broker is reachable, also when it's still down at boot. The connect runs on the network
+        # thread while the buttons are set up.
+        connect_client(client, cfg)
         client.loop_start()
 
+        init_buttons()
         log('Waiting for button event')
-        stop_button.when_pressed = coop_door_stop
-        up_button.when_pressed = coop_door_open
-        down_button.when_pressed = coop_door_close
+        register_button_callbacks()
+        startup.mark(PHASE_GPIO)
+        if heartbeat:
+            heartbeat.add(create_gpio_probe())
+            heartbeat.add(gpio_callbacks)
+            heartbeat.start()
+        start_schedule()
+        cfg.add_reload_listener(reload_config)
+        cfg.start_watching()
 
         pause()
     except KeyboardInterrupt:
@@ -131,9 +336,14 @@ def main():
     except Exception as err:
         log('coop_door_buttons.py broke with exception', level=logging.ERROR, exc=err)
     finally:
+        if heartbeat:
+            heartbeat.stop()
         if client:
-            client.unsubscribe(MQTT_COMMAND_TOPIC)
+            if not cfg.get_mqtt_persistent_session() and command_sender:
+                client.unsubscribe(command_sender.reply_topic)
             client.disconnect()
+        if command_sender:
+            command_sender.close()
         log('Finishing coop door buttons script')
 
 if __name__ == '__main__':
@@ -0,0 +1,154 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Evaluates the journal written by the coop door scripts.
+
+    python coop_door_journal.py travel [--since DAYS]
+        Travel times per door and direction, from motor on to the stop at the end stop.
+    python coop_door_journal.py bounces [--since DAYS]
+        Sensor edges vs. debounced states per sensor.
+    python coop_door_journal.py blocked [--since DAYS]
+        Button presses, rejected presses and blocked openings per hour of the day.
+    python coop_door_journal.py dump [--since DAYS]
+        Every record.
+"""
+
+import argparse
+import datetime as dt
+import time
+from collections import defaultdict
+
+from misc.config_loader import Config
+from misc.coop_door_command import CoopDoorCommand
+from misc.coop_door_state import CoopDoorState
+from misc.journal import (
+    EVENT_BUTTON_PRESS,
+    EVENT_COMMAND,
+    EVENT_MOTOR_OFF,
+    EVENT_MOTOR_ON,
+    EVENT_NAMES,
+    EVENT_OPEN_BLOCKED,
+    EVENT_PRESS_REJECTED,
+    EVENT_SENSOR_COMMIT,
+    EVENT_SENSOR_EDGE,
+    EVENT_STATE_PUBLISH,
+    MOTOR_OFF_END_STOP,
+    MOTOR_OFF_TRAVEL_TIMEOUT,
+    MOTOR_OPENING,
+    read_journal,
+    SENSOR_OPEN
+)
+
+DAY_NS = 24 * 3600 * 10 ** 9
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def travel(records):
+    started = {}
+    durations = defaultdict(list)
+    timeouts = defaultdict(int)
+    for _, monotonic_ns, door, event, source, value in records:
+        if event == EVENT_MOTOR_ON:
+            started[(door, source)] = (monotonic_ns, 'opening' if value == MOTOR_OPENING else 'closing')
+        elif event == EVENT_MOTOR_OFF:
+            start = started.pop((door, source), None)
+            # Monotonic time restarts with a reboot
+            if value == MOTOR_OFF_END_STOP and start and monotonic_ns >= start[0]:
+                durations[(door, start[1])].append((monotonic_ns - start[0]) / 1e9)
+            elif value == MOTOR_OFF_TRAVEL_TIMEOUT and start:
+                timeouts[(door, start[1])] += 1
+
+    for (door, direction), seconds in sorted(durations.items()):
+        seconds.sort()
+        print(f'{door} {direction}: {len(seconds)} runs, min {seconds[0]:.2f}s, median {percentile(seconds, 0.5):.2f}s, '
+              f'p90 {percentile(seconds, 0.9):.2f}s, max {seconds[-1]:.2f}s, mean {sum(seconds) / len(seconds):.2f}s')
+    for (door, direction), count in sorted(timeouts.items()):
+        print(f'{door} {direction}: {count} runs stopped by the travel watchdog')
+    if not durations:
+        print('No completed runs')
+
+
+def bounces(records):
+    edges = defaultdict(int)
+    commits = defaultdict(int)
+    for _, _, door, event, _, value in records:
+        sensor = (door, 'open sensor' if abs(value) == SENSOR_OPEN else 'closed sensor')
+        if event == EVENT_SENSOR_EDGE:
+            edges[sensor] += 1
+        elif event == EVENT_SENSOR_COMMIT:
+            commits[sensor] += 1
+
+    for door, sensor in sorted(set(edges) | set(commits)):
+        edge_count = edges[(door, sensor)]
+        commit_count = commits[(door, sensor)]
+        bounce_count = max(0, edge_count - commit_count)
+        ratio = f', {bounce_count / commit_count:.1f} bounces per state' if commit_count else ''
+        print(f'{door} {sensor}: {edge_count} edges, {commit_count} states, {bounce_count} bounces{ratio}')
+    if not edges and not commits:
+        print('No sensor events')
+
+
+def blocked(records):
+    presses = defaultdict(int)
+    rejected_presses = defaultdict(int)
+    blocked_openings = defaultdict(int)
+    counters = {
+        EVENT_BUTTON_PRESS: presses,
+        EVENT_PRESS_REJECTED: rejected_presses,
+        EVENT_OPEN_BLOCKED: blocked_openings
+    }
+    for wall_ns, _, _, event, _, _ in records:
+        if event in counters:
+            counters[event][dt.datetime.fromtimestamp(wall_ns / 1e9).hour] += 1
+
+    print('hour  presses  rejected  blocked openings')
+    for hour in range(24):
+        if presses[hour] or rejected_presses[hour] or blocked_openings[hour]:
+            print(f'{hour:02d}    {presses[hour]:7d}  {rejected_presses[hour]:8d}  {blocked_openings[hour]:16d}')
+    print(f'total {sum(presses.values()):7d}  {sum(rejected_presses.values()):8d}  '
+          f'{sum(blocked_openings.values()):16d}')
+
+
+def format_value(event, value):
+    if event in (EVENT_COMMAND, EVENT_BUTTON_PRESS, EVENT_PRESS_REJECTED):
+        return CoopDoorCommand(value).name
+    if event == EVENT_STATE_PUBLISH:
+        return CoopDoorState(value).name
+    if event == EVENT_MOTOR_ON:
+        return 'opening' if value == MOTOR_OPENING else 'closing'
+    if event == EVENT_MOTOR_OFF:
+        if value == MOTOR_OFF_TRAVEL_TIMEOUT:
+            return 'travel timeout'
+        return 'end stop' if value == MOTOR_OFF_END_STOP else 'stopped'
+    if event in (EVENT_SENSOR_EDGE, EVENT_SENSOR_COMMIT):
+        return f"{'open' if abs(value) == SENSOR_OPEN else 'closed'} sensor {'pressed' if value > 0 else 'released'}"
+    return str(value)
+
+
+def dump(records):
+    for wall_ns, _, door, event, _, value in records:
+        timestamp = dt.datetime.fromtimestamp(wall_ns / 1e9).isoformat(timespec='milliseconds')
+        print(f'{timestamp} {door}: {EVENT_NAMES.get(event, event)} {format_value(event, value)}')
+
+
+def main():
+    commands = {'travel': travel, 'bounces': bounces, 'blocked': blocked, 'dump': dump}
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=commands)
+    parser.add_argument('--since', type=float, help='only the last DAYS days')
+    parser.add_argument('--directory', help='journal directory, by default the one of the config')
+    args = parser.parse_args()
+
+    directory = args.directory or Config().get_journal_directory()
+    since_wall_ns = time.time_ns() - int(args.since * DAY_NS) if args.since else 0
+    start = time.perf_counter()
+    commands[args.command](read_journal(directory, since_wall_ns))
+    if args.command != 'dump':
+        print(f'\nEvaluated in {time.perf_counter() - start:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,44 +1,123 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-from gpiozero import Button
 from signal import pause
-import paho.mqtt.client as mqtt
 import logging
-import logging.handlers
+import threading
+import time
 
 from misc.config_loader import Config
+from misc.debounce import Debouncer
+from misc.event_bus import EVENT_END_STOP
+from misc.hardware import create_gpio_probe, edge_timestamp_ns, format_input_stats, load_button_class
+from misc.heartbeat import create_heartbeat, create_mqtt_probe, gpio_callbacks
+from misc.journal import (
+    create_journal,
+    DEFAULT_DOOR,
+    EVENT_SENSOR_COMMIT,
+    EVENT_SENSOR_EDGE,
+    EVENT_STATE_PUBLISH,
+    SENSOR_CLOSED,
+    SENSOR_OPEN
+)
+from misc.local_control import create_local_control_client, REPLY_ERROR
+from misc.metrics import metrics, register_tracer, start_metrics_server
+from misc.mqtt_client import connect_client, create_client, RecoveryTimer
+from misc.mqtt_publisher import create_publisher
+from misc.queued_logging import setup_queued_logging
+from misc.startup import PHASE_CONFIG, PHASE_CONNECT, PHASE_GPIO, PHASE_IMPORTS, StartupTimer
+from misc.state_payload import (
+    CAUSE_CLOSED_SENSOR,
+    CAUSE_OPEN_SENSOR,
+    CAUSE_RESYNC,
+    CAUSE_SENSORS_RELEASED,
+    StateEncoder,
+    STRUCTURED_TOPIC_SUFFIX
+)
+from misc.tracing import create_tracer
 from misc.coop_door_state import CoopDoorState
 
-cfg = Config()
+# adaptive passes every edge to the software debouncer, fixed uses the bounce time of gpiozero
+DEBOUNCE_ADAPTIVE = 'adaptive'
 
-# Initializing pins
-SENSOR_COOP_DOOR_OPENED_PIN = cfg.get_coop_door_sensors_open_pin()
-SENSOR_COOP_DOOR_CLOSED_PIN = cfg.get_coop_door_sensors_close_pin()
+# Sensor of each end stop state in the journal
+JOURNAL_SENSORS = {CoopDoorState.OPEN.name: SENSOR_OPEN, CoopDoorState.CLOSED.name: SENSOR_CLOSED}
+METRICS_SENSORS = {CoopDoorState.OPEN.name: 'open', CoopDoorState.CLOSED.name: 'closed'}
+CAUSE_SENSORS = {CoopDoorState.OPEN.name: CAUSE_OPEN_SENSOR, CoopDoorState.CLOSED.name: CAUSE_CLOSED_SENSOR}
 
-MQTT_COOP_DOOR_STATE_TOPIC = cfg.get_mqtt_topic_state()
-MQTT_COOP_DOOR_REALTIME_STATE_TOPIC = cfg.get_mqtt_topic_realtime_state()
+# Set by configure, when the sensors run as a script or inside coop_door.py, which shares its own with them
+cfg = None
+tracer = None
+journal = None
+state_encoder = StateEncoder('coop_door_sensors')
+# Only when run as a script: ready for systemd, once the sensors are read and the broker connected
+startup = None
 
-SENSOR_BOUNCE_TIME = 0.01
+# Pins, topics and debouncing, see read_topics and read_sensors
+SENSOR_COOP_DOOR_OPENED_PIN = None
+SENSOR_COOP_DOOR_CLOSED_PIN = None
+MQTT_COOP_DOOR_STATE_TOPIC = None
+MQTT_COOP_DOOR_REALTIME_STATE_TOPIC = None
+SENSOR_DEBOUNCE = None
+# Fixed bounce time or the initial settle time for the adaptive debouncer, which stays between min and max
+SENSOR_BOUNCE_TIME = None
+SENSOR_BOUNCE_TIME_MIN = None
+SENSOR_BOUNCE_TIME_MAX = None
 
 # Global last state to only publish a state, when it changed
 last_state = None
 
 client = None
+recovery = RecoveryTimer()
+publisher = None
 door_open_sensor = None
 door_closed_sensor = None
+debouncer = None
+# Set once the sensors are initialized, their state is only published after
+hardware_ready = threading.Event()
+# Set when the sensors run inside coop_door.py, which stops the motor on the end stop event
+event_bus = None
+# Control socket of coop_door.py, if it runs on this host
+local_control = None
+# Withholds the systemd watchdog while the Mqtt loop or a sensor callback hangs, if enabled
+heartbeat = None
+mqtt_probe = None
+
+
+def configure(config, sensors_journal, sensors_tracer):
+    """Sets the sensors up with the config, journal and tracer of the process they run in."""
+    global cfg, journal, tracer
+    cfg, journal, tracer = config, sensors_journal, sensors_tracer
+    read_topics()
+    read_sensors()
+
+
+def read_topics():
+    global MQTT_COOP_DOOR_STATE_TOPIC, MQTT_COOP_DOOR_REALTIME_STATE_TOPIC
+    MQTT_COOP_DOOR_STATE_TOPIC = cfg.get_mqtt_topic_state()
+    MQTT_COOP_DOOR_REALTIME_STATE_TOPIC = cfg.get_mqtt_topic_realtime_state()
+
+
+def read_sensors():
+    global SENSOR_COOP_DOOR_OPENED_PIN, SENSOR_COOP_DOOR_CLOSED_PIN
+    global SENSOR_DEBOUNCE, SENSOR_BOUNCE_TIME, SENSOR_BOUNCE_TIME_MIN, SENSOR_BOUNCE_TIME_MAX
+    SENSOR_COOP_DOOR_OPENED_PIN = cfg.get_coop_door_sensors_open_pin()
+    SENSOR_COOP_DOOR_CLOSED_PIN = cfg.get_coop_door_sensors_close_pin()
+    SENSOR_DEBOUNCE = cfg.get_coop_door_sensors_debounce()
+    SENSOR_BOUNCE_TIME = cfg.get_coop_door_sensors_bounce_time()
+    SENSOR_BOUNCE_TIME_MIN = cfg.get_coop_door_sensors_bounce_time_min()
+    SENSOR_BOUNCE_TIME_MAX = cfg.get_coop_door_sensors_bounce_time_max()
 
 
 def setup_logging():
-    log_handler = logging.handlers.WatchedFileHandler(cfg.get_coop_door_sensors_logging_logfile())
-    formatter = logging.Formatter(
+    setup_queued_logging(
+        cfg.get_coop_door_sensors_logging_logfile(),
         cfg.get_coop_door_sensors_logging_message_format(),
-        cfg.get_coop_door_sensors_logging_date_time_format()
+        cfg.get_coop_door_sensors_logging_date_time_format(),
+        cfg.get_coop_door_sensors_logging_level(),
+        cfg.get_coop_door_sensors_logging_burst_limit(),
+        cfg.get_coop_door_sensors_logging_burst_window()
     )
-    log_handler.setFormatter(formatter)
-    logger = logging.getLogger()
-    logger.addHandler(log_handler)
-    logger.setLevel(cfg.get_coop_door_sensors_logging_level())
 
 
 def log(message: str, *args, level: int = logging.INFO, exc=None) -> None:
@@ -47,69 +126,259 @@ def log(message: str, *args, level: int = logging.INFO, exc=None) -> None:
     else:
         logging.log(level, message, *args)
 
-def publish_state(new_state):
+def publish_structured_state(topic, state, cause, detected_at_ns=None, retain=False, coalesce=False):
+    if cfg.get_mqtt_structured_payloads():
+        topic += STRUCTURED_TOPIC_SUFFIX
+        payload = state_encoder.encode(topic, DEFAULT_DOOR, state, cause, detected_at_ns)
+        publisher.publish(topic, payload, retain=retain, coalesce=coalesce)
+
+def publish_state(new_state, detected_at_ns=None, cause=CAUSE_RESYNC):
     global last_state
-    log(f'Current realtime state {last_state}, new state {new_state}')
+    log('Current realtime state %s, new state %s', last_state, new_state)
     # only publish when state changed
     if new_state != last_state:
-        log(f'Realtime state changed from {last_state} to {new_state}')
-        realtime_state_info = client.publish(MQTT_COOP_DOOR_REALTIME_STATE_TOPIC, new_state)
-        log(f'Published realtime state {new_state} to topic {MQTT_COOP_DOOR_REALTIME_STATE_TOPIC} with rc {realtime_state_info.rc}')
+        log('Realtime state changed from %s to %s', last_state, new_state)
+        journal.record(EVENT_STATE_PUBLISH, CoopDoorState[new_state].value)
+        # Only the latest realtime state matters, older ones still waiting for the broker are dropped
+        publisher.publish(MQTT_COOP_DOOR_REALTIME_STATE_TOPIC, new_state, coalesce=True)
+        publish_structured_state(MQTT_COOP_DOOR_REALTIME_STATE_TOPIC, new_state, cause, detected_at_ns, coalesce=True)
+        log('Queued realtime state %s for topic %s', new_state, MQTT_COOP_DOOR_REALTIME_STATE_TOPIC)
 
         # Only open and closed are published to the state topic which can be used to set a switch in OpenHab, e.g.
         if new_state in [CoopDoorState.OPEN.name, CoopDoorState.CLOSED.name]:
-            state_info = client.publish(MQTT_COOP_DOOR_STATE_TOPIC, new_state, retain=True)
-            #log(f'Published state {new_state} to topic {MQTT_COOP_DOOR_STATE_TOPIC} with rc {state_info.rc}')
-            pass
+            # The trace carries the time the end stop was detected, so the coop door can measure its latencies
+            trace = tracer.start_trace(detected_at_ns)
+            publisher.publish(MQTT_COOP_DOOR_STATE_TOPIC, new_state, retain=True, properties=tracer.properties(trace))
+            publish_structured_state(MQTT_COOP_DOOR_STATE_TOPIC, new_state, cause, detected_at_ns, retain=True)
 
         last_state = new_state
 
-def door_opened():
-    publish_state(CoopDoorState.OPEN.name)
 
-def door_closed():
-    publish_state(CoopDoorState.CLOSED.name)
+def end_stop_reached(state, detected_at_ns):
+    # Fast path without the broker: the motor is stopped once the sensor is debounced, before publishing. Not on the
+    # first raw edge, as a single glitch on the line would stop a moving door then.
+    if event_bus:
+        event_bus.publish(EVENT_END_STOP, state, detected_at_ns)
+    elif local_control:
+        # The state is still published, also for coop_door.py, in case it isn't reachable over the socket
+        door_id = cfg.get_coop_door_sensors_door()
+        reply = local_control.request(f'END {state} {door_id}')
+        if reply and reply.startswith(REPLY_ERROR):
+            log('End stop %s of %s refused over local control: %s', state, door_id, reply, level=logging.WARNING)
+
+def door_reached(state):
+    detected_at_ns = time.monotonic_ns()
+    journal.record(EVENT_SENSOR_COMMIT, JOURNAL_SENSORS[state], monotonic_ns=detected_at_ns)
+    metrics.inc('coop_door_sensor_states_total', sensor=METRICS_SENSORS[state])
+    end_stop_reached(state, detected_at_ns)
+    publish_state(state, detected_at_ns, CAUSE_SENSORS[state])
 
 # For the time the door is opening or closing, the state is "unknown"
 def door_running():
-    publish_state(CoopDoorState.RUNNING.name)
+    publish_state(CoopDoorState.RUNNING.name, cause=CAUSE_SENSORS_RELEASED)
+
+def door_left(state):
+    journal.record(EVENT_SENSOR_COMMIT, -JOURNAL_SENSORS[state])
+    metrics.inc('coop_door_sensor_states_total', sensor=METRICS_SENSORS[state])
+    door_running()
+
+
+def on_sensor_commit(state, pressed, detected_at_ns):
+    journal.record(EVENT_SENSOR_COMMIT, JOURNAL_SENSORS[state] if pressed else -JOURNAL_SENSORS[state])
+    metrics.inc('coop_door_sensor_states_total', sensor=METRICS_SENSORS[state])
+    if pressed:
+        end_stop_reached(state, detected_at_ns)
+        publish_state(state, detected_at_ns, CAUSE_SENSORS[state])
+    else:
+        door_running()
 
 
 def on_connect(client, userdata, flags, result_code, properties):
     log(f"Connected with result code {result_code}")
+    recovery.connected()
+    startup.mark(PHASE_CONNECT)
+    # Only blocks on the first connect, if it was faster than setting up the sensors
+    hardware_ready.wait()
+    if PHASE_GPIO not in startup.done:
+        return
+    if mqtt_probe:
+        mqtt_probe.subscribe()
+    resync_state()
+    publisher.notify_connected()
+
+
+def on_message(client, userdata, message):
+    # The sensors only receive their own heartbeat probes
+    if mqtt_probe and message.topic == mqtt_probe.topic:
+        mqtt_probe.answer()
+
+
+def on_subscribe(client, userdata, mid, reason_code_list, properties):
+    if mqtt_probe:
+        mqtt_probe.on_subscribe(mid, reason_code_list)
+
+
+def resync_state():
+    # States may have been missed while the broker was unreachable, so the sensors are read again and their state is
+    # published even if it didn't change
+    global last_state
+    if door_open_sensor.is_pressed:
+        state = CoopDoorState.OPEN.name
+    elif door_closed_sensor.is_pressed:
+        state = CoopDoorState.CLOSED.name
+    else:
+        state = CoopDoorState.RUNNING.name
+    last_state = None
+    publish_state(state, cause=CAUSE_RESYNC)
+    log('Resynchronized state %s after connecting', state)
 
 
 def init_sensors():
     global door_open_sensor, door_closed_sensor
+    # With the adaptive debouncer gpiozero must pass on every edge
+    bounce_time = None if SENSOR_DEBOUNCE == DEBOUNCE_ADAPTIVE else SENSOR_BOUNCE_TIME
+    # gpiozero is only imported here, as it takes a while on a Pi Zero
+    Button = load_button_class(cfg)
     # Initialize sensors
-    door_open_sensor = Button(SENSOR_COOP_DOOR_OPENED_PIN, pull_up=True, bounce_time=SENSOR_BOUNCE_TIME)
-    door_closed_sensor = Button(SENSOR_COOP_DOOR_CLOSED_PIN, pull_up=True, bounce_time=SENSOR_BOUNCE_TIME)
+    door_open_sensor = Button(SENSOR_COOP_DOOR_OPENED_PIN, pull_up=True, bounce_time=bounce_time)
+    door_closed_sensor = Button(SENSOR_COOP_DOOR_CLOSED_PIN, pull_up=True, bounce_time=bounce_time)
 
 
-def main():
-    global client
-    setup_logging()
+def register_adaptive_debouncing():
+    global debouncer
+    if debouncer is None:
+        debouncer = Debouncer()
+        debouncer.start()
+    for channel in list(debouncer.channels):
+        debouncer.remove_channel(channel)
+
+    for name, sensor, state in (
+        ('open sensor', door_open_sensor, CoopDoorState.OPEN.name),
+        ('closed sensor', door_closed_sensor, CoopDoorState.CLOSED.name)
+    ):
+        channel = debouncer.add_channel(
+            name, sensor.is_pressed,
+            lambda pressed, detected_at_ns, state=state: on_sensor_commit(state, pressed, detected_at_ns),
+            SENSOR_BOUNCE_TIME, SENSOR_BOUNCE_TIME_MIN, SENSOR_BOUNCE_TIME_MAX
+        )
+        sensor.when_pressed = gpio_callbacks.wrap(
+            lambda sensor=sensor, channel=channel, state=state: sensor_pressed(sensor, channel, state)
+        )
+        sensor.when_released = gpio_callbacks.wrap(
+            lambda sensor=sensor, channel=channel, state=state: sensor_released(sensor, channel, state)
+        )
+
+
+def sensor_pressed(sensor, channel, state):
+    pressed_at_ns = edge_timestamp_ns(sensor)
+    journal.record(EVENT_SENSOR_EDGE, JOURNAL_SENSORS[state], monotonic_ns=pressed_at_ns)
+    metrics.inc('coop_door_sensor_edges_total', sensor=METRICS_SENSORS[state])
+    debouncer.edge(channel, True, pressed_at_ns)
+
+
+def sensor_released(sensor, channel, state):
+    released_at_ns = edge_timestamp_ns(sensor)
+    journal.record(EVENT_SENSOR_EDGE, -JOURNAL_SENSORS[state], monotonic_ns=released_at_ns)
+    metrics.inc('coop_door_sensor_edges_total', sensor=METRICS_SENSORS[state])
+    debouncer.edge(channel, False, released_at_ns)
+
+
+def register_sensor_callbacks():
+    if SENSOR_DEBOUNCE == DEBOUNCE_ADAPTIVE:
+        register_adaptive_debouncing()
+        return
+
+    # Waiting for event to publish the current state
+    door_open_sensor.when_pressed = gpio_callbacks.wrap(lambda: door_reached(CoopDoorState.OPEN.name))
+    door_closed_sensor.when_pressed = gpio_callbacks.wrap(lambda: door_reached(CoopDoorState.CLOSED.name))
+
+    # For the time opening or closing, when no sensor is active
+    door_open_sensor.when_released = gpio_callbacks.wrap(lambda: door_left(CoopDoorState.OPEN.name))
+    door_closed_sensor.when_released = gpio_callbacks.wrap(lambda: door_left(CoopDoorState.CLOSED.name))
+
+
+def init_hardware():
     try:
         init_sensors()
+        register_sensor_callbacks()
+        startup.mark(PHASE_GPIO)
+    finally:
+        # Also when it failed, so on_connect doesn't block the shutdown
+        hardware_ready.set()
+
+
+def format_debounce_stats():
+    if debouncer is None:
+        return 'Adaptive debouncing disabled'
+    return f'Debounce stats:\n{debouncer.format_stats()}'
+
+
+def format_publisher_stats():
+    return publisher.stats() if publisher else 'Publisher not started'
+
 
+def reload_logging(changed_sections):
+    # Only when run as a script, inside coop_door.py its own logging section applies
+    if 'COOP_DOOR_SENSORS_LOGGING' in changed_sections:
+        logging.getLogger().setLevel(cfg.get_coop_door_sensors_logging_level())
+
+
+def reload_config(changed_sections):
+    if 'MQTT' in changed_sections:
+        read_topics()
+        log('Publishing states to %s and %s', MQTT_COOP_DOOR_STATE_TOPIC, MQTT_COOP_DOOR_REALTIME_STATE_TOPIC)
+
+    if 'COOP_DOOR_SENSORS' in changed_sections:
+        read_sensors()
+        door_open_sensor.close()
+        door_closed_sensor.close()
+        init_sensors()
+        register_sensor_callbacks()
+        log('Sensors reinitialized with %s debouncing and bounce time %s', SENSOR_DEBOUNCE, SENSOR_BOUNCE_TIME)
+
+
+def format_heartbeat_stats():
+    return heartbeat.format() if heartbeat else 'Heartbeat disabled'
+
+
+def main():
+    global client, publisher, local_control, heartbeat, mqtt_probe
+    setup_logging()
+    tracer.install_dump_handler(format_debounce_stats, format_publisher_stats, recovery.format, format_input_stats,
+                                format_heartbeat_stats)
+    local_control = create_local_control_client(cfg)
+    register_tracer(tracer)
+    metrics.histogram('coop_door_mqtt_recovery_seconds', recovery.recoveries)
+    start_metrics_server(cfg, 'coop_door_sensors')
+    try:
         log('Connecting to mqtt')
-        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        client = create_client(cfg, 'coop_door_sensors')
         log('Mqtt client created')
         client.username_pw_set(cfg.get_mqtt_username(), cfg.get_mqtt_password())
         log('Mqtt username and password set')
         log('Trying to connect to Mqtt server')
         client.on_connect = on_connect
-        client.connect(cfg.get_mqtt_broker())
-        log('Connected to Mqtt server')
+        client.on_disconnect = recovery.on_disconnect
+        client.on_message = on_message
+        client.on_subscribe = on_subscribe
+        publisher = create_publisher(cfg, client)
+        heartbeat = create_heartbeat(cfg)
+        if heartbeat:
+            mqtt_probe = create_mqtt_probe(cfg, client, 'coop_door_sensors')
+            heartbeat.add(mqtt_probe)
+        # Retries until the broker is reachable, also when it's still down at boot. The connect runs on the network
+        # thread while the sensors are set up.
+        connect_client(client, cfg)
         client.loop_start()
 
-        # Waiting for event to publish the current state
-        door_open_sensor.when_pressed = door_opened
-        door_closed_sensor.when_pressed = door_closed
-
-        # For the time opening or closing, when no sensor is active
-        door_open_sensor.when_released = door_running
-        door_closed_sensor.when_released = door_running
+        init_hardware()
+        if heartbeat:
+            heartbeat.add(create_gpio_probe())
+            heartbeat.add(gpio_callbacks)
+            heartbeat.start()
+        cfg.add_reload_listener(reload_logging)
+        cfg.add_reload_listener(reload_config)
+        cfg.start_watching()
 
         pause()
     except KeyboardInterrupt:
@@ -117,6 +386,8 @@ def main():
     except Exception as err:
         log("coop_door.py broke with exception", level=logging.ERROR, exc=err)
     finally:
+        if heartbeat:
+            heartbeat.stop()
         if client:
             client.loop_stop()
             client.disconnect()
@@ -124,4 +395,9 @@ def main():
 
 
 if __name__ == '__main__':
+    startup = StartupTimer('coop_door_sensors', (PHASE_GPIO, PHASE_CONNECT))
+    startup.mark(PHASE_IMPORTS)
+    cfg = Config()
+    startup.mark(PHASE_CONFIG)
+    configure(cfg, create_journal(cfg, 'coop_door_sensors'), create_tracer(cfg))
     main()
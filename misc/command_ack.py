@@ -0,0 +1,236 @@
+import logging
+import os
+import threading
+import time
+from collections import namedtuple, OrderedDict
+
+from misc.metrics import metrics
+from misc.mqtt_client import build_client_id
+from misc.tracing import LatencyHistogram
+
+# Acks coop_door.py publishes once it handled a command, the first word of the reply payload
+ACK_ACCEPTED = 'accepted'
+ACK_REJECTED = 'rejected'
+ACK_ALREADY = 'already'
+# Completions of an accepted OPEN or CLOSE, once its run ended
+DONE_COMPLETED = 'completed'
+DONE_INTERRUPTED = 'interrupted'
+DONE_FAULT = 'fault'
+ACKS = (ACK_ACCEPTED, ACK_REJECTED, ACK_ALREADY)
+# Commands which get a completion after their ack
+COMPLETING_COMMANDS = ('OPEN', 'CLOSE')
+
+# Subtopic of the command topic the replies of a sender go to, followed by its client id
+REPLY_TOPIC_SUFFIX = '/reply/'
+# Replies coop_door.py keeps, so a retried command is answered again instead of being executed twice
+REMEMBERED_REPLIES = 64
+# Seconds a sender waits for the completion of an accepted command
+COMPLETION_TIMEOUT = 600
+
+logger = logging.getLogger(__name__)
+
+# Where a command wants its replies: the Mqtt v5 response topic and correlation data of the command message
+CommandReply = namedtuple('CommandReply', ['topic', 'correlation_data'])
+
+
+def reply_of(message):
+    """The CommandReply a received command asks for or None."""
+    properties = message.properties
+    topic = getattr(properties, 'ResponseTopic', None) if properties is not None else None
+    if not topic:
+        return None
+    return CommandReply(topic, getattr(properties, 'CorrelationData', None) or b'')
+
+
+def reply_properties(correlation_data: bytes, response_topic: str = None, properties=None):
+    """Publish properties with correlation_data and response_topic, added to properties if given, e.g. the ones of
+    the tracer."""
+    if properties is None:
+        from paho.mqtt.packettypes import PacketTypes
+        from paho.mqtt.properties import Properties
+
+        properties = Properties(PacketTypes.PUBLISH)
+    properties.CorrelationData = correlation_data
+    if response_topic:
+        properties.ResponseTopic = response_topic
+    return properties
+
+
+class ReplyCache:
+    """Last replies of coop_door.py by correlation data. A sender retries a command, whose ack got lost or late, with
+    the same correlation data, and gets the ack of the first attempt instead of a second run of the motor."""
+
+    def __init__(self, size: int = REMEMBERED_REPLIES):
+        self.size = size
+        self._replies = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, reply: CommandReply):
+        with self._lock:
+            return self._replies.get((reply.topic, reply.correlation_data))
+
+    def put(self, reply: CommandReply, payload: str):
+        with self._lock:
+            self._replies[(reply.topic, reply.correlation_data)] = payload
+            if len(self._replies) > self.size:
+                self._replies.popitem(last=False)
+
+
+class PendingCommand:
+    __slots__ = ('request_id', 'topic', 'command', 'properties', 'sent_at_ns', 'acked_at_ns', 'attempts', 'timer',
+                 'offline')
+
+    def __init__(self, request_id: bytes, topic: str, command: str, properties):
+        self.request_id = request_id
+        self.topic = topic
+        self.command = command
+        self.properties = properties
+        self.sent_at_ns = None
+        self.acked_at_ns = None
+        self.attempts = 0
+        self.timer = None
+        # Whether the ack timeout passed while the broker was unreachable
+        self.offline = False
+
+
+class CommandSender:
+    """Publishes commands with a request id as Mqtt v5 correlation data and reply_topic as response topic, and waits
+    for the ack of coop_door.py. A command without ack after timeout seconds is published again with the same request
+    id, at most retries times. The time from the first publish to the ack and to the completion is kept per command,
+    so a lost command is told apart from a slow one.
+
+    publish is called with topic, payload and properties, e.g. MqttPublisher.publish; on_reply must be called with
+    every message received on reply_topic. While connected returns False, e.g. client.is_connected, no retries are
+    published, as the publisher holds the command until the reconnect anyway; the timeout starts over then."""
+
+    def __init__(self, publish, reply_topic: str, timeout: float, retries: int, connected=None):
+        self.publish = publish
+        self.connected = connected
+        self.reply_topic = reply_topic
+        self.timeout = timeout
+        self.retries = retries
+        self.retried = 0
+        self.unanswered = 0
+        self.acks = {ack: 0 for ack in ACKS}
+        # Round trip times per command
+        self.ack_rtt = {}
+        self.completion_rtt = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def send(self, topic: str, command: str, properties=None) -> bytes:
+        """Publishes command to topic, properties may already carry a trace. Returns the request id."""
+        request_id = os.urandom(8).hex().encode()
+        pending = PendingCommand(request_id, topic, command,
+                                 reply_properties(request_id, self.reply_topic, properties))
+        with self._lock:
+            self._expire(time.monotonic_ns())
+            self._pending[request_id] = pending
+            self._publish(pending)
+        return request_id
+
+    def _publish(self, pending: PendingCommand):
+        pending.attempts += 1
+        if pending.sent_at_ns is None:
+            pending.sent_at_ns = time.monotonic_ns()
+        self.publish(pending.topic, pending.command, properties=pending.properties)
+        self._start_timer(pending)
+
+    def _start_timer(self, pending: PendingCommand):
+        pending.timer = threading.Timer(self.timeout, self._ack_timeout, args=(pending,))
+        pending.timer.name = 'command-ack'
+        pending.timer.daemon = True
+        pending.timer.start()
+
+    def _ack_timeout(self, pending: PendingCommand):
+        with self._lock:
+            if self._pending.get(pending.request_id) is not pending or pending.acked_at_ns is not None:
+                return
+            if self.connected and not self.connected():
+                pending.offline = True
+                self._start_timer(pending)
+                return
+            if pending.offline:
+                # The held command was only just replayed
+                pending.offline = False
+                self._start_timer(pending)
+                return
+            if pending.attempts > self.retries:
+                del self._pending[pending.request_id]
+                self.unanswered += 1
+                logger.warning('Command %s %s not acknowledged after %s attempts', pending.command,
+                               pending.request_id.decode(), pending.attempts)
+                metrics.inc('coop_door_commands_unanswered_total', command=pending.command)
+                return
+            self.retried += 1
+            logger.info('Retrying command %s %s without ack', pending.command, pending.request_id.decode())
+            metrics.inc('coop_door_command_retries_total', command=pending.command)
+            self._publish(pending)
+
+    def _expire(self, now_ns: int):
+        # Accepted commands whose completion never came, e.g. because coop_door.py restarted meanwhile
+        for request_id, pending in list(self._pending.items()):
+            if pending.acked_at_ns is not None and now_ns - pending.acked_at_ns > COMPLETION_TIMEOUT * 1e9:
+                del self._pending[request_id]
+
+    @staticmethod
+    def _histogram(histograms: dict, name: str, command: str) -> LatencyHistogram:
+        histogram = histograms.get(command)
+        if histogram is None:
+            histogram = histograms[command] = LatencyHistogram()
+            metrics.histogram(name, histogram, command=command)
+        return histogram
+
+    def on_reply(self, message):
+        received_at_ns = time.monotonic_ns()
+        status, _, detail = message.payload.decode('utf-8', 'replace').partition(' ')
+        request_id = getattr(message.properties, 'CorrelationData', None) if message.properties is not None else None
+        with self._lock:
+            pending = self._pending.get(request_id)
+            if pending is None:
+                # Reply to an attempt answered before or to a command of a previous run
+                return
+            seconds = (received_at_ns - pending.sent_at_ns) / 1e9
+            if status in ACKS:
+                if pending.acked_at_ns is not None:
+                    return
+                pending.timer.cancel()
+                pending.acked_at_ns = received_at_ns
+                self.acks[status] += 1
+                self._histogram(self.ack_rtt, 'coop_door_command_ack_seconds', pending.command).observe(seconds)
+                metrics.inc('coop_door_command_acks_total', command=pending.command, ack=status)
+                if status != ACK_ACCEPTED or pending.command not in COMPLETING_COMMANDS:
+                    del self._pending[request_id]
+            else:
+                pending.timer.cancel()
+                del self._pending[request_id]
+                self._histogram(self.completion_rtt, 'coop_door_command_completion_seconds',
+                                pending.command).observe(seconds)
+                metrics.inc('coop_door_command_completions_total', command=pending.command, result=status)
+        logger.info('Command %s %s: %s %s after %.3fs', pending.command, request_id.decode(), status, detail, seconds)
+
+    def close(self):
+        with self._lock:
+            for pending in self._pending.values():
+                pending.timer.cancel()
+            self._pending.clear()
+
+    def format(self) -> str:
+        acks = ', '.join(f'{count} {ack}' for ack, count in self.acks.items())
+        lines = [f'Commands to {self.reply_topic}: {acks}, {self.retried} retried, {self.unanswered} unanswered']
+        for command, histogram in sorted(self.ack_rtt.items()):
+            lines.append(f'{command} ack: {histogram.format()}')
+        for command, histogram in sorted(self.completion_rtt.items()):
+            lines.append(f'{command} completion: {histogram.format()}')
+        return '\n'.join(lines)
+
+
+def create_command_sender(cfg, publish, command_topic: str, name: str, connected=None):
+    """Command sender of the script name as configured or None, when commands go out without acks."""
+    if not cfg.get_mqtt_command_acks():
+        return None
+    if cfg.get_mqtt_protocol() != '5':
+        raise ValueError('Command acks need mqtt protocol 5 for the response topic and correlation data')
+    reply_topic = command_topic + REPLY_TOPIC_SUFFIX + build_client_id(cfg, name)
+    return CommandSender(publish, reply_topic, cfg.get_mqtt_ack_timeout(), cfg.get_mqtt_ack_retries(),
+                         connected)
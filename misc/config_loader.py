@@ -1,138 +1,584 @@
 import configparser
+import logging
 import os
+import threading
+import time
+from types import MappingProxyType
+
+# Path of the config file can be given by this environment variable, otherwise config/config.ini is searched in the
+# working directory and then next to the scripts, so the services don't depend on their working directory
+CONFIG_FILE_ENV = "COOP_DOOR_CONFIG"
+DEFAULT_CONFIG_FILE = os.path.join("config", "config.ini")
+
+# Keys converted once when the config is loaded, all other values stay strings
+INT_KEYS = {
+    "open_pin", "close_pin", "speed_pin", "stop_pin", "burst_limit", "virtual_bounce_count", "publish_queue_size",
+    "publish_spool_size", "session_expiry", "qos", "file_size", "max_files", "coop_door_port",
+    "coop_door_buttons_port", "coop_door_sensors_port", "open_offset", "close_offset",
+    "confirm_samples", "confirm_required", "min_runs", "ack_retries"
+}
+FLOAT_KEYS = {
+    "bounce_time", "bounce_time_min", "bounce_time_max", "burst_window", "virtual_travel_time",
+    "virtual_bounce_interval", "reload_interval", "ramp_time", "cruise_duty", "approach_duty", "approach_fraction",
+    "learning_rate", "reconnect_delay_min", "reconnect_delay_max", "latitude", "longitude",
+    "confirm_hold_time", "margin", "sigmas", "max_travel_time", "max_state_age", "ack_timeout",
+    "interval", "stall_threshold"
+}
+BOOLEAN_KEYS = {
+    "enabled", "combined_sensors", "persistent_session", "auto_open", "auto_close", "structured_payloads",
+    "command_acks"
+}
+LIST_KEYS = {"doors"}
+# Replaced by the door names in the topic templates of the fleet, it must be a whole topic level
+FLEET_DOOR_PLACEHOLDER = "{door}"
+FLEET_TOPIC_KEYS = ("topic_command", "topic_state")
+
+logger = logging.getLogger(__name__)
+
+
+def find_config_file() -> str:
+    if os.environ.get(CONFIG_FILE_ENV):
+        return os.environ[CONFIG_FILE_ENV]
+    if os.path.exists(DEFAULT_CONFIG_FILE):
+        return os.path.abspath(DEFAULT_CONFIG_FILE)
+    return os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), DEFAULT_CONFIG_FILE)
+
+
+def convert_value(section: str, key: str, value: str):
+    try:
+        if key in INT_KEYS:
+            return int(value)
+        if key in FLOAT_KEYS:
+            return float(value)
+        if key in BOOLEAN_KEYS:
+            return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+        if key in LIST_KEYS:
+            return tuple(item.strip() for item in value.split(",") if item.strip())
+    except (KeyError, ValueError):
+        raise ValueError(f"Invalid value {value!r} for {key} in config section {section}") from None
+    return value
+
+
+def validate_fleet(section):
+    """Raises ValueError for topic templates and door names of the fleet which don't give valid topics."""
+    for key in FLEET_TOPIC_KEYS:
+        template = section.get(key)
+        if template is None:
+            continue
+        if template.split("/").count(FLEET_DOOR_PLACEHOLDER) != 1 or template.count(FLEET_DOOR_PLACEHOLDER) != 1 \
+                or "+" in template or "#" in template:
+            raise ValueError(f"Invalid {key} {template!r} in config section {section.name}, it needs "
+                             f"{FLEET_DOOR_PLACEHOLDER} once as a whole topic level without wildcards, "
+                             f"e.g. coops/{FLEET_DOOR_PLACEHOLDER}/state")
+    for door in section.get("doors", ()):
+        if any(character in door for character in "/+#"):
+            raise ValueError(f"Invalid door {door!r} in config section {section.name}, it can't contain / + or #")
+
+
+class ConfigSection:
+    """Immutable view of one config section with its values already converted."""
+
+    __slots__ = ("name", "_values")
+
+    def __init__(self, name: str, values: dict):
+        object.__setattr__(self, "name", name)
+        object.__setattr__(self, "_values", MappingProxyType(values))
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f"Config section {self.name} is immutable")
+
+    def __getitem__(self, key: str):
+        return self._values[key]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._values
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, ConfigSection) and self._values == other._values
+
+    __hash__ = None
+
+    def get(self, key: str, fallback=None):
+        return self._values.get(key, fallback)
+
+
+class ConfigSnapshot:
+    """Validated and converted state of the config file at one point in time; replaced as a whole on reload."""
+
+    __slots__ = ("sections", "mtime_ns")
+
+    def __init__(self, sections: dict, mtime_ns: int):
+        object.__setattr__(self, "sections", MappingProxyType(dict(sections)))
+        object.__setattr__(self, "mtime_ns", mtime_ns)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("Config snapshot is immutable, reload the config instead")
+
+    @classmethod
+    def load(cls, config_file: str) -> "ConfigSnapshot":
+        if not os.path.exists(config_file):
+            raise FileNotFoundError(f"Config file {config_file} not found")
 
+        mtime_ns = os.stat(config_file).st_mtime_ns
+        parser = configparser.ConfigParser(interpolation=None)
+        parser.read(config_file)
+        sections = {
+            name: ConfigSection(name, {key: convert_value(name, key, value) for key, value in parser[name].items()})
+            for name in parser.sections()
+        }
+        if "COOP_DOOR_FLEET" in sections:
+            validate_fleet(sections["COOP_DOOR_FLEET"])
+        return cls(sections, mtime_ns)
 
-class Config:
-    def __init__(self):
-        self.config = configparser.ConfigParser(interpolation=None)
-        config_file = "config/config.ini"
+    def __getitem__(self, name: str) -> ConfigSection:
+        return self.sections[name]
 
-        if not os.path.exists(config_file):
-            raise FileNotFoundError(f"Config file {config_file} not found")
+    def __contains__(self, name: str) -> bool:
+        return name in self.sections
 
-        self.config.read(config_file)
+    def get(self, section: str, key: str, fallback=None):
+        if section not in self.sections:
+            return fallback
+        return self.sections[section].get(key, fallback)
+
+    def changed_sections(self, other: "ConfigSnapshot") -> set:
+        names = set(self.sections) | set(other.sections)
+        return {name for name in names if self.sections.get(name) != other.sections.get(name)}
+
+
+class Config:
+    def __init__(self, config_file: str = None):
+        self.config_file = config_file or find_config_file()
+        self.snapshot = ConfigSnapshot.load(self.config_file)
+        self._reload_listeners = []
+        self._watcher = None
+
+    def section(self, name: str) -> ConfigSection:
+        return self.snapshot[name]
+
+    def add_reload_listener(self, listener):
+        """listener is called with the names of the changed sections after the config file was reloaded."""
+        self._reload_listeners.append(listener)
+
+    def reload(self) -> bool:
+        try:
+            snapshot = ConfigSnapshot.load(self.config_file)
+        except (OSError, ValueError, configparser.Error) as err:
+            logger.error("Keeping current config, %s could not be loaded: %s", self.config_file, err)
+            return False
+
+        # The snapshot is swapped in one assignment, so readers see either the old or the new config
+        old_snapshot, self.snapshot = self.snapshot, snapshot
+        changed_sections = old_snapshot.changed_sections(snapshot)
+        if changed_sections:
+            logger.info("Config reloaded, changed sections %s", sorted(changed_sections))
+            for listener in self._reload_listeners:
+                try:
+                    listener(changed_sections)
+                except Exception as err:
+                    logger.error("Config reload listener %s failed", listener, exc_info=err)
+        return True
+
+    def start_watching(self):
+        """Reloads the config whenever the config file changes, checked every reload_interval seconds."""
+        interval = self.get_config_reload_interval()
+        if self._watcher or interval <= 0:
+            return
+        self._watcher = threading.Thread(target=self._watch, args=(interval,), name="config-watcher", daemon=True)
+        self._watcher.start()
+
+    def _watch(self, interval: float):
+        # A file which failed to load is only tried again once it changes again
+        seen_mtime_ns = self.snapshot.mtime_ns
+        while True:
+            time.sleep(interval)
+            try:
+                mtime_ns = os.stat(self.config_file).st_mtime_ns
+            except OSError:
+                continue
+            if mtime_ns != seen_mtime_ns:
+                seen_mtime_ns = mtime_ns
+                self.reload()
 
     def get_mqtt_config(self):
         return {
-            "broker": self.config["MQTT"]["broker"],
-            "username": self.config["MQTT"]["username"],
-            "password": self.config["MQTT"]["password"],
-            "topic_command": self.config["MQTT"]["topic_command"],
-            "topic_state": self.config["MQTT"]["topic_state"]
+            "broker": self.snapshot["MQTT"]["broker"],
+            "username": self.snapshot["MQTT"]["username"],
+            "password": self.snapshot["MQTT"]["password"],
+            "topic_command": self.snapshot["MQTT"]["topic_command"],
+            "topic_state": self.snapshot["MQTT"]["topic_state"]
         }
 
     def get_mqtt_broker(self) -> str:
-        return self.config["MQTT"]["broker"]
+        return self.snapshot["MQTT"]["broker"]
 
     def get_mqtt_username(self) -> str:
-        return self.config["MQTT"]["username"]
+        return self.snapshot["MQTT"]["username"]
 
     def get_mqtt_password(self) -> str:
-        return self.config["MQTT"]["password"]
+        return self.snapshot["MQTT"]["password"]
 
     def get_mqtt_topic_command(self) -> str:
-        return self.config["MQTT"]["topic_command"]
+        return self.snapshot["MQTT"]["topic_command"]
 
     def get_mqtt_topic_state(self) -> str:
-        return self.config["MQTT"]["topic_state"]
+        return self.snapshot["MQTT"]["topic_state"]
 
     def get_mqtt_topic_realtime_state(self) -> str:
-        return self.config["MQTT"]["topic_realtime_state"]
+        return self.snapshot["MQTT"]["topic_realtime_state"]
 
     def get_coop_door_pins(self) -> dict[str, int]:
         return {
-            "open": int(self.config["COOP_DOOR"]["open_pin"]),
-            "close": int(self.config["COOP_DOOR"]["close_pin"]),
-            "speed": int(self.config["COOP_DOOR"]["speed_pin"])
+            "open": self.snapshot["COOP_DOOR"]["open_pin"],
+            "close": self.snapshot["COOP_DOOR"]["close_pin"],
+            "speed": self.snapshot["COOP_DOOR"]["speed_pin"]
         }
 
     def get_coop_door_open_pin(self) -> int:
-        return int(self.config["COOP_DOOR"]["open_pin"])
+        return self.snapshot["COOP_DOOR"]["open_pin"]
 
     def get_coop_door_close_pin(self) -> int:
-        return int(self.config["COOP_DOOR"]["close_pin"])
+        return self.snapshot["COOP_DOOR"]["close_pin"]
 
     def get_coop_door_speed_pin(self) -> int:
-        return int(self.config["COOP_DOOR"]["speed_pin"])
+        return self.snapshot["COOP_DOOR"]["speed_pin"]
 
     def get_coop_door_logging(self) -> dict:
         return {
-            "logfile": self.config["COOP_DOOR_LOGGING"]["logfile"],
-            "level": self.config["COOP_DOOR_LOGGING"]["level"]
+            "logfile": self.snapshot["COOP_DOOR_LOGGING"]["logfile"],
+            "level": self.snapshot["COOP_DOOR_LOGGING"]["level"]
         }
 
     def get_coop_door_logging_logfile(self) -> str:
-        return self.config["COOP_DOOR_LOGGING"]["logfile"]
+        return self.snapshot["COOP_DOOR_LOGGING"]["logfile"]
 
     def get_coop_door_logging_level(self) -> str:
-        return self.config["COOP_DOOR_LOGGING"]["level"]
+        return self.snapshot["COOP_DOOR_LOGGING"]["level"]
 
     def get_coop_door_logging_message_format(self) -> str:
-        return self.config["COOP_DOOR_LOGGING"]["message_format"]
+        return self.snapshot["COOP_DOOR_LOGGING"]["message_format"]
 
     def get_coop_door_logging_date_time_format(self) -> str:
-        return self.config["COOP_DOOR_LOGGING"]["date_time_format"]
+        return self.snapshot["COOP_DOOR_LOGGING"]["date_time_format"]
+
+    def get_coop_door_logging_burst_limit(self) -> int:
+        return self.snapshot.get("COOP_DOOR_LOGGING", "burst_limit", 5)
+
+    def get_coop_door_logging_burst_window(self) -> float:
+        return self.snapshot.get("COOP_DOOR_LOGGING", "burst_window", 1.0)
 
     def get_coop_door_buttons_pins(self) -> dict[str, int]:
         return {
-            "open": int(self.config["COOP_DOOR_BUTTONS"]["open_pin"]),
-            "stop": int(self.config["COOP_DOOR_BUTTONS"]["stop_pin"]),
-            "close": int(self.config["COOP_DOOR_BUTTONS"]["close_pin"])
+            "open": self.snapshot["COOP_DOOR_BUTTONS"]["open_pin"],
+            "stop": self.snapshot["COOP_DOOR_BUTTONS"]["stop_pin"],
+            "close": self.snapshot["COOP_DOOR_BUTTONS"]["close_pin"]
         }
 
     def get_coop_door_buttons_open_pin(self) -> int:
-        return int(self.config["COOP_DOOR_BUTTONS"]["open_pin"])
+        return self.snapshot["COOP_DOOR_BUTTONS"]["open_pin"]
 
     def get_coop_door_buttons_stop_pin(self) -> int:
-        return int(self.config["COOP_DOOR_BUTTONS"]["stop_pin"])
+        return self.snapshot["COOP_DOOR_BUTTONS"]["stop_pin"]
 
     def get_coop_door_buttons_close_pin(self) -> int:
-        return int(self.config["COOP_DOOR_BUTTONS"]["close_pin"])
+        return self.snapshot["COOP_DOOR_BUTTONS"]["close_pin"]
+
+    def get_coop_door_buttons_door(self) -> str:
+        return self.snapshot.get("COOP_DOOR_BUTTONS", "door", "coop door")
 
     def get_coop_door_buttons_logging(self) -> dict:
         return {
-            "logfile": self.config["COOP_DOOR_BUTTONS_LOGGING"]["logfile"],
-            "level": self.config["COOP_DOOR_BUTTONS_LOGGING"]["level"]
+            "logfile": self.snapshot["COOP_DOOR_BUTTONS_LOGGING"]["logfile"],
+            "level": self.snapshot["COOP_DOOR_BUTTONS_LOGGING"]["level"]
         }
 
     def get_coop_door_buttons_logging_logfile(self) -> str:
-        return self.config["COOP_DOOR_BUTTONS_LOGGING"]["logfile"]
+        return self.snapshot["COOP_DOOR_BUTTONS_LOGGING"]["logfile"]
 
     def get_coop_door_buttons_logging_level(self) -> str:
-        return self.config["COOP_DOOR_BUTTONS_LOGGING"]["level"]
+        return self.snapshot["COOP_DOOR_BUTTONS_LOGGING"]["level"]
 
     def get_coop_door_buttons_logging_message_format(self) -> str:
-        return self.config["COOP_DOOR_BUTTONS_LOGGING"]["message_format"]
+        return self.snapshot["COOP_DOOR_BUTTONS_LOGGING"]["message_format"]
 
     def get_coop_door_buttons_logging_date_time_format(self) -> str:
-        return self.config["COOP_DOOR_BUTTONS_LOGGING"]["date_time_format"]
+        return self.snapshot["COOP_DOOR_BUTTONS_LOGGING"]["date_time_format"]
+
+    def get_coop_door_buttons_logging_burst_limit(self) -> int:
+        return self.snapshot.get("COOP_DOOR_BUTTONS_LOGGING", "burst_limit", 5)
+
+    def get_coop_door_buttons_logging_burst_window(self) -> float:
+        return self.snapshot.get("COOP_DOOR_BUTTONS_LOGGING", "burst_window", 1.0)
 
     def get_coop_door_sensory_pins(self) -> dict[str, int]:
         return {
-            "open": int(self.config["COOP_DOOR_SENSORS"]["open_pin"]),
-            "close": int(self.config["COOP_DOOR_SENSORS"]["close_pin"])
+            "open": self.snapshot["COOP_DOOR_SENSORS"]["open_pin"],
+            "close": self.snapshot["COOP_DOOR_SENSORS"]["close_pin"]
         }
 
     def get_coop_door_sensors_open_pin(self) -> int:
-        return int(self.config["COOP_DOOR_SENSORS"]["open_pin"])
+        return self.snapshot["COOP_DOOR_SENSORS"]["open_pin"]
 
     def get_coop_door_sensors_close_pin(self) -> int:
-        return int(self.config["COOP_DOOR_SENSORS"]["close_pin"])
+        return self.snapshot["COOP_DOOR_SENSORS"]["close_pin"]
+
+    def get_coop_door_sensors_door(self) -> str:
+        return self.snapshot.get("COOP_DOOR_SENSORS", "door", "coop door")
 
     def get_coop_door_sensors_logging(self) -> dict:
         return {
-            "logfile": self.config["COOP_DOOR_SENSORS_LOGGING"]["logfile"],
-            "level": self.config["COOP_DOOR_SENSORS_LOGGING"]["level"]
+            "logfile": self.snapshot["COOP_DOOR_SENSORS_LOGGING"]["logfile"],
+            "level": self.snapshot["COOP_DOOR_SENSORS_LOGGING"]["level"]
         }
 
     def get_coop_door_sensors_logging_logfile(self) -> str:
-        return self.config["COOP_DOOR_SENSORS_LOGGING"]["logfile"]
+        return self.snapshot["COOP_DOOR_SENSORS_LOGGING"]["logfile"]
 
     def get_coop_door_sensors_logging_level(self) -> str:
-        return self.config["COOP_DOOR_SENSORS_LOGGING"]["level"]
+        return self.snapshot["COOP_DOOR_SENSORS_LOGGING"]["level"]
 
     def get_coop_door_sensors_logging_message_format(self) -> str:
-        return self.config["COOP_DOOR_SENSORS_LOGGING"]["message_format"]
+        return self.snapshot["COOP_DOOR_SENSORS_LOGGING"]["message_format"]
 
     def get_coop_door_sensors_logging_date_time_format(self) -> str:
-        return self.config["COOP_DOOR_SENSORS_LOGGING"]["date_time_format"]
+        return self.snapshot["COOP_DOOR_SENSORS_LOGGING"]["date_time_format"]
+
+    def get_coop_door_sensors_logging_burst_limit(self) -> int:
+        return self.snapshot.get("COOP_DOOR_SENSORS_LOGGING", "burst_limit", 5)
+
+    def get_coop_door_sensors_logging_burst_window(self) -> float:
+        return self.snapshot.get("COOP_DOOR_SENSORS_LOGGING", "burst_window", 1.0)
+
+    def has_coop_door_fleet(self) -> bool:
+        return "COOP_DOOR_FLEET" in self.snapshot
+
+    def get_coop_door_fleet_doors(self) -> list[str]:
+        return list(self.snapshot["COOP_DOOR_FLEET"]["doors"])
+
+    def get_coop_door_fleet_topic_command(self) -> str:
+        return self.snapshot["COOP_DOOR_FLEET"]["topic_command"]
+
+    def get_coop_door_fleet_topic_state(self) -> str:
+        return self.snapshot["COOP_DOOR_FLEET"]["topic_state"]
+
+    def get_coop_door_fleet_pins(self, door: str) -> dict[str, int]:
+        section = self.snapshot[f"COOP_DOOR_FLEET.{door}"]
+        return {
+            "open": section["open_pin"],
+            "close": section["close_pin"],
+            "speed": section["speed_pin"]
+        }
+
+    def get_hardware_backend(self) -> str:
+        return self.snapshot.get("HARDWARE", "backend", "gpio")
+
+    def get_hardware_inputs(self) -> str:
+        return self.snapshot.get("HARDWARE", "inputs", "gpiozero")
+
+    def get_hardware_gpio_chip(self) -> str:
+        return self.snapshot.get("HARDWARE", "gpio_chip", "/dev/gpiochip0")
+
+    def get_hardware_pwm(self) -> str:
+        return self.snapshot.get("HARDWARE", "pwm", "software")
+
+    def get_hardware_pwm_chip(self) -> str:
+        return self.snapshot.get("HARDWARE", "pwm_chip", "/sys/class/pwm/pwmchip0")
+
+    def get_hardware_virtual_travel_time(self) -> float:
+        return self.snapshot.get("HARDWARE", "virtual_travel_time", 6.0)
+
+    def get_hardware_virtual_bounce_count(self) -> int:
+        return self.snapshot.get("HARDWARE", "virtual_bounce_count", 3)
+
+    def get_hardware_virtual_bounce_interval(self) -> float:
+        return self.snapshot.get("HARDWARE", "virtual_bounce_interval", 0.002)
+
+    def get_mqtt_backend(self) -> str:
+        return self.snapshot.get("MQTT", "backend", "paho")
+
+    def get_mqtt_structured_payloads(self) -> bool:
+        return self.snapshot.get("MQTT", "structured_payloads", False)
+
+    def get_mqtt_max_state_age(self) -> float:
+        return self.snapshot.get("MQTT", "max_state_age", 10.0)
+
+    def get_mqtt_command_acks(self) -> bool:
+        return self.snapshot.get("MQTT", "command_acks", False)
+
+    def get_mqtt_ack_timeout(self) -> float:
+        return self.snapshot.get("MQTT", "ack_timeout", 2.0)
+
+    def get_mqtt_ack_retries(self) -> int:
+        return self.snapshot.get("MQTT", "ack_retries", 2)
+
+    def get_mqtt_protocol(self) -> str:
+        return self.snapshot.get("MQTT", "protocol", "3.1.1")
+
+    def get_mqtt_client_id_prefix(self) -> str:
+        return self.snapshot.get("MQTT", "client_id_prefix", None)
+
+    def get_mqtt_persistent_session(self) -> bool:
+        return self.snapshot.get("MQTT", "persistent_session", True)
+
+    def get_mqtt_session_expiry(self) -> int:
+        return self.snapshot.get("MQTT", "session_expiry", 3600)
+
+    def get_mqtt_qos(self) -> int:
+        return self.snapshot.get("MQTT", "qos", 1)
+
+    def get_mqtt_reconnect_delay_min(self) -> float:
+        return self.snapshot.get("MQTT", "reconnect_delay_min", 0.25)
+
+    def get_mqtt_reconnect_delay_max(self) -> float:
+        return self.snapshot.get("MQTT", "reconnect_delay_max", 30.0)
+
+    def get_mqtt_publish_queue_size(self) -> int:
+        return self.snapshot.get("MQTT", "publish_queue_size", 100)
+
+    def get_mqtt_publish_spool_file(self) -> str:
+        return self.snapshot.get("MQTT", "publish_spool_file", None)
+
+    def get_mqtt_publish_spool_size(self) -> int:
+        return self.snapshot.get("MQTT", "publish_spool_size", 1000)
+
+    def get_tracing_enabled(self) -> bool:
+        return self.snapshot.get("TRACING", "enabled", False)
+
+    def get_config_reload_interval(self) -> float:
+        return self.snapshot.get("CONFIG", "reload_interval", 2.0)
+
+    def get_coop_door_buttons_bounce_time(self) -> float:
+        return self.snapshot.get("COOP_DOOR_BUTTONS", "bounce_time", 0.1)
+
+    def get_coop_door_buttons_confirm_hold_time(self) -> float:
+        return self.snapshot.get("COOP_DOOR_BUTTONS", "confirm_hold_time", 0.03)
+
+    def get_coop_door_buttons_confirm_samples(self) -> int:
+        return self.snapshot.get("COOP_DOOR_BUTTONS", "confirm_samples", 5)
+
+    def get_coop_door_buttons_confirm_required(self) -> int:
+        return self.snapshot.get("COOP_DOOR_BUTTONS", "confirm_required", 4)
+
+    def get_coop_door_sensors_bounce_time(self) -> float:
+        return self.snapshot.get("COOP_DOOR_SENSORS", "bounce_time", 0.01)
+
+    def get_coop_door_sensors_debounce(self) -> str:
+        return self.snapshot.get("COOP_DOOR_SENSORS", "debounce", "adaptive")
+
+    def get_coop_door_sensors_bounce_time_min(self) -> float:
+        return self.snapshot.get("COOP_DOOR_SENSORS", "bounce_time_min", 0.001)
+
+    def get_coop_door_sensors_bounce_time_max(self) -> float:
+        return self.snapshot.get("COOP_DOOR_SENSORS", "bounce_time_max", 0.1)
+
+    def get_coop_door_combined_sensors(self) -> bool:
+        return self.snapshot.get("COOP_DOOR", "combined_sensors", False)
+
+    def get_coop_door_control_socket(self) -> str:
+        return self.snapshot.get("COOP_DOOR", "control_socket", None)
+
+    def get_coop_door_motion_enabled(self) -> bool:
+        return self.snapshot.get("COOP_DOOR_MOTION", "enabled", False)
+
+    def get_coop_door_motion_ramp_time(self) -> float:
+        return self.snapshot.get("COOP_DOOR_MOTION", "ramp_time", 0.5)
+
+    def get_coop_door_motion_cruise_duty(self) -> float:
+        return self.snapshot.get("COOP_DOOR_MOTION", "cruise_duty", 100.0)
+
+    def get_coop_door_motion_approach_duty(self) -> float:
+        return self.snapshot.get("COOP_DOOR_MOTION", "approach_duty", 40.0)
+
+    def get_coop_door_motion_approach_fraction(self) -> float:
+        return self.snapshot.get("COOP_DOOR_MOTION", "approach_fraction", 0.85)
+
+    def get_coop_door_motion_learning_rate(self) -> float:
+        return self.snapshot.get("COOP_DOOR_MOTION", "learning_rate", 0.3)
+
+    def get_coop_door_motion_travel_model_file(self) -> str:
+        return self.snapshot.get("COOP_DOOR_MOTION", "travel_model_file", None)
+
+    def get_coop_door_motion_runs_file(self) -> str:
+        return self.snapshot.get("COOP_DOOR_MOTION", "runs_file", None)
+
+    def get_coop_door_watchdog_enabled(self) -> bool:
+        return self.snapshot.get("COOP_DOOR_WATCHDOG", "enabled", True)
+
+    def get_coop_door_watchdog_margin(self) -> float:
+        return self.snapshot.get("COOP_DOOR_WATCHDOG", "margin", 0.25)
+
+    def get_coop_door_watchdog_sigmas(self) -> float:
+        return self.snapshot.get("COOP_DOOR_WATCHDOG", "sigmas", 4.0)
+
+    def get_coop_door_watchdog_min_runs(self) -> int:
+        return self.snapshot.get("COOP_DOOR_WATCHDOG", "min_runs", 3)
+
+    def get_coop_door_watchdog_max_travel_time(self) -> float:
+        return self.snapshot.get("COOP_DOOR_WATCHDOG", "max_travel_time", 120.0)
+
+    def get_coop_door_watchdog_statistics_file(self) -> str:
+        return self.snapshot.get("COOP_DOOR_WATCHDOG", "statistics_file", None)
+
+    def get_journal_enabled(self) -> bool:
+        return self.snapshot.get("JOURNAL", "enabled", False)
+
+    def get_journal_directory(self) -> str:
+        return self.snapshot.get("JOURNAL", "directory", "/var/log/coop/journal")
+
+    def get_journal_file_size(self) -> int:
+        return self.snapshot.get("JOURNAL", "file_size", 1048576)
+
+    def get_journal_max_files(self) -> int:
+        return self.snapshot.get("JOURNAL", "max_files", 64)
+
+    def get_heartbeat_enabled(self) -> bool:
+        return self.snapshot.get("HEARTBEAT", "enabled", False)
+
+    def get_heartbeat_interval(self) -> float:
+        return self.snapshot.get("HEARTBEAT", "interval", 5.0)
+
+    def get_heartbeat_stall_threshold(self) -> float:
+        return self.snapshot.get("HEARTBEAT", "stall_threshold", 10.0)
+
+    def get_heartbeat_topic(self) -> str:
+        return self.snapshot.get("HEARTBEAT", "topic", "coop/heartbeat")
+
+    def get_metrics_enabled(self) -> bool:
+        return self.snapshot.get("METRICS", "enabled", False)
+
+    def get_metrics_bind_address(self) -> str:
+        return self.snapshot.get("METRICS", "bind_address", "127.0.0.1")
+
+    def get_metrics_port(self, script_name: str) -> int:
+        default_ports = {"coop_door": 9101, "coop_door_buttons": 9102, "coop_door_sensors": 9103}
+        return self.snapshot.get("METRICS", f"{script_name}_port", default_ports[script_name])
+
+    def get_schedule_latitude(self) -> float:
+        return self.snapshot.get("SCHEDULE", "latitude", None)
+
+    def get_schedule_longitude(self) -> float:
+        return self.snapshot.get("SCHEDULE", "longitude", None)
+
+    def get_schedule_open_offset(self) -> int:
+        return self.snapshot.get("SCHEDULE", "open_offset", 0)
+
+    def get_schedule_close_offset(self) -> int:
+        return self.snapshot.get("SCHEDULE", "close_offset", 0)
+
+    def get_schedule_open_not_before(self) -> str:
+        return self.snapshot.get("SCHEDULE", "open_not_before", None)
+
+    def get_schedule_open_from(self) -> str:
+        return self.snapshot.get("SCHEDULE", "open_from", "07:30")
+
+    def get_schedule_open_until(self) -> str:
+        return self.snapshot.get("SCHEDULE", "open_until", "22:00")
+
+    def get_schedule_cache_file(self) -> str:
+        return self.snapshot.get("SCHEDULE", "cache_file", None)
+
+    def get_schedule_auto_open(self) -> bool:
+        return self.snapshot.get("SCHEDULE", "auto_open", False)
+
+    def get_schedule_auto_close(self) -> bool:
+        return self.snapshot.get("SCHEDULE", "auto_close", False)
@@ -0,0 +1,198 @@
+import logging
+import threading
+import time
+
+from misc.door_state_machine import DoorAction, DoorPhase, TRANSITIONS
+from misc.journal import EVENT_MOTOR_OFF, EVENT_MOTOR_ON, MOTOR_CLOSING, MOTOR_OFF_TRAVEL_TIMEOUT, MOTOR_OPENING
+from misc.metrics import metrics
+from misc.motion_profile import DIRECTION_CLOSING, DIRECTION_OPENING
+from misc.pwm import OnDemandPWM
+
+DUTY_CYCLE_MIN = 0
+# 100% performance, so the full power goes to the motor. At 12 V with 75% it would only be 9 V given to the motor, e.g.;
+# to be tried out, if 75% would also be enough!
+DUTY_CYCLE_MAX = 100
+
+logger = logging.getLogger(__name__)
+
+
+class CoopDoorMotor:
+    """Motor pins and PWM of a single coop door, so one process is able to drive several doors.
+
+    gpio is RPi.GPIO or its virtual stand-in from misc.hardware. create_pwm returns the PWM of the speed pin, by default
+    an OnDemandPWM of gpio, which only runs while the motor is driven. With a MotionControl from misc.motion_profile
+    the duty cycle follows its profile instead of switching straight to DUTY_CYCLE_MAX. Moves and stops are recorded
+    in the given misc.journal Journal. With a TravelWatchdog from misc.travel_watchdog every run is stopped once it
+    takes longer than the travel learned for its direction allows, and the door is in the FAULT phase then.
+
+    Commands and sensor states go through handle, which looks up the transition in the table of
+    misc.door_state_machine and only drives the motor if the transition has an action. Pin levels and the duty cycle
+    are cached, so only pins which actually change are written."""
+
+    def __init__(self, gpio, door_id: str, open_pin: int, close_pin: int, speed_pin: int, motion=None,
+                 journal=None, create_pwm=None, watchdog=None):
+        self.gpio = gpio
+        self.create_pwm = create_pwm
+        self.door_id = door_id
+        self.open_pin = open_pin
+        self.close_pin = close_pin
+        self.speed_pin = speed_pin
+        self.pwm_speed = None
+        # Monotonic timestamps of the last move and reset and the trace of the command which caused the move
+        self.moved_at_ns = None
+        self.reset_at_ns = None
+        self.trace_id = None
+        # Pin driving the motor at the moment, None while the motor stands still
+        self.moving_pin = None
+        self.motion = motion
+        self.motion_run = None
+        self.journal = journal
+        self.watchdog = watchdog
+        self.watchdog_timer = None
+        # Called with the door, the direction and the MOTOR_OFF_* reason of misc.journal, whenever a run ends
+        self.on_run_end = None
+        self.phase = DoorPhase.STOPPED
+        # Last written level per pin and duty cycle, None if unknown, e.g. while a motion profile drives the PWM
+        self.levels = {}
+        self.duty_cycle = None
+        # Commands arrive on the Mqtt network thread, end stops of combined sensors on the debouncer or GPIO thread
+        self._lock = threading.RLock()
+
+    def init_pins(self):
+        self.gpio.setup([self.open_pin, self.close_pin], self.gpio.OUT, initial=self.gpio.LOW)
+
+        # Starts with switched off motor (= 0%), the PWM only runs once the motor is driven
+        if self.create_pwm:
+            self.pwm_speed = self.create_pwm(self.speed_pin)
+        else:
+            self.pwm_speed = OnDemandPWM(self.gpio, self.speed_pin)
+        self.levels = {self.open_pin: self.gpio.LOW, self.close_pin: self.gpio.LOW}
+        self.duty_cycle = DUTY_CYCLE_MIN
+
+    def output(self, pin, level, force: bool = False):
+        if force or self.levels.get(pin) != level:
+            self.gpio.output(pin, level)
+            self.levels[pin] = level
+
+    def change_duty_cycle(self, duty_cycle, force: bool = False):
+        if force or self.duty_cycle != duty_cycle:
+            self.pwm_speed.ChangeDutyCycle(duty_cycle)
+            self.duty_cycle = duty_cycle
+
+    def handle(self, event, trace_id=None) -> DoorAction:
+        """Applies a CoopDoorCommand or CoopDoorState and returns the action it caused."""
+        with self._lock:
+            phase, action = TRANSITIONS[(self.phase, event)]
+            logger.debug('%s: %s on %s -> %s, %s', self.door_id, event, self.phase, phase, action)
+            if action == DoorAction.OPEN:
+                self.open_door(trace_id)
+            elif action == DoorAction.CLOSE:
+                self.close_door(trace_id)
+            elif action == DoorAction.STOP:
+                self.stop_door_move()
+            elif action == DoorAction.END_STOP:
+                self.reset_pins(end_stop_reached=True)
+            self.phase = phase
+            return action
+
+    def resync_pins(self):
+        """Writes all pins of a standing door again, whatever the cache says."""
+        with self._lock:
+            if self.moving_pin is None and self.pwm_speed is not None:
+                self.reset_pins(force=True)
+
+    def reset_pins(self, end_stop_reached: bool = False, force: bool = False, timed_out: bool = False):
+        logger.info('Resetting pins of %s to original state', self.door_id)
+        if self.watchdog_timer:
+            self.watchdog_timer.cancel()
+            self.watchdog_timer = None
+        motion_run = self.motion_run
+        if motion_run:
+            # Keeps the profile from changing the duty cycle after the motor was stopped
+            motion_run.stop()
+        self.output(self.open_pin, self.gpio.LOW, force)
+        self.output(self.close_pin, self.gpio.LOW, force)
+        self.change_duty_cycle(DUTY_CYCLE_MIN, force)  # stop motor
+        self.reset_at_ns = time.monotonic_ns()
+        run_ended = self.moving_pin is not None
+        if run_ended:
+            direction = DIRECTION_OPENING if self.moving_pin == self.open_pin else DIRECTION_CLOSING
+            motor_off = MOTOR_OFF_TRAVEL_TIMEOUT if timed_out else int(end_stop_reached)
+            on_seconds = (self.reset_at_ns - self.moved_at_ns) / 1e9
+            metrics.inc('coop_door_motor_on_seconds_total', on_seconds, door=self.door_id)
+            if end_stop_reached:
+                metrics.observe('coop_door_travel_seconds', on_seconds, door=self.door_id, direction=direction)
+                if self.watchdog:
+                    self.watchdog.learn(self.door_id, direction, on_seconds)
+            if self.journal:
+                self.journal.record(EVENT_MOTOR_OFF, motor_off, self.door_id, self.reset_at_ns)
+        self.moved_at_ns = None
+        self.moving_pin = None
+        logger.info('Reset pins of %s to original state', self.door_id)
+        if motion_run:
+            self.motion_run = None
+            motion_run.finish(end_stop_reached)
+        if run_ended and self.on_run_end:
+            self.on_run_end(self, direction, motor_off)
+
+    def move_door(self, pin, position, trace_id=None):
+        self.reset_pins()
+        if self.motion is None:
+            self.change_duty_cycle(DUTY_CYCLE_MAX)
+        logger.info('Setting pin %s to HIGH for %s %s', pin, position, self.door_id)
+        self.output(pin, self.gpio.HIGH)
+        if self.motion:
+            self.motion_run = self.motion.start(self.pwm_speed, self.door_id, position)
+            self.duty_cycle = None
+        self.moved_at_ns = time.monotonic_ns()
+        if self.journal:
+            motor_direction = MOTOR_OPENING if pin == self.open_pin else MOTOR_CLOSING
+            self.journal.record(EVENT_MOTOR_ON, motor_direction, self.door_id, self.moved_at_ns)
+        self.trace_id = trace_id
+        self.moving_pin = pin
+        self.arm_watchdog(position)
+        logger.info('Set pin %s to HIGH', pin)
+
+    def arm_watchdog(self, direction: str):
+        watchdog = self.watchdog
+        if watchdog is None:
+            return
+        limit = watchdog.limit(self.door_id, direction)
+        self.watchdog_timer = threading.Timer(limit, self.travel_timeout,
+                                              args=(watchdog, self.moved_at_ns, direction, limit))
+        self.watchdog_timer.name = f'travel-watchdog-{self.door_id}'
+        self.watchdog_timer.daemon = True
+        self.watchdog_timer.start()
+
+    def travel_timeout(self, watchdog, moved_at_ns: int, direction: str, limit: float):
+        """Called by the watchdog timer of the run started at moved_at_ns, when it didn't reach its end stop in time."""
+        with self._lock:
+            # The run may have ended while the timer fired
+            if self.moved_at_ns != moved_at_ns:
+                return
+            logger.error('%s didn\'t reach its end stop %s within %.2fs, stopping the motor', self.door_id,
+                         direction, limit)
+            self.reset_pins(timed_out=True)
+            self.phase = DoorPhase.FAULT
+        metrics.inc('coop_door_travel_timeouts_total', door=self.door_id, direction=direction)
+        watchdog.fault(self)
+
+    def open_door(self, trace_id=None):
+        self.move_door(self.open_pin, DIRECTION_OPENING, trace_id)
+
+    def close_door(self, trace_id=None):
+        self.move_door(self.close_pin, DIRECTION_CLOSING, trace_id)
+
+    def stop_door_move(self):
+        logger.info('Stopping %s move', self.door_id)
+        self.reset_pins()
+        logger.info('Stopped %s move', self.door_id)
+
+    def release_pins(self):
+        """Stops the motor and frees the pins, e.g. when they were changed in the config."""
+        self.reset_pins()
+        self.pwm_speed.close()
+        self.pwm_speed = None
+        self.levels = {}
+        self.duty_cycle = None
+        self.gpio.cleanup([self.open_pin, self.close_pin])
@@ -5,3 +5,4 @@ class CoopDoorState(Enum):
     CLOSED = auto()
     STOPPED = auto()
     RUNNING = auto()
+    FAULT = auto()  # stopped by the travel watchdog of the coop door
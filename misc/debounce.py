@@ -0,0 +1,135 @@
+import threading
+import time
+from collections import deque
+
+# Settle time = learned largest gap between bounces times this margin
+SETTLE_MARGIN = 2.0
+# Per committed state the learned gap shrinks by this factor, unless the burst had a larger gap
+GAP_DECAY = 0.95
+EDGE_BUFFER_SIZE = 256
+
+
+class DebounceChannel:
+    """Debounce state of one input. Edges are appended to a ring buffer by the GPIO callback thread and consumed
+    by the debouncer thread, which commits a level once no edge was seen for the learned settle time."""
+
+    def __init__(self, name: str, level: bool, on_commit, settle_time: float, min_settle_time: float,
+                 max_settle_time: float):
+        self.name = name
+        self.on_commit = on_commit
+        self.edges = deque(maxlen=EDGE_BUFFER_SIZE)
+        self.min_settle_ns = int(min_settle_time * 1e9)
+        self.max_settle_ns = int(max_settle_time * 1e9)
+        self.max_gap_ns = int(settle_time * 1e9 / SETTLE_MARGIN)
+        self.committed_level = level
+        self.committed_at_ns = None
+        self.level = level
+        self.last_edge_ns = None
+        self.burst_start_ns = None
+        self.burst_max_gap_ns = 0
+        self.deadline_ns = None
+        self.edges_seen = 0
+        self.states_committed = 0
+        self.corrections = 0
+
+    @property
+    def settle_ns(self) -> int:
+        return min(self.max_settle_ns, max(self.min_settle_ns, int(self.max_gap_ns * SETTLE_MARGIN)))
+
+    def process(self, timestamp_ns: int, level: bool):
+        self.edges_seen += 1
+        if self.burst_start_ns is None:
+            self.burst_start_ns = timestamp_ns
+            # An edge undoing a commit within one settle time means the settle time was shorter than a bounce
+            if (self.committed_at_ns is not None and level != self.committed_level
+                    and timestamp_ns - self.committed_at_ns < self.settle_ns):
+                self.corrections += 1
+                self.max_gap_ns = max(self.max_gap_ns, timestamp_ns - self.last_edge_ns)
+        elif self.last_edge_ns is not None:
+            self.burst_max_gap_ns = max(self.burst_max_gap_ns, timestamp_ns - self.last_edge_ns)
+        self.last_edge_ns = timestamp_ns
+        self.level = level
+        self.deadline_ns = timestamp_ns + self.settle_ns
+
+    def settle(self, now_ns: int):
+        """Commits the level, when the deadline passed; returns the commit to call back or None."""
+        if self.deadline_ns is None or now_ns < self.deadline_ns:
+            return None
+
+        burst_start_ns = self.burst_start_ns
+        self.max_gap_ns = max(self.burst_max_gap_ns, int(self.max_gap_ns * GAP_DECAY))
+        self.deadline_ns = None
+        self.burst_start_ns = None
+        self.burst_max_gap_ns = 0
+        if self.level == self.committed_level:
+            return None
+        self.committed_level = self.level
+        self.committed_at_ns = now_ns
+        self.states_committed += 1
+        return self.on_commit, self.level, burst_start_ns
+
+    def stats(self) -> dict:
+        return {
+            'edges_seen': self.edges_seen,
+            'states_committed': self.states_committed,
+            'corrections': self.corrections,
+            'settle_time': round(self.settle_ns / 1e9, 4)
+        }
+
+
+class Debouncer(threading.Thread):
+    """Software debouncing of several inputs on one thread, learning the bounce envelope of every input online.
+
+    on_commit(level, first_edge_ns) of a channel is called on this thread with the stable level and the time of the
+    first edge of the burst, which is the earliest moment the change was detected."""
+
+    def __init__(self):
+        super().__init__(name='debouncer', daemon=True)
+        self.channels = []
+        self._condition = threading.Condition()
+
+    def add_channel(self, name: str, level: bool, on_commit, settle_time: float, min_settle_time: float,
+                    max_settle_time: float) -> DebounceChannel:
+        channel = DebounceChannel(name, level, on_commit, settle_time, min_settle_time, max_settle_time)
+        with self._condition:
+            self.channels.append(channel)
+        return channel
+
+    def remove_channel(self, channel: DebounceChannel):
+        with self._condition:
+            self.channels.remove(channel)
+
+    def edge(self, channel: DebounceChannel, level: bool, timestamp_ns: int = None):
+        """Called from the GPIO callback thread, only timestamps and enqueues the edge. timestamp_ns is the
+        time.monotonic_ns() of the edge, if known more exactly than the time of the callback."""
+        channel.edges.append((timestamp_ns or time.monotonic_ns(), level))
+        with self._condition:
+            self._condition.notify()
+
+    def run(self):
+        while True:
+            commits = []
+            with self._condition:
+                now_ns = time.monotonic_ns()
+                deadline_ns = None
+                for channel in self.channels:
+                    while channel.edges:
+                        channel.process(*channel.edges.popleft())
+                    commit = channel.settle(now_ns)
+                    if commit:
+                        commits.append(commit)
+                    if channel.deadline_ns is not None and (deadline_ns is None or channel.deadline_ns < deadline_ns):
+                        deadline_ns = channel.deadline_ns
+                if not commits:
+                    self._condition.wait(None if deadline_ns is None else max(0, deadline_ns - now_ns) / 1e9)
+            for on_commit, level, first_edge_ns in commits:
+                on_commit(level, first_edge_ns)
+
+    def stats(self) -> dict:
+        return {channel.name: channel.stats() for channel in self.channels}
+
+    def format_stats(self) -> str:
+        return '\n'.join(
+            f'{name}: ' + ', '.join(f'{key} {value}' for key, value in stats.items())
+            for name, stats in self.stats().items()
+        )
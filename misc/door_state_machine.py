@@ -0,0 +1,101 @@
+from enum import Enum, auto
+
+from misc.coop_door_command import CoopDoorCommand
+from misc.coop_door_state import CoopDoorState
+
+
+class DoorPhase(Enum):
+    """What the door does according to the commands and states it got."""
+    OPEN = auto()  # standing at the open end stop
+    CLOSED = auto()  # standing at the closed end stop
+    STOPPED = auto()  # standing in between or at an unknown position
+    OPENING = auto()
+    CLOSING = auto()
+    FAULT = auto()  # stopped by the travel watchdog, e.g. the door is jammed or the end stop sensor dead
+
+
+class DoorAction(Enum):
+    """What the motor has to do for a transition."""
+    NONE = auto()
+    OPEN = auto()
+    CLOSE = auto()
+    STOP = auto()
+    END_STOP = auto()  # stop, because the end stop the door is moving to was reached
+
+
+# End stop each moving phase is heading for
+TARGET_END_STOPS = {DoorPhase.OPENING: CoopDoorState.OPEN, DoorPhase.CLOSING: CoopDoorState.CLOSED}
+
+# Phase of a standing door per state reported by the sensors
+STANDING_PHASES = {
+    CoopDoorState.OPEN: DoorPhase.OPEN,
+    CoopDoorState.CLOSED: DoorPhase.CLOSED,
+    CoopDoorState.STOPPED: DoorPhase.STOPPED,
+    CoopDoorState.RUNNING: DoorPhase.STOPPED,
+    CoopDoorState.FAULT: DoorPhase.FAULT
+}
+
+# Per phase the next phase and action of each command. A command which doesn't change anything, like OPEN while
+# opening or STOP while standing, has no action, so the motor doesn't stutter on repeated commands.
+COMMAND_TRANSITIONS = {
+    DoorPhase.OPEN: {
+        CoopDoorCommand.OPEN: (DoorPhase.OPEN, DoorAction.NONE),
+        CoopDoorCommand.CLOSE: (DoorPhase.CLOSING, DoorAction.CLOSE),
+        CoopDoorCommand.STOP: (DoorPhase.OPEN, DoorAction.NONE)
+    },
+    DoorPhase.CLOSED: {
+        CoopDoorCommand.OPEN: (DoorPhase.OPENING, DoorAction.OPEN),
+        CoopDoorCommand.CLOSE: (DoorPhase.CLOSED, DoorAction.NONE),
+        CoopDoorCommand.STOP: (DoorPhase.CLOSED, DoorAction.NONE)
+    },
+    DoorPhase.STOPPED: {
+        CoopDoorCommand.OPEN: (DoorPhase.OPENING, DoorAction.OPEN),
+        CoopDoorCommand.CLOSE: (DoorPhase.CLOSING, DoorAction.CLOSE),
+        CoopDoorCommand.STOP: (DoorPhase.STOPPED, DoorAction.NONE)
+    },
+    DoorPhase.OPENING: {
+        CoopDoorCommand.OPEN: (DoorPhase.OPENING, DoorAction.NONE),
+        CoopDoorCommand.CLOSE: (DoorPhase.CLOSING, DoorAction.CLOSE),
+        CoopDoorCommand.STOP: (DoorPhase.STOPPED, DoorAction.STOP)
+    },
+    DoorPhase.CLOSING: {
+        CoopDoorCommand.OPEN: (DoorPhase.OPENING, DoorAction.OPEN),
+        CoopDoorCommand.CLOSE: (DoorPhase.CLOSING, DoorAction.NONE),
+        CoopDoorCommand.STOP: (DoorPhase.STOPPED, DoorAction.STOP)
+    },
+    # Another try is up to whoever sends the command, the watchdog bounds it like any other run
+    DoorPhase.FAULT: {
+        CoopDoorCommand.OPEN: (DoorPhase.OPENING, DoorAction.OPEN),
+        CoopDoorCommand.CLOSE: (DoorPhase.CLOSING, DoorAction.CLOSE),
+        CoopDoorCommand.STOP: (DoorPhase.FAULT, DoorAction.NONE)
+    }
+}
+
+
+def state_transition(phase: DoorPhase, state: CoopDoorState):
+    # A moving door only stops at the end stop it's heading for, e.g. RUNNING or a bounce of the end stop it's
+    # leaving don't touch the motor. A standing door, e.g. on the retained state after a connect, only learns
+    # where it is. FAULT stops a moving door, a door in FAULT only leaves it once a sensor reports an end stop.
+    if phase in TARGET_END_STOPS:
+        if state == TARGET_END_STOPS[phase]:
+            return STANDING_PHASES[state], DoorAction.END_STOP
+        if state == CoopDoorState.FAULT:
+            return DoorPhase.FAULT, DoorAction.STOP
+        return phase, DoorAction.NONE
+    if phase == DoorPhase.FAULT and state not in (CoopDoorState.OPEN, CoopDoorState.CLOSED):
+        return phase, DoorAction.NONE
+    return STANDING_PHASES[state], DoorAction.NONE
+
+
+def build_transitions() -> dict:
+    transitions = {}
+    for phase in DoorPhase:
+        for command, transition in COMMAND_TRANSITIONS[phase].items():
+            transitions[(phase, command)] = transition
+        for state in CoopDoorState:
+            transitions[(phase, state)] = state_transition(phase, state)
+    return transitions
+
+
+# (phase, command or state) -> (next phase, action), so dispatching a message is a single lookup
+TRANSITIONS = build_transitions()
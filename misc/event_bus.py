@@ -0,0 +1,24 @@
+import logging
+
+# A reed sensor detected the door at an end stop: handler(state name, detection time as time.monotonic_ns())
+EVENT_END_STOP = 'end_stop'
+
+logger = logging.getLogger(__name__)
+
+
+class EventBus:
+    """In-process publish/subscribe. Handlers run on the publishing thread, so there is no queue or thread
+    switch between e.g. a sensor edge and the motor control reacting to it."""
+
+    def __init__(self):
+        self._handlers = {}
+
+    def subscribe(self, event: str, handler):
+        self._handlers.setdefault(event, []).append(handler)
+
+    def publish(self, event: str, *args):
+        for handler in self._handlers.get(event, ()):
+            try:
+                handler(*args)
+            except Exception as err:
+                logger.error('Handler %s for event %s failed', handler, event, exc_info=err)
@@ -0,0 +1,80 @@
+import atexit
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def replace_file(path: str, data: str):
+    """Writes data aside and renames it to path, so a crash never leaves a half written file."""
+    path_tmp = path + '.tmp'
+    with open(path_tmp, 'w') as file:
+        file.write(data)
+    os.replace(path_tmp, path)
+
+
+class FileWriter(threading.Thread):
+    """Writes files on its own thread, so e.g. a stopping motor never waits for the SD card. A file replaced again
+    before it was written is only written once with the latest data, appended lines keep their order."""
+
+    def __init__(self):
+        super().__init__(name='file-writer', daemon=True)
+        self._replaced = {}
+        self._appended = {}
+        self._stopped = False
+        self._condition = threading.Condition()
+
+    def replace(self, path: str, data: str):
+        with self._condition:
+            self._replaced[path] = data
+            self._condition.notify()
+
+    def append(self, path: str, data: str):
+        with self._condition:
+            self._appended.setdefault(path, []).append(data)
+            self._condition.notify()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not (self._replaced or self._appended or self._stopped):
+                    self._condition.wait()
+                replaced, self._replaced = self._replaced, {}
+                appended, self._appended = self._appended, {}
+                stopped = self._stopped
+            for path, data in replaced.items():
+                try:
+                    replace_file(path, data)
+                except OSError as err:
+                    logger.warning('Could not write %s: %s', path, err)
+            for path, lines in appended.items():
+                try:
+                    with open(path, 'a') as file:
+                        file.writelines(lines)
+                except OSError as err:
+                    logger.warning('Could not append to %s: %s', path, err)
+            if stopped:
+                return
+
+    def stop(self):
+        """Writes what is still pending and ends the thread."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self.join()
+
+
+_file_writer = None
+_file_writer_lock = threading.Lock()
+
+
+def file_writer() -> FileWriter:
+    """The writer of this process, started on first use and flushed at exit."""
+    global _file_writer
+    with _file_writer_lock:
+        if _file_writer is None:
+            _file_writer = FileWriter()
+            _file_writer.start()
+            atexit.register(_file_writer.stop)
+        return _file_writer
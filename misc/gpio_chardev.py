@@ -0,0 +1,207 @@
+import fcntl
+import logging
+import os
+import select
+import struct
+import threading
+import time
+from collections import deque
+
+from misc.tracing import LatencyHistogram
+
+# Linux GPIO character device uAPI v2, see include/uapi/linux/gpio.h
+GPIO_V2_LINE_FLAG_ACTIVE_LOW = 1 << 1
+GPIO_V2_LINE_FLAG_INPUT = 1 << 2
+GPIO_V2_LINE_FLAG_EDGE_RISING = 1 << 4
+GPIO_V2_LINE_FLAG_EDGE_FALLING = 1 << 5
+GPIO_V2_LINE_FLAG_BIAS_PULL_UP = 1 << 8
+GPIO_V2_LINE_FLAG_BIAS_PULL_DOWN = 1 << 9
+GPIO_V2_LINE_ATTR_ID_DEBOUNCE = 3
+GPIO_V2_LINE_EVENT_RISING_EDGE = 1
+GPIO_V2_LINE_NUM_ATTRS_MAX = 10
+
+# struct gpio_v2_line_request: offsets[64], consumer[32], config (flags, num_attrs, padding[5], attrs[10] of
+# id, padding, value, mask), num_lines, event_buffer_size, padding[5], fd
+LINE_REQUEST = struct.Struct('<64I32sQI5I' + 'IIQQ' * GPIO_V2_LINE_NUM_ATTRS_MAX + 'II5Ii')
+# struct gpio_v2_line_values: bits, mask
+LINE_VALUES = struct.Struct('<QQ')
+# struct gpio_v2_line_event: timestamp_ns, id, offset, seqno, line_seqno, padding[6]
+LINE_EVENT = struct.Struct('<QIIII24x')
+
+
+def _iowr(number: int, size: int) -> int:
+    return (3 << 30) | (size << 16) | (0xB4 << 8) | number
+
+
+GPIO_V2_GET_LINE_IOCTL = _iowr(0x07, LINE_REQUEST.size)
+GPIO_V2_LINE_GET_VALUES_IOCTL = _iowr(0x0E, LINE_VALUES.size)
+
+CONSUMER = b'coop_door'
+# Edges the kernel buffers per line while the loop is busy
+EVENT_BUFFER_SIZE = 64
+# Edges read per line and wake up
+READ_EVENTS = 16
+
+logger = logging.getLogger(__name__)
+
+
+class ChardevButton:
+    """Stand-in for gpiozero.Button on a line of a GPIO character device.
+
+    bounce_time is done by the kernel debouncer of the line: an edge is only reported once the line was stable for
+    bounce_time, instead of gpiozero's ignoring of edges for bounce_time after a reported one. edge_timestamp_ns is
+    the kernel timestamp (time.monotonic_ns() clock) of the edge whose callback is running."""
+
+    def __init__(self, multiplexer, pin: int, pull_up: bool = True, bounce_time: float = None):
+        self.multiplexer = multiplexer
+        self.pin = pin
+        self.pull_up = pull_up
+        self.bounce_time = bounce_time
+        self.when_pressed = None
+        self.when_released = None
+        self.edge_timestamp_ns = None
+        self.fd = multiplexer.add(self)
+
+    @property
+    def is_pressed(self) -> bool:
+        # Active low for pulled up lines, so the value is 1 while pressed either way
+        values = bytearray(LINE_VALUES.pack(0, 1))
+        fcntl.ioctl(self.fd, GPIO_V2_LINE_GET_VALUES_IOCTL, values, True)
+        return bool(LINE_VALUES.unpack(values)[0] & 1)
+
+    def dispatch(self, pressed: bool, timestamp_ns: int):
+        self.edge_timestamp_ns = timestamp_ns
+        callback = self.when_pressed if pressed else self.when_released
+        if callback:
+            callback()
+
+    def close(self):
+        if self.fd is not None:
+            self.multiplexer.remove(self)
+            self.fd = None
+
+
+class InputMultiplexer:
+    """Watches the lines of all inputs of a process on one GPIO character device with a single thread.
+
+    The thread waits on the line fds with epoll, reads the edges the kernel timestamped and queued, and calls the
+    callbacks of all lines that woke it in the order of their timestamps. A busy callback delays the following ones,
+    but no edge and no edge time is lost as long as the kernel buffer of the line doesn't overflow."""
+
+    def __init__(self, chip_path: str):
+        self.chip_path = chip_path
+        self.buttons = {}
+        self.events = 0
+        self.lost = 0
+        # Time from the edge to its callback
+        self.dispatch_lag = LatencyHistogram()
+        self._line_seqnos = {}
+        self._epoll = select.epoll()
+        self._lock = threading.Lock()
+        self._thread = None
+        # Calls for the thread of the multiplexer, it's woken up for them over the pipe
+        self._calls = deque()
+        self._wakeup_read, self._wakeup_write = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        self._epoll.register(self._wakeup_read, select.EPOLLIN)
+
+    def request_line(self, pin: int, pull_up: bool, bounce_time: float) -> int:
+        flags = GPIO_V2_LINE_FLAG_INPUT | GPIO_V2_LINE_FLAG_EDGE_RISING | GPIO_V2_LINE_FLAG_EDGE_FALLING
+        if pull_up:
+            flags |= GPIO_V2_LINE_FLAG_ACTIVE_LOW | GPIO_V2_LINE_FLAG_BIAS_PULL_UP
+        else:
+            flags |= GPIO_V2_LINE_FLAG_BIAS_PULL_DOWN
+        attributes = [0, 0, 0, 0] * GPIO_V2_LINE_NUM_ATTRS_MAX
+        num_attrs = 0
+        if bounce_time:
+            # Debounce period in microseconds for the first and only line of the request
+            attributes[0:4] = [GPIO_V2_LINE_ATTR_ID_DEBOUNCE, 0, int(bounce_time * 1e6), 1]
+            num_attrs = 1
+        request = bytearray(LINE_REQUEST.pack(
+            pin, *[0] * 63, CONSUMER, flags, num_attrs, *[0] * 5, *attributes, 1, EVENT_BUFFER_SIZE, *[0] * 5, 0
+        ))
+        chip_fd = os.open(self.chip_path, os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            fcntl.ioctl(chip_fd, GPIO_V2_GET_LINE_IOCTL, request, True)
+        finally:
+            os.close(chip_fd)
+        return LINE_REQUEST.unpack(request)[-1]
+
+    def button(self, pin: int, pull_up: bool = True, bounce_time: float = None) -> ChardevButton:
+        return ChardevButton(self, pin, pull_up=pull_up, bounce_time=bounce_time)
+
+    def add(self, button: ChardevButton) -> int:
+        fd = self.request_line(button.pin, button.pull_up, button.bounce_time)
+        with self._lock:
+            self.buttons[fd] = button
+            self._epoll.register(fd, select.EPOLLIN)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, name='gpio-inputs', daemon=True)
+                self._thread.start()
+        logger.info('Watching line %s of %s', button.pin, self.chip_path)
+        return fd
+
+    def remove(self, button: ChardevButton):
+        with self._lock:
+            self.buttons.pop(button.fd, None)
+            self._line_seqnos.pop(button.fd, None)
+            self._epoll.unregister(button.fd)
+            os.close(button.fd)
+
+    def call_soon(self, callback) -> bool:
+        """Calls callback on the thread of the multiplexer after the edges it's dispatching, e.g. to measure how long
+        it takes to get there. False, while no line is watched and the thread isn't running."""
+        if self._thread is None:
+            return False
+        self._calls.append(callback)
+        try:
+            os.write(self._wakeup_write, b'\0')
+        except BlockingIOError:
+            # The pipe is full of wakeups already
+            pass
+        return True
+
+    def _read_edges(self, fd: int, edges: list):
+        try:
+            data = os.read(fd, READ_EVENTS * LINE_EVENT.size)
+        except OSError:
+            # Closed by remove in the meantime
+            return
+        button = self.buttons.get(fd)
+        for timestamp_ns, event_id, _, _, line_seqno in LINE_EVENT.iter_unpack(data):
+            previous = self._line_seqnos.get(fd)
+            if previous is not None and line_seqno > previous + 1:
+                self.lost += line_seqno - previous - 1
+            self._line_seqnos[fd] = line_seqno
+            if button:
+                edges.append((timestamp_ns, button, event_id == GPIO_V2_LINE_EVENT_RISING_EDGE))
+
+    def run(self):
+        while True:
+            edges = []
+            woken = False
+            for fd, _ in self._epoll.poll():
+                if fd == self._wakeup_read:
+                    woken = True
+                else:
+                    self._read_edges(fd, edges)
+            # Edges of different lines in the order they happened, the sort is stable for edges of the same line
+            edges.sort(key=lambda edge: edge[0])
+            for timestamp_ns, button, pressed in edges:
+                self.events += 1
+                self.dispatch_lag.observe((time.monotonic_ns() - timestamp_ns) / 1e9)
+                try:
+                    button.dispatch(pressed, timestamp_ns)
+                except Exception as err:
+                    logger.error('Callback of line %s failed', button.pin, exc_info=err)
+            if woken:
+                try:
+                    os.read(self._wakeup_read, READ_EVENTS * LINE_EVENT.size)
+                except BlockingIOError:
+                    pass
+                while self._calls:
+                    self._calls.popleft()()
+
+    def format(self) -> str:
+        return (f'GPIO inputs on {self.chip_path}: {len(self.buttons)} lines, {self.events} edges, {self.lost} lost, '
+                f'dispatch lag {self.dispatch_lag.format()}')
+
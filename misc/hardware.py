@@ -0,0 +1,124 @@
+import logging
+import time
+
+BACKEND_GPIO = 'gpio'
+BACKEND_VIRTUAL = 'virtual'
+# Inputs of the gpio backend: gpiozero with a thread per pin or one epoll thread on the GPIO character device
+INPUTS_GPIOZERO = 'gpiozero'
+INPUTS_CHARDEV = 'chardev'
+# Motor PWM of the gpio backend: RPi.GPIO's software PWM or a hardware PWM channel through sysfs
+PWM_SOFTWARE = 'software'
+PWM_HARDWARE = 'hardware'
+# Hardware PWM channel per BCM pin, once the pin is switched to it, e.g. by dtoverlay=pwm,pin=18,func=2
+HARDWARE_PWM_CHANNELS = {12: 0, 13: 1, 18: 0, 19: 1}
+
+logger = logging.getLogger(__name__)
+
+_virtual_coop = None
+_input_multiplexer = None
+
+
+def get_virtual_coop(cfg):
+    """Returns the simulated coop of this process, wired like the configured pins."""
+    global _virtual_coop
+    if _virtual_coop is None:
+        from misc.virtual_coop import VirtualCoop
+
+        _virtual_coop = VirtualCoop(
+            travel_time=cfg.get_hardware_virtual_travel_time(),
+            bounce_count=cfg.get_hardware_virtual_bounce_count(),
+            bounce_interval=cfg.get_hardware_virtual_bounce_interval()
+        )
+        if cfg.has_coop_door_fleet():
+            doors = [(door, cfg.get_coop_door_fleet_pins(door)) for door in cfg.get_coop_door_fleet_doors()]
+        else:
+            doors = [(cfg.get_coop_door_sensors_door(), cfg.get_coop_door_pins())]
+        for door, pins in doors:
+            # The reed sensors are those of the door the sensors script reports for
+            if door == cfg.get_coop_door_sensors_door():
+                sensor_pins = cfg.get_coop_door_sensors_open_pin(), cfg.get_coop_door_sensors_close_pin()
+            else:
+                sensor_pins = None, None
+            _virtual_coop.add_door(pins['open'], pins['close'], pins['speed'], *sensor_pins)
+    return _virtual_coop
+
+
+def get_input_multiplexer(cfg):
+    """Returns the multiplexer watching all inputs of this process on the configured GPIO character device."""
+    global _input_multiplexer
+    if _input_multiplexer is None:
+        from misc.gpio_chardev import InputMultiplexer
+        from misc.metrics import metrics
+
+        _input_multiplexer = InputMultiplexer(cfg.get_hardware_gpio_chip())
+        metrics.histogram('coop_door_gpio_dispatch_seconds', _input_multiplexer.dispatch_lag)
+        metrics.counter('coop_door_gpio_edges_lost_total', lambda: _input_multiplexer.lost)
+    return _input_multiplexer
+
+
+def create_gpio_probe():
+    """Heartbeat probe of the thread dispatching the character device edges, None with other inputs, whose threads
+    can't take a probe."""
+    if _input_multiplexer is None:
+        return None
+    from misc.heartbeat import LOOP_GPIO, LoopProbe
+
+    probe = LoopProbe(LOOP_GPIO)
+    probe.post_probe = lambda: _input_multiplexer.call_soon(probe.answer)
+    return probe
+
+
+def format_input_stats() -> str:
+    if _input_multiplexer is None:
+        return 'GPIO inputs: no character device lines'
+    return _input_multiplexer.format()
+
+
+def edge_timestamp_ns(button) -> int:
+    """time.monotonic_ns() of the edge whose callback is running, the kernel timestamp for character device lines
+    and the time of the callback for gpiozero and virtual buttons."""
+    return getattr(button, 'edge_timestamp_ns', None) or time.monotonic_ns()
+
+
+def load_gpio(cfg):
+    """Returns RPi.GPIO or its virtual stand-in, depending on the configured hardware backend."""
+    backend = cfg.get_hardware_backend()
+    if backend == BACKEND_VIRTUAL:
+        return get_virtual_coop(cfg).gpio
+    if backend != BACKEND_GPIO:
+        raise ValueError(f'Unknown hardware backend {backend}')
+
+    import RPi.GPIO as gpio
+    return gpio
+
+
+def create_pwm(cfg, gpio, pin: int):
+    """Returns the motor PWM of pin, which only runs while the motor is driven: a hardware PWM channel with
+    pwm = hardware, if pin has one, otherwise RPi.GPIO's or the virtual software PWM."""
+    from misc.pwm import OnDemandPWM, SysfsPWM
+
+    pwm = cfg.get_hardware_pwm()
+    if pwm not in (PWM_SOFTWARE, PWM_HARDWARE):
+        raise ValueError(f'Unknown hardware pwm {pwm}')
+    if pwm == PWM_HARDWARE and cfg.get_hardware_backend() == BACKEND_GPIO:
+        if pin in HARDWARE_PWM_CHANNELS:
+            return SysfsPWM(cfg.get_hardware_pwm_chip(), HARDWARE_PWM_CHANNELS[pin])
+        logger.warning('Pin %s has no hardware PWM channel, using software PWM', pin)
+    return OnDemandPWM(gpio, pin)
+
+
+def load_button_class(cfg):
+    """Returns gpiozero.Button or a factory with the same signature creating virtual or character device buttons."""
+    backend = cfg.get_hardware_backend()
+    if backend == BACKEND_VIRTUAL:
+        return get_virtual_coop(cfg).button
+    if backend != BACKEND_GPIO:
+        raise ValueError(f'Unknown hardware backend {backend}')
+    inputs = cfg.get_hardware_inputs()
+    if inputs == INPUTS_CHARDEV:
+        return get_input_multiplexer(cfg).button
+    if inputs != INPUTS_GPIOZERO:
+        raise ValueError(f'Unknown hardware inputs {inputs}')
+
+    from gpiozero import Button
+    return Button
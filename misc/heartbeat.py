@@ -0,0 +1,252 @@
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from misc.metrics import metrics
+from misc.mqtt_client import build_client_id
+from misc.systemd import notify
+from misc.tracing import LatencyHistogram
+
+# Loops watched by the heartbeat monitor
+LOOP_MQTT = 'mqtt'
+LOOP_GPIO = 'gpio'
+
+logger = logging.getLogger(__name__)
+
+
+class LoopProbe:
+    """Scheduling lag of a loop thread, e.g. the Mqtt network thread. post_probe hands a probe to the loop and returns
+    whether the loop took it, the loop calls answer once it got to the probe. A probe not answered yet is a stall
+    growing with every check, so a wedged loop is noticed while it still hangs, not after it came back. It is posted
+    again on every check until answered, so a single lost probe only delays the answer by one interval.
+
+    active tells whether the loop is expected to answer at all, e.g. only while the client is connected."""
+
+    def __init__(self, name: str, post_probe=None, active=None):
+        self.name = name
+        self.post_probe = post_probe
+        self.active = active
+        self.lag = LatencyHistogram()
+        # Thread which answered the last probe, the one to dump on a stall
+        self.thread_id = None
+        self._posted_ns = None
+        self._lock = threading.Lock()
+        metrics.histogram('coop_door_loop_lag_seconds', self.lag, loop=name)
+
+    def post(self, now_ns: int):
+        if self.active and not self.active():
+            with self._lock:
+                self._posted_ns = None
+            return
+        with self._lock:
+            # A stall counts from the first probe, which is still waiting
+            waiting = self._posted_ns is not None
+            if not waiting:
+                self._posted_ns = now_ns
+        if not self.post_probe() and not waiting:
+            with self._lock:
+                self._posted_ns = None
+
+    def answer(self):
+        answered_ns = time.monotonic_ns()
+        with self._lock:
+            posted_ns, self._posted_ns = self._posted_ns, None
+            self.thread_id = threading.get_ident()
+        if posted_ns is not None:
+            self.lag.observe((answered_ns - posted_ns) / 1e9)
+
+    def stall(self, now_ns: int):
+        """Seconds the current probe waits for its answer and the thread to blame."""
+        with self._lock:
+            posted_ns = self._posted_ns
+        return ((now_ns - posted_ns) / 1e9 if posted_ns is not None else 0.0), self.thread_id
+
+    def format(self) -> str:
+        return f'{self.name} loop lag: {self.lag.format()}'
+
+
+class CallbackWatch:
+    """Callbacks running at the moment per thread, e.g. gpiozero's, which can't be handed a probe. A callback blocking
+    its thread is a stall for as long as it runs, as the following edges wait for it."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.durations = LatencyHistogram()
+        self._running = {}
+        self._lock = threading.Lock()
+        metrics.histogram('coop_door_callback_seconds', self.durations, loop=name)
+
+    def wrap(self, callback):
+        """callback, noting while it runs."""
+        def watched():
+            thread_id = threading.get_ident()
+            started_ns = time.monotonic_ns()
+            with self._lock:
+                # Only the outermost of nested watched callbacks counts
+                outermost = self._running.setdefault(thread_id, started_ns) == started_ns
+            try:
+                return callback()
+            finally:
+                if outermost:
+                    with self._lock:
+                        del self._running[thread_id]
+                    self.durations.observe((time.monotonic_ns() - started_ns) / 1e9)
+        return watched
+
+    def post(self, now_ns: int):
+        pass
+
+    def stall(self, now_ns: int):
+        with self._lock:
+            if not self._running:
+                return 0.0, None
+            thread_id, started_ns = min(self._running.items(), key=lambda running: running[1])
+        return (now_ns - started_ns) / 1e9, thread_id
+
+    def format(self) -> str:
+        return f'{self.name} callbacks: {self.durations.format()}'
+
+
+# GPIO callbacks of all inputs of this process, see CallbackWatch.wrap
+gpio_callbacks = CallbackWatch(LOOP_GPIO)
+
+
+def format_stack(thread_id: int = None) -> str:
+    """Stack of the thread thread_id or of all threads, if it's unknown."""
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    frames = sys._current_frames()
+    thread_ids = [thread_id] if thread_id is not None else list(frames)
+    stacks = []
+    for ident in thread_ids:
+        frame = frames.get(ident)
+        stack = ''.join(traceback.format_stack(frame)) if frame else '  (thread ended)\n'
+        stacks.append(f'Thread {names.get(ident, ident)}:\n{stack}')
+    return ''.join(stacks)
+
+
+def systemd_watchdog_interval():
+    """Half the watchdog timeout systemd expects WATCHDOG=1 within in seconds, None without WatchdogSec."""
+    usec = os.environ.get('WATCHDOG_USEC')
+    pid = os.environ.get('WATCHDOG_PID')
+    if not usec or (pid and pid != str(os.getpid())):
+        return None
+    try:
+        return int(usec) / 2e6
+    except ValueError:
+        return None
+
+
+class HeartbeatMonitor:
+    """Checks the loops of a script every interval seconds. While no probe waits and no callback runs for longer than
+    stall_threshold, WATCHDOG=1 is sent to systemd, so with WatchdogSec in the service a hanging script is restarted.
+    The stack of a thread found stalled is logged once per stall."""
+
+    def __init__(self, interval: float, stall_threshold: float):
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.probes = []
+        self.healthy = True
+        self.stalls = 0
+        self.heartbeats = 0
+        self._stopped = threading.Event()
+        self._thread = None
+        metrics.gauge('coop_door_healthy', lambda: int(self.healthy))
+
+    def add(self, probe):
+        if probe is not None:
+            self.probes.append(probe)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='heartbeat', daemon=True)
+        self._thread.start()
+        logger.info('Checking %s every %.1fs', ', '.join(sorted({probe.name for probe in self.probes})), self.interval)
+
+    def run(self):
+        self.check()
+        while not self._stopped.wait(self.interval):
+            self.check()
+
+    def check(self):
+        now_ns = time.monotonic_ns()
+        stalled = []
+        for probe in self.probes:
+            seconds, thread_id = probe.stall(now_ns)
+            if seconds > self.stall_threshold:
+                stalled.append((probe, seconds, thread_id))
+        if stalled:
+            if self.healthy:
+                self.stalls += 1
+                for probe, seconds, thread_id in stalled:
+                    metrics.inc('coop_door_loop_stalls_total', loop=probe.name)
+                    logger.error('%s loop stalled for %.1fs, withholding the systemd watchdog:\n%s', probe.name,
+                                 seconds, format_stack(thread_id))
+            self.healthy = False
+        else:
+            if not self.healthy:
+                logger.warning('Loops responsive again')
+            self.healthy = True
+            self.heartbeats += 1
+            notify('WATCHDOG=1')
+        for probe in self.probes:
+            probe.post(now_ns)
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+
+    def format(self) -> str:
+        lines = [f'Heartbeat: {"healthy" if self.healthy else "stalled"}, {self.heartbeats} heartbeats, '
+                 f'{self.stalls} stalls']
+        lines.extend(probe.format() for probe in self.probes)
+        return '\n'.join(lines)
+
+
+def create_heartbeat(cfg):
+    """Heartbeat monitor as configured or None, when it's disabled. Checks at least twice per watchdog timeout of
+    systemd."""
+    if not cfg.get_heartbeat_enabled():
+        return None
+    interval = cfg.get_heartbeat_interval()
+    watchdog_interval = systemd_watchdog_interval()
+    if watchdog_interval:
+        interval = min(interval, watchdog_interval)
+    return HeartbeatMonitor(interval, cfg.get_heartbeat_stall_threshold())
+
+
+class MqttProbe(LoopProbe):
+    """Probe of the network thread of client: an empty message to topic, answered when the client receives it. Only
+    active while the client is connected and the broker acknowledged the subscription of topic, so no probe is lost
+    before the subscription exists. The reconnects are watched by the RecoveryTimer.
+
+    subscribe must be called from on_connect and on_subscribe from the on_subscribe callback of the client."""
+
+    def __init__(self, client, topic: str):
+        super().__init__(LOOP_MQTT, self._publish, self._active)
+        self.client = client
+        self.topic = topic
+        self.subscribed = False
+        self._mid = None
+
+    def subscribe(self):
+        self.subscribed = False
+        _, self._mid = self.client.subscribe(self.topic, qos=1)
+        return self._mid
+
+    def on_subscribe(self, mid: int, reason_code_list):
+        if mid == self._mid and not any(reason_code.is_failure for reason_code in reason_code_list):
+            self.subscribed = True
+
+    def _active(self) -> bool:
+        return self.subscribed and self.client.is_connected()
+
+    def _publish(self) -> bool:
+        return self.client.publish(self.topic, b'', qos=1).rc == 0
+
+
+def create_mqtt_probe(cfg, client, name: str) -> MqttProbe:
+    """Probe of the Mqtt network thread of the script name on a topic of its own."""
+    return MqttProbe(client, f'{cfg.get_heartbeat_topic()}/{build_client_id(cfg, name)}')
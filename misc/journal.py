@@ -0,0 +1,207 @@
+import glob
+import heapq
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+# Event types, the meaning of the value is given behind each
+EVENT_COMMAND = 1  # CoopDoorCommand value received by the coop door
+EVENT_MOTOR_ON = 2  # MOTOR_OPENING or MOTOR_CLOSING
+EVENT_MOTOR_OFF = 3  # 1 when stopped at the end stop, MOTOR_OFF_TRAVEL_TIMEOUT by the travel watchdog, else 0
+EVENT_SENSOR_EDGE = 4  # SENSOR_OPEN or SENSOR_CLOSED, negative when released
+EVENT_SENSOR_COMMIT = 5  # like EVENT_SENSOR_EDGE, for the debounced state
+EVENT_STATE_PUBLISH = 6  # CoopDoorState value
+EVENT_BUTTON_PRESS = 7  # CoopDoorCommand value
+EVENT_OPEN_BLOCKED = 8  # 0
+EVENT_PRESS_REJECTED = 9  # CoopDoorCommand value of the button
+
+EVENT_NAMES = {
+    EVENT_COMMAND: 'command',
+    EVENT_MOTOR_ON: 'motor_on',
+    EVENT_MOTOR_OFF: 'motor_off',
+    EVENT_SENSOR_EDGE: 'sensor_edge',
+    EVENT_SENSOR_COMMIT: 'sensor_commit',
+    EVENT_STATE_PUBLISH: 'state_publish',
+    EVENT_BUTTON_PRESS: 'button_press',
+    EVENT_OPEN_BLOCKED: 'open_blocked',
+    EVENT_PRESS_REJECTED: 'press_rejected'
+}
+
+MOTOR_OPENING = 1
+MOTOR_CLOSING = 2
+MOTOR_OFF_END_STOP = 1
+MOTOR_OFF_TRAVEL_TIMEOUT = 2
+SENSOR_OPEN = 1
+SENSOR_CLOSED = 2
+
+SOURCES = {'coop_door': 1, 'coop_door_buttons': 2, 'coop_door_sensors': 3}
+
+DEFAULT_DOOR = 'coop door'
+
+# File header: magic, record size, source, number of records, followed by the length of the door table and the
+# door table as json list, the door of a record is its index in this list
+MAGIC = b'COOPJRN1'
+HEADER = struct.Struct('<8sHBxQ')
+COUNT = struct.Struct('<Q')
+COUNT_OFFSET = 12
+DOOR_TABLE_OFFSET = 32
+DOOR_TABLE_LENGTH = struct.Struct('<H')
+HEADER_SIZE = 4096
+# Wall clock ns, monotonic ns, door, event, source, value
+RECORD = struct.Struct('<qqHBBi')
+
+logger = logging.getLogger(__name__)
+
+
+class JournalFile:
+    """One memory mapped journal file of fixed size, records are appended until it's full."""
+
+    def __init__(self, path: str, source: int, file_size: int):
+        self.path = path
+        exists = os.path.exists(path)
+        with open(path, 'a+b') as file:
+            existing_size = os.fstat(file.fileno()).st_size
+            if existing_size > file_size:
+                # Cutting the file would drop its newest records, the new size applies from the next file on
+                logger.info('Keeping the size of %s at %d bytes, larger than the configured %d bytes',
+                            path, existing_size, file_size)
+                file_size = existing_size
+            else:
+                file.truncate(file_size)
+            self.map = mmap.mmap(file.fileno(), file_size)
+        self.capacity = (file_size - HEADER_SIZE) // RECORD.size
+        magic, record_size, _, self.count = HEADER.unpack_from(self.map)
+        if exists and magic == MAGIC and record_size == RECORD.size:
+            self.doors = read_door_table(self.map)
+        else:
+            self.count = 0
+            self.doors = []
+            HEADER.pack_into(self.map, 0, MAGIC, RECORD.size, source, 0)
+            self.write_door_table()
+
+    @property
+    def full(self) -> bool:
+        return self.count >= self.capacity
+
+    def write_door_table(self):
+        table = json.dumps(self.doors).encode()
+        if DOOR_TABLE_OFFSET + DOOR_TABLE_LENGTH.size + len(table) > HEADER_SIZE:
+            raise ValueError(f'Too many doors for the journal header: {self.doors}')
+        DOOR_TABLE_LENGTH.pack_into(self.map, DOOR_TABLE_OFFSET, len(table))
+        start = DOOR_TABLE_OFFSET + DOOR_TABLE_LENGTH.size
+        self.map[start:start + len(table)] = table
+
+    def append(self, wall_ns: int, monotonic_ns: int, door: int, event: int, source: int, value: int):
+        RECORD.pack_into(self.map, HEADER_SIZE + self.count * RECORD.size,
+                         wall_ns, monotonic_ns, door, event, source, value)
+        # The count is written after the record, so a reader never sees a half written record
+        self.count += 1
+        COUNT.pack_into(self.map, COUNT_OFFSET, self.count)
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+
+
+class Journal:
+    """Append-only binary journal of door events written by one script, in files of file_size bytes of which the
+    newest max_files are kept. Appending is a struct pack into the memory map, cheap enough for GPIO callbacks."""
+
+    def __init__(self, enabled: bool, directory: str, source_name: str, file_size: int, max_files: int):
+        self.enabled = enabled
+        self.directory = directory
+        self.source_name = source_name
+        self.source = SOURCES[source_name]
+        self.file_size = file_size
+        self.max_files = max_files
+        self.file = None
+        self._lock = threading.Lock()
+        if enabled:
+            os.makedirs(directory, exist_ok=True)
+            paths = journal_paths(directory, source_name)
+            self._open(paths[-1] if paths else self._path(0))
+
+    def _path(self, sequence: int) -> str:
+        return os.path.join(self.directory, f'{self.source_name}-{sequence:06d}.journal')
+
+    def _open(self, path: str):
+        self.file = JournalFile(path, self.source, self.file_size)
+        if self.file.full:
+            self._rotate()
+
+    def _rotate(self):
+        sequence = int(os.path.basename(self.file.path).rsplit('-', 1)[1].split('.')[0]) + 1
+        doors = self.file.doors
+        self.file.close()
+        self.file = JournalFile(self._path(sequence), self.source, self.file_size)
+        self.file.doors = list(doors)
+        self.file.write_door_table()
+        for path in journal_paths(self.directory, self.source_name)[:-self.max_files]:
+            os.remove(path)
+
+    def record(self, event: int, value: int = 0, door_id: str = DEFAULT_DOOR, monotonic_ns: int = None):
+        if not self.enabled:
+            return
+        with self._lock:
+            try:
+                door = self.file.doors.index(door_id)
+            except ValueError:
+                self.file.doors.append(door_id)
+                self.file.write_door_table()
+                door = len(self.file.doors) - 1
+            self.file.append(time.time_ns(), monotonic_ns or time.monotonic_ns(), door, event, self.source, value)
+            if self.file.full:
+                self._rotate()
+
+    def close(self):
+        with self._lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+                self.enabled = False
+
+
+def journal_paths(directory: str, source_name: str = '*') -> list:
+    return sorted(glob.glob(os.path.join(directory, f'{source_name}-*.journal')))
+
+
+def read_door_table(buffer) -> list:
+    length, = DOOR_TABLE_LENGTH.unpack_from(buffer, DOOR_TABLE_OFFSET)
+    start = DOOR_TABLE_OFFSET + DOOR_TABLE_LENGTH.size
+    return json.loads(bytes(buffer[start:start + length]) or b'[]')
+
+
+def read_file(path: str, since_wall_ns: int = 0):
+    """Records of one journal file as (wall_ns, monotonic_ns, door id, event, source, value)."""
+    with open(path, 'rb') as file:
+        data = file.read()
+    magic, record_size, _, count = HEADER.unpack_from(data)
+    if magic != MAGIC or record_size != RECORD.size:
+        logger.warning('Skipping %s, it is no journal of this version', path)
+        return
+    if not count or RECORD.unpack_from(data, HEADER_SIZE + (count - 1) * RECORD.size)[0] < since_wall_ns:
+        return
+    doors = read_door_table(data)
+    records = memoryview(data)[HEADER_SIZE:HEADER_SIZE + count * RECORD.size]
+    for wall_ns, monotonic_ns, door, event, source, value in RECORD.iter_unpack(records):
+        if wall_ns >= since_wall_ns:
+            yield wall_ns, monotonic_ns, doors[door], event, source, value
+
+
+def read_journal(directory: str, since_wall_ns: int = 0):
+    """Records of all scripts in the directory ordered by wall clock time."""
+    return heapq.merge(*(read_file(path, since_wall_ns) for path in journal_paths(directory)), key=lambda r: r[0])
+
+
+def create_journal(cfg, source_name: str) -> Journal:
+    return Journal(
+        cfg.get_journal_enabled(),
+        cfg.get_journal_directory(),
+        source_name,
+        cfg.get_journal_file_size(),
+        cfg.get_journal_max_files()
+    )
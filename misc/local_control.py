@@ -0,0 +1,171 @@
+import logging
+import os
+import selectors
+import socket
+import stat
+import threading
+import time
+
+from misc.metrics import metrics
+
+# Requests and replies are single lines, replies start with one of these
+REPLY_OK = 'OK'
+REPLY_ERROR = 'ERR'
+MAX_REQUEST = 1024
+# Seconds a script waits for coop_door.py, before it falls back to the broker
+CLIENT_TIMEOUT = 0.5
+
+logger = logging.getLogger(__name__)
+
+
+class LocalControlServer:
+    """Unix domain socket of coop_door.py for the scripts and automations on the same host, so they reach the motor
+    without the broker. Every request is one line, handler is called with it on the thread of the server and returns
+    the reply line, e.g. 'OPEN' -> 'OK OPEN OPENING'. Lines are answered in the order they arrive per connection."""
+
+    def __init__(self, path: str, handler):
+        self.path = path
+        self.handler = handler
+        self.requests = 0
+        self._socket = None
+        self._selector = selectors.DefaultSelector()
+        # Wakes the server thread up for close, so it doesn't need to poll
+        self._wakeup_read, self._wakeup_write = socket.socketpair()
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        if os.path.exists(self.path) and stat.S_ISSOCK(os.stat(self.path).st_mode):
+            # Left by a coop_door.py, which didn't exit cleanly
+            os.unlink(self.path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM | socket.SOCK_CLOEXEC)
+        self._socket.bind(self.path)
+        os.chmod(self.path, 0o660)
+        self._socket.listen()
+        self._socket.setblocking(False)
+        self._selector.register(self._socket, selectors.EVENT_READ)
+        self._selector.register(self._wakeup_read, selectors.EVENT_READ)
+        self._thread = threading.Thread(target=self.serve, name='local-control', daemon=True)
+        self._thread.start()
+        logger.info('Serving local control on %s', self.path)
+
+    def serve(self):
+        buffers = {}
+        while not self._stopped:
+            for key, _ in self._selector.select():
+                sock = key.fileobj
+                if sock is self._wakeup_read:
+                    continue
+                if sock is self._socket:
+                    try:
+                        connection, _ = self._socket.accept()
+                    except BlockingIOError:
+                        continue
+                    self._selector.register(connection, selectors.EVENT_READ)
+                    buffers[connection] = b''
+                    continue
+                try:
+                    data = sock.recv(MAX_REQUEST)
+                except OSError:
+                    data = b''
+                buffers[sock] += data
+                if not data or len(buffers[sock]) > MAX_REQUEST:
+                    self._selector.unregister(sock)
+                    sock.close()
+                    del buffers[sock]
+                    continue
+                *lines, buffers[sock] = buffers[sock].split(b'\n')
+                for line in lines:
+                    self._reply(sock, line.decode('utf-8', 'replace').strip())
+
+    def _reply(self, sock, line: str):
+        self.requests += 1
+        try:
+            reply = self.handler(line)
+        except Exception as err:
+            logger.error('Local control request %s failed', line, exc_info=err)
+            reply = f'{REPLY_ERROR} internal error'
+        try:
+            # Replies are short, the socket buffer takes them without blocking
+            sock.setblocking(True)
+            sock.sendall(f'{reply}\n'.encode())
+            sock.setblocking(False)
+        except OSError:
+            pass
+
+    def close(self):
+        self._stopped = True
+        self._wakeup_write.send(b'\0')
+        if self._thread:
+            self._thread.join()
+        for key in list(self._selector.get_map().values()):
+            key.fileobj.close()
+        self._selector.close()
+        self._wakeup_write.close()
+        if self._socket:
+            os.unlink(self.path)
+
+    def format(self) -> str:
+        return f'Local control on {self.path}: {self.requests} requests'
+
+
+class LocalControlClient:
+    """Connection of a script to the control socket of coop_door.py. request returns None while coop_door.py isn't
+    reachable, e.g. not running on this host, so the script falls back to the broker."""
+
+    def __init__(self, path: str, timeout: float = CLIENT_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self._socket = None
+        self._buffer = b''
+        # Buttons and the schedule request from different threads
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM | socket.SOCK_CLOEXEC)
+        self._socket.settimeout(self.timeout)
+        self._socket.connect(self.path)
+        self._buffer = b''
+
+    def _close(self):
+        if self._socket:
+            self._socket.close()
+            self._socket = None
+
+    def _read_line(self) -> str:
+        while b'\n' not in self._buffer:
+            data = self._socket.recv(MAX_REQUEST)
+            if not data:
+                raise ConnectionResetError('Closed by coop_door.py')
+            self._buffer += data
+        line, self._buffer = self._buffer.split(b'\n', 1)
+        return line.decode()
+
+    def request(self, line: str):
+        started_ns = time.monotonic_ns()
+        with self._lock:
+            # A kept connection may be closed by a restarted coop_door.py, so once more with a new one
+            for attempt in range(2):
+                try:
+                    if self._socket is None:
+                        self._connect()
+                    self._socket.sendall(f'{line}\n'.encode())
+                    reply = self._read_line()
+                    break
+                except OSError as err:
+                    self._close()
+                    if attempt or isinstance(err, (FileNotFoundError, socket.timeout)):
+                        logger.debug('Local control on %s not reachable: %s', self.path, err)
+                        return None
+        metrics.observe('coop_door_local_control_seconds', (time.monotonic_ns() - started_ns) / 1e9)
+        return reply
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+
+def create_local_control_client(cfg):
+    """Client of the configured control socket or None, when coop_door.py serves none."""
+    path = cfg.get_coop_door_control_socket()
+    return LocalControlClient(path) if path else None
@@ -0,0 +1,185 @@
+import logging
+import threading
+
+from misc.tracing import LatencyHistogram
+
+# Metric types and help texts, metrics not listed here are rendered untyped
+METRICS_HELP = {
+    'coop_door_messages_received_total': ('counter', 'Mqtt messages received per configured topic or other'),
+    'coop_door_commands_total': ('counter', 'Commands executed per door and command'),
+    'coop_door_motor_on_seconds_total': ('counter', 'Seconds the motor was driven per door'),
+    'coop_door_local_requests_total': ('counter', 'Requests over the local control socket per request'),
+    'coop_door_local_control_seconds': ('histogram', 'Round trip of a request to the local control socket'),
+    'coop_door_command_acks_total': ('counter', 'Acks of the commands sent per command and ack'),
+    'coop_door_command_completions_total': ('counter', 'Completions of the accepted commands per command and result'),
+    'coop_door_command_retries_total': ('counter', 'Commands sent again without ack per command'),
+    'coop_door_commands_unanswered_total': ('counter', 'Commands given up without ack per command'),
+    'coop_door_command_ack_seconds': ('histogram', 'Time from sending a command to its ack per command'),
+    'coop_door_command_completion_seconds': ('histogram', 'Time from sending a command to its completion per command'),
+    'coop_door_states_ignored_total': ('counter', 'Structured state messages ignored per door and reason'),
+    'coop_door_travel_timeouts_total': ('counter', 'Runs stopped by the travel watchdog per door and direction'),
+    'coop_door_pwm_running': ('gauge', 'Whether the motor PWM of a door runs at the moment'),
+    'coop_door_travel_seconds': ('histogram', 'Time from motor on to the end stop per door and direction'),
+    'coop_door_sensor_edges_total': ('counter', 'Raw sensor edges per sensor'),
+    'coop_door_sensor_states_total': ('counter', 'Debounced sensor states per sensor'),
+    'coop_door_button_presses_total': ('counter', 'Button presses per command'),
+    'coop_door_button_presses_rejected_total': ('counter', 'Button presses rejected by the press confirmation'),
+    'coop_door_press_confirm_seconds': ('histogram', 'Time from a button press to its confirmation'),
+    'coop_door_publish_total': ('counter', 'Mqtt publishes per return code'),
+    'coop_door_publish_queue_depth': ('gauge', 'Messages waiting in the publish queue'),
+    'coop_door_mqtt_reconnects_total': ('counter', 'Reconnects to the mqtt broker'),
+    'coop_door_mqtt_recovery_seconds': ('histogram', 'Time from losing the broker connection to the reconnect'),
+    'coop_door_stage_latency_seconds': ('histogram', 'Latency per traced stage'),
+    'coop_door_gpio_dispatch_seconds': ('histogram', 'Time from a GPIO edge to its callback on the character device'),
+    'coop_door_gpio_edges_lost_total': ('counter', 'GPIO edges lost by an overflow of the kernel buffer of a line'),
+    'coop_door_loop_lag_seconds': ('histogram', 'Time a heartbeat probe waited for its loop per loop'),
+    'coop_door_callback_seconds': ('histogram', 'Time a watched callback blocked its thread per loop'),
+    'coop_door_loop_stalls_total': ('counter', 'Stalls found by the heartbeat monitor per loop'),
+    'coop_door_healthy': ('gauge', 'Whether the loops of the script are responsive'),
+    'coop_door_startup_seconds': ('gauge', 'Time from the process start until a startup phase was done'),
+}
+
+logger = logging.getLogger(__name__)
+
+
+def label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def escape_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(key: tuple, extra: str = '') -> str:
+    labels = [f'{name}="{escape_label_value(value)}"' for name, value in key]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+class Metrics:
+    """Counters, gauges and histograms of a process, rendered in the Prometheus text format. Updates only take a
+    short lock, so they can be done from GPIO callbacks and the Mqtt network thread."""
+
+    def __init__(self):
+        self._counters = {}
+        self._counter_callbacks = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = (name, label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def counter(self, name: str, callback, **labels):
+        """Registers callback, which returns the current count kept elsewhere whenever the metrics are rendered."""
+        with self._lock:
+            self._counter_callbacks[(name, label_key(labels))] = callback
+
+    def gauge(self, name: str, callback, **labels):
+        """Registers callback, which returns the current value whenever the metrics are rendered."""
+        with self._lock:
+            self._gauges[(name, label_key(labels))] = callback
+
+    def histogram(self, name: str, histogram: LatencyHistogram, **labels):
+        """Registers an existing histogram, e.g. of the tracer."""
+        with self._lock:
+            self._histograms[(name, label_key(labels))] = histogram
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, label_key(labels))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, LatencyHistogram())
+        histogram.observe(seconds)
+
+    def render(self) -> str:
+        with self._lock:
+            counters = dict(self._counters)
+            counter_callbacks = list(self._counter_callbacks.items())
+            gauges = sorted(self._gauges.items(), key=lambda item: item[0])
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+
+        lines = []
+        described = set()
+
+        def describe(name):
+            if name not in described and name in METRICS_HELP:
+                metric_type, help_text = METRICS_HELP[name]
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {metric_type}')
+            described.add(name)
+
+        for key, callback in counter_callbacks:
+            try:
+                counters[key] = callback()
+            except Exception as err:
+                logger.warning('Counter %s failed: %s', key[0], err)
+        for (name, key), value in sorted(counters.items()):
+            describe(name)
+            lines.append(f'{name}{format_labels(key)} {value}')
+        for (name, key), callback in gauges:
+            describe(name)
+            try:
+                lines.append(f'{name}{format_labels(key)} {callback()}')
+            except Exception as err:
+                logger.warning('Gauge %s failed: %s', name, err)
+        for (name, key), histogram in histograms:
+            describe(name)
+            counts, count, total = histogram.snapshot()
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                bucket_label = f'le="{bound}"'
+                lines.append(f'{name}_bucket{format_labels(key, bucket_label)} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(key)} {total}')
+            lines.append(f'{name}_count{format_labels(key)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+# One registry per process, so the scripts running combined in coop_door.py share one endpoint
+metrics = Metrics()
+
+
+def create_metrics_server(address):
+    # http.server pulls in http.client, email and ssl, so it's only imported when metrics are enabled
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug('Metrics request: ' + format, *args)
+
+    server = ThreadingHTTPServer(address, MetricsHandler)
+    server.daemon_threads = True
+    return server
+
+
+def register_tracer(tracer):
+    for stage, histogram in tracer.stages.items():
+        metrics.histogram('coop_door_stage_latency_seconds', histogram, stage=stage)
+
+
+def start_metrics_server(cfg, script_name: str):
+    """Serves the metrics on http://<bind_address>:<port>/metrics, when enabled."""
+    if not cfg.get_metrics_enabled():
+        return None
+    address = (cfg.get_metrics_bind_address(), cfg.get_metrics_port(script_name))
+    server = create_metrics_server(address)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info('Serving metrics on %s:%s', *address)
+    return server
@@ -0,0 +1,160 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+from misc.file_writer import file_writer
+
+DIRECTION_OPENING = 'opening'
+DIRECTION_CLOSING = 'closing'
+
+# Duty cycle updates while ramping and approaching
+PROFILE_TICK = 0.02
+
+logger = logging.getLogger(__name__)
+
+# ramp_time: seconds from 0 to cruise_duty, approach_duty: duty cycle once approach_fraction of the expected travel
+# is done, so the door reaches the end stop slowly
+MotionProfile = namedtuple('MotionProfile', ['ramp_time', 'cruise_duty', 'approach_duty', 'approach_fraction'])
+
+
+class TravelModel:
+    """Travel per door and direction learned from completed runs, measured in seconds at 100% duty cycle, so runs
+    with different profiles are comparable. Stored as json by the file writer, so it survives restarts."""
+
+    def __init__(self, model_file: str, learning_rate: float):
+        self.model_file = model_file
+        self.learning_rate = learning_rate
+        self._lock = threading.Lock()
+        self._travel = {}
+        if model_file and os.path.exists(model_file):
+            try:
+                with open(model_file) as model:
+                    self._travel = json.load(model)
+            except (OSError, ValueError) as err:
+                logger.warning('Starting without travel model, %s could not be read: %s', model_file, err)
+
+    def expected_travel(self, door_id: str, direction: str):
+        return self._travel.get(door_id, {}).get(direction)
+
+    def learn(self, door_id: str, direction: str, travel: float):
+        with self._lock:
+            directions = self._travel.setdefault(door_id, {})
+            expected = directions.get(direction)
+            directions[direction] = travel if expected is None else expected + self.learning_rate * (travel - expected)
+            if self.model_file:
+                file_writer().replace(self.model_file, json.dumps(self._travel))
+
+
+class MotionRun(threading.Thread):
+    """One move of a door: ramps the duty cycle up, cruises and slows down before the expected end stop."""
+
+    def __init__(self, control, pwm_speed, door_id: str, direction: str):
+        super().__init__(name=f'motion-{door_id}', daemon=True)
+        self.control = control
+        self.pwm_speed = pwm_speed
+        self.door_id = door_id
+        self.direction = direction
+        self.profile = control.profile
+        self.expected_travel = control.travel_model.expected_travel(door_id, direction)
+        self.started_at = time.monotonic()
+        self.accounted_at = self.started_at
+        self.duration = None
+        # Travel done so far in seconds at 100% duty cycle
+        self.travel = 0.0
+        self.duty_cycle = 0.0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def target_duty_cycle(self, elapsed: float) -> float:
+        profile = self.profile
+        if self.expected_travel and self.travel >= profile.approach_fraction * self.expected_travel:
+            return profile.approach_duty
+        if profile.ramp_time > 0 and elapsed < profile.ramp_time:
+            return profile.cruise_duty * elapsed / profile.ramp_time
+        return profile.cruise_duty
+
+    def _account(self, now: float):
+        self.travel += self.duty_cycle / 100 * (now - self.accounted_at)
+        self.accounted_at = now
+
+    def run(self):
+        while True:
+            with self._lock:
+                if self._stopped.is_set():
+                    return
+                now = time.monotonic()
+                self._account(now)
+                duty_cycle = self.target_duty_cycle(now - self.started_at)
+                if duty_cycle != self.duty_cycle:
+                    self.pwm_speed.ChangeDutyCycle(duty_cycle)
+                    self.duty_cycle = duty_cycle
+            self._stopped.wait(PROFILE_TICK)
+
+    def stop(self):
+        """Stops changing the duty cycle; afterwards the caller owns the PWM again."""
+        with self._lock:
+            if self._stopped.is_set():
+                return
+            now = time.monotonic()
+            self._account(now)
+            self.duration = now - self.started_at
+            self._stopped.set()
+
+    def finish(self, end_stop_reached: bool):
+        """Stops the run and records it with the control it was started by, even if the config changed since."""
+        self.stop()
+        self.control.record(self, end_stop_reached)
+
+
+class MotionControl:
+    """Motion profile, travel model and the record of runs shared by all doors of a process."""
+
+    def __init__(self, profile: MotionProfile, travel_model: TravelModel, runs_file: str):
+        self.profile = profile
+        self.travel_model = travel_model
+        self.runs_file = runs_file
+
+    def start(self, pwm_speed, door_id: str, direction: str) -> MotionRun:
+        motion_run = MotionRun(self, pwm_speed, door_id, direction)
+        motion_run.start()
+        return motion_run
+
+    def record(self, motion_run: MotionRun, end_stop_reached: bool):
+        """Learns the travel of the run, when the end stop was reached, and records its timing."""
+        if end_stop_reached:
+            self.travel_model.learn(motion_run.door_id, motion_run.direction, motion_run.travel)
+        logger.info(
+            'Run of %s %s took %.2fs, travel %.2fs at full speed, expected %s, end stop reached %s',
+            motion_run.door_id, motion_run.direction, motion_run.duration, motion_run.travel,
+            motion_run.expected_travel, end_stop_reached
+        )
+        if self.runs_file:
+            record = {
+                'door': motion_run.door_id,
+                'direction': motion_run.direction,
+                'started': round(time.time() - motion_run.duration, 3),
+                'duration': round(motion_run.duration, 3),
+                'travel': round(motion_run.travel, 3),
+                'expected_travel': motion_run.expected_travel,
+                'end_stop_reached': end_stop_reached,
+                'profile': self.profile._asdict()
+            }
+            # Appended by the file writer, the run ends under the lock of its door
+            file_writer().append(self.runs_file, json.dumps(record) + '\n')
+
+
+def create_motion_control(cfg):
+    """Motion control as configured or None, when the motor shall run at full speed as before."""
+    if not cfg.get_coop_door_motion_enabled():
+        return None
+    profile = MotionProfile(
+        cfg.get_coop_door_motion_ramp_time(),
+        cfg.get_coop_door_motion_cruise_duty(),
+        cfg.get_coop_door_motion_approach_duty(),
+        cfg.get_coop_door_motion_approach_fraction()
+    )
+    travel_model = TravelModel(cfg.get_coop_door_motion_travel_model_file(), cfg.get_coop_door_motion_learning_rate())
+    return MotionControl(profile, travel_model, cfg.get_coop_door_motion_runs_file())
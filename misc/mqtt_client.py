@@ -0,0 +1,92 @@
+import logging
+import socket
+import time
+
+from misc.metrics import metrics
+from misc.tracing import LatencyHistogram
+
+PROTOCOL_V311 = '3.1.1'
+PROTOCOL_V5 = '5'
+
+BACKEND_PAHO = 'paho'
+BACKEND_VIRTUAL = 'virtual'
+
+logger = logging.getLogger(__name__)
+
+
+def build_client_id(cfg, name: str) -> str:
+    """Client id of the script name, also the last level of its command reply topic."""
+    return f'{cfg.get_mqtt_client_id_prefix() or socket.gethostname()}-{name}'
+
+
+def create_client(cfg, name: str):
+    """Creates a Mqtt client speaking the configured protocol version, reconnecting with exponential backoff.
+
+    name makes the client id unique per script, so a persistent session is found again after a restart. With the
+    virtual backend the client is connected to the broker stand-in of misc.virtual_mqtt instead."""
+    protocol = cfg.get_mqtt_protocol()
+    client_id = build_client_id(cfg, name)
+    backend = cfg.get_mqtt_backend()
+    if backend == BACKEND_VIRTUAL:
+        from misc.virtual_mqtt import get_virtual_broker
+
+        return get_virtual_broker().client(client_id)
+    if backend != BACKEND_PAHO:
+        raise ValueError(f'Unknown mqtt backend {backend}')
+    # paho is only imported here, so the virtual backend runs without it
+    import paho.mqtt.client as mqtt
+
+    persistent_session = cfg.get_mqtt_persistent_session()
+    if protocol == PROTOCOL_V5:
+        # Mqtt v5 chooses the session on connect, see connect_client
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id, protocol=mqtt.MQTTv5)
+    elif protocol == PROTOCOL_V311:
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id,
+                             clean_session=not persistent_session)
+    else:
+        raise ValueError(f'Unsupported mqtt protocol {protocol}')
+    client.reconnect_delay_set(cfg.get_mqtt_reconnect_delay_min(), cfg.get_mqtt_reconnect_delay_max())
+    return client
+
+
+def connect_client(client, cfg):
+    """Starts connecting without blocking, the network loop then retries until the broker is reachable, also for
+    the first connection after boot."""
+    # The broker stand-in keeps no sessions, paho's properties are only imported for a real broker
+    if cfg.get_mqtt_protocol() == PROTOCOL_V5 and cfg.get_mqtt_backend() != BACKEND_VIRTUAL:
+        from paho.mqtt.packettypes import PacketTypes
+        from paho.mqtt.properties import Properties
+
+        persistent_session = cfg.get_mqtt_persistent_session()
+        properties = Properties(PacketTypes.CONNECT)
+        properties.SessionExpiryInterval = cfg.get_mqtt_session_expiry() if persistent_session else 0
+        client.connect_async(cfg.get_mqtt_broker(), clean_start=not persistent_session, properties=properties)
+    else:
+        client.connect_async(cfg.get_mqtt_broker())
+
+
+class RecoveryTimer:
+    """Measures the time from losing the broker connection to being connected again."""
+
+    def __init__(self):
+        self.disconnected_at_ns = None
+        self.recoveries = LatencyHistogram()
+
+    def on_disconnect(self, client, userdata, flags, reason_code, properties):
+        if self.disconnected_at_ns is None:
+            self.disconnected_at_ns = time.monotonic_ns()
+        logger.warning('Disconnected from mqtt broker with reason code %s, reconnecting', reason_code)
+
+    def connected(self):
+        """To be called from on_connect, returns the seconds the connection was lost or None for the first one."""
+        if self.disconnected_at_ns is None:
+            return None
+        seconds = (time.monotonic_ns() - self.disconnected_at_ns) / 1e9
+        self.disconnected_at_ns = None
+        self.recoveries.observe(seconds)
+        metrics.inc('coop_door_mqtt_reconnects_total')
+        logger.info('Reconnected to mqtt broker after %.3fs', seconds)
+        return seconds
+
+    def format(self) -> str:
+        return f'Mqtt reconnects: {self.recoveries.format()}'
@@ -0,0 +1,241 @@
+import json
+import logging
+import os
+import threading
+from collections import deque
+
+from misc.command_ack import reply_properties
+from misc.metrics import metrics
+
+# While messages wait for the broker, the publisher checks the connection at least this often
+RETRY_INTERVAL = 0.5
+# Return code of a successful publish, paho.mqtt.client.MQTT_ERR_SUCCESS, as paho isn't imported for the virtual
+# backend
+MQTT_ERR_SUCCESS = 0
+
+logger = logging.getLogger(__name__)
+
+
+class PendingMessage:
+    __slots__ = ('topic', 'payload', 'retain', 'properties', 'coalesce', 'superseded')
+
+    def __init__(self, topic: str, payload: str, retain: bool, properties, coalesce: bool):
+        self.topic = topic
+        self.payload = payload
+        self.retain = retain
+        self.properties = properties
+        self.coalesce = coalesce
+        self.superseded = False
+
+    def to_json(self) -> str:
+        message = {'topic': self.topic, 'payload': self.payload, 'retain': self.retain, 'coalesce': self.coalesce}
+        # Traces are meaningless once the message was spooled, but a command still needs its reply topic and request
+        # id, so coop_door.py acks it and recognizes its retries
+        correlation_data = getattr(self.properties, 'CorrelationData', None) if self.properties is not None else None
+        if correlation_data is not None:
+            message['correlation_data'] = correlation_data.hex()
+            message['response_topic'] = getattr(self.properties, 'ResponseTopic', None)
+        return json.dumps(message)
+
+    @classmethod
+    def from_json(cls, line: str):
+        message = json.loads(line)
+        properties = None
+        if 'correlation_data' in message:
+            properties = reply_properties(bytes.fromhex(message['correlation_data']), message['response_topic'])
+        return cls(message['topic'], message['payload'], message['retain'], properties, message['coalesce'])
+
+
+def coalesced(messages) -> list:
+    """Drops every coalescing message followed by a later one for the same topic, keeping the order of the rest."""
+    latest = {}
+    for index, message in enumerate(messages):
+        if message.coalesce:
+            latest[message.topic] = index
+    return [message for index, message in enumerate(messages)
+            if not message.coalesce or latest[message.topic] == index]
+
+
+class MqttPublisher(threading.Thread):
+    """Publishes on its own thread, so GPIO callbacks only append to a queue.
+
+    A coalescing message replaces a not yet published one for the same topic, e.g. realtime states where only the
+    latest matters. While the broker is unreachable the messages are appended to spool_file and replayed in order
+    after the reconnect, before anything newer. Without spool_file they wait in memory. Superseded and excess messages
+    are only removed from the spool on the reconnect, or when it grew to twice spool_size."""
+
+    def __init__(self, client, queue_size: int, spool_file: str = None, spool_size: int = 1000,
+                 qos: int = 0):
+        super().__init__(name='mqtt-publisher', daemon=True)
+        self.client = client
+        self.qos = qos
+        self.queue_size = queue_size
+        self.spool_file = spool_file
+        self.spool_size = spool_size
+        self.queue = deque()
+        self.pending_by_topic = {}
+        # Undelivered messages, when there is no spool file
+        self.backlog = []
+        # Messages held in the spool or backlog since it was last compacted
+        self.backlog_size = 0
+        if spool_file and os.path.exists(spool_file):
+            with open(spool_file) as spool:
+                self.backlog_size = sum(1 for _ in spool)
+        self.published = 0
+        self.coalesced = 0
+        self.spooled = 0
+        self.dropped = 0
+        self._condition = threading.Condition()
+
+    def publish(self, topic: str, payload: str, retain: bool = False, properties=None, coalesce: bool = False):
+        message = PendingMessage(topic, payload, retain, properties, coalesce)
+        with self._condition:
+            if coalesce:
+                previous = self.pending_by_topic.get(topic)
+                if previous is not None:
+                    previous.superseded = True
+                    self.coalesced += 1
+                self.pending_by_topic[topic] = message
+            if len(self.queue) >= self.queue_size:
+                self._compact()
+            self.queue.append(message)
+            self._condition.notify()
+
+    def _compact(self):
+        """Frees the full queue from superseded messages and, if that's not enough, from the oldest other than a
+        coalescing one. The latest message of a coalescing topic, e.g. the current realtime state, is never dropped,
+        the queue rather grows beyond its size."""
+        self.queue = deque(message for message in self.queue if not message.superseded)
+        if len(self.queue) < self.queue_size:
+            return
+        for message in self.queue:
+            if not message.coalesce:
+                self.queue.remove(message)
+                self.dropped += 1
+                logger.warning('Publish queue full, dropping %s to %s', message.payload, message.topic)
+                return
+        logger.warning('Publish queue exceeds its size %s', self.queue_size)
+
+    def notify_connected(self):
+        """To be called from on_connect, so waiting messages are replayed right away."""
+        with self._condition:
+            self._condition.notify()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self.queue and not (self._has_backlog() and self.client.is_connected()):
+                    self._condition.wait(RETRY_INTERVAL if self._has_backlog() else None)
+                messages = [message for message in self.queue if not message.superseded]
+                self.queue.clear()
+                self.pending_by_topic.clear()
+            self._deliver(messages)
+
+    def _deliver(self, messages):
+        # While the broker is unreachable the older messages aren't touched, the new ones are only appended to them
+        if self._has_backlog() and not (self.client.is_connected() and self._replay()):
+            self._hold(messages)
+            return
+        for index, message in enumerate(messages):
+            if not self._send(message):
+                self._hold(messages[index:])
+                return
+
+    def _send(self, message: PendingMessage) -> bool:
+        if not self.client.is_connected():
+            return False
+        info = self.client.publish(message.topic, message.payload, qos=self.qos, retain=message.retain,
+                                   properties=message.properties)
+        metrics.inc('coop_door_publish_total', rc=info.rc)
+        if info.rc != MQTT_ERR_SUCCESS:
+            logger.warning('Publishing %s to %s failed with rc %s', message.payload, message.topic, info.rc)
+            return False
+        self.published += 1
+        logger.debug('Published %s to %s', message.payload, message.topic)
+        return True
+
+    def _has_backlog(self) -> bool:
+        if self.spool_file:
+            return os.path.exists(self.spool_file)
+        return bool(self.backlog)
+
+    def _read_backlog(self) -> list:
+        if not self.spool_file:
+            return list(self.backlog)
+        messages = []
+        with open(self.spool_file) as spool:
+            for line in spool:
+                try:
+                    messages.append(PendingMessage.from_json(line))
+                except (ValueError, KeyError):
+                    logger.warning('Skipping unreadable line %r of %s', line, self.spool_file)
+        return messages
+
+    def _limit(self, messages) -> list:
+        """messages without the superseded ones and at most the newest spool_size of the rest."""
+        messages = coalesced(messages)
+        if len(messages) > self.spool_size:
+            self.dropped += len(messages) - self.spool_size
+            logger.warning('Dropping %s oldest undelivered messages', len(messages) - self.spool_size)
+            messages = messages[-self.spool_size:]
+        return messages
+
+    def _write_backlog(self, messages):
+        messages = self._limit(messages)
+        self.backlog_size = len(messages)
+        if not self.spool_file:
+            self.backlog = messages
+            return
+        if not messages:
+            if os.path.exists(self.spool_file):
+                os.remove(self.spool_file)
+            return
+        # Written aside and renamed, so a crash never leaves a half written spool
+        spool_tmp = self.spool_file + '.tmp'
+        with open(spool_tmp, 'w') as spool:
+            spool.writelines(message.to_json() + '\n' for message in messages)
+        os.replace(spool_tmp, self.spool_file)
+
+    def _hold(self, messages):
+        """Keeps messages which could not be published behind the older undelivered ones."""
+        if not messages:
+            return
+        self.spooled += len(messages)
+        self.backlog_size += len(messages)
+        if self.spool_file:
+            # A line cut short by a crash is skipped when the spool is read
+            with open(self.spool_file, 'a') as spool:
+                spool.writelines(message.to_json() + '\n' for message in messages)
+        else:
+            self.backlog.extend(messages)
+        if self.backlog_size > 2 * self.spool_size:
+            self._write_backlog(self._read_backlog())
+        logger.info('Holding %s messages until the broker is reachable again', len(messages))
+
+    def _replay(self) -> bool:
+        """Publishes the undelivered messages in order, returns whether all of them went out."""
+        backlog = self._limit(self._read_backlog())
+        for index, message in enumerate(backlog):
+            if not self._send(message):
+                self._write_backlog(backlog[index:])
+                return False
+        self._write_backlog([])
+        logger.info('Replayed %s held messages', len(backlog))
+        return True
+
+    def stats(self) -> str:
+        return (f'Publisher: published {self.published}, coalesced {self.coalesced}, held {self.spooled}, '
+                f'dropped {self.dropped}')
+
+
+def create_publisher(cfg, client) -> MqttPublisher:
+    publisher = MqttPublisher(
+        client,
+        cfg.get_mqtt_publish_queue_size(),
+        cfg.get_mqtt_publish_spool_file(),
+        cfg.get_mqtt_publish_spool_size(),
+        cfg.get_mqtt_qos()
+    )
+    publisher.start()
+    metrics.gauge('coop_door_publish_queue_depth', lambda: len(publisher.queue))
+    return publisher
@@ -0,0 +1,52 @@
+import logging
+import time
+
+from misc.tracing import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+
+class PressConfirmation:
+    """Confirms a button press by sampling the pin: of samples readings spread over hold_time at least required
+    must be pressed. A ghost press, a short spike on the line, is gone before the window ends, while a real press
+    only waits hold_time instead of a long bounce time."""
+
+    def __init__(self, hold_time: float, samples: int, required: int):
+        if samples and not 0 < required <= samples:
+            raise ValueError(f'Press confirmation needs 0 < required <= samples, got {required} of {samples}')
+        self.hold_time = hold_time
+        self.samples = samples
+        self.required = required
+        self.confirmed = 0
+        self.rejected = 0
+        # Time from the press to its confirmation, the latency added to every press
+        self.latency = LatencyHistogram()
+
+    @property
+    def enabled(self) -> bool:
+        return self.samples > 0
+
+    def confirm(self, button, pressed_at_ns: int) -> bool:
+        if not self.enabled:
+            return True
+        interval = self.hold_time / (self.samples - 1) if self.samples > 1 else 0
+        pressed = 0
+        for sample in range(self.samples):
+            if sample:
+                time.sleep(interval)
+            if button.is_pressed:
+                pressed += 1
+            elif self.samples - sample - 1 < self.required - pressed:
+                # Not enough samples left to reach required
+                break
+        if pressed >= self.required:
+            self.confirmed += 1
+            self.latency.observe((time.monotonic_ns() - pressed_at_ns) / 1e9)
+            return True
+        self.rejected += 1
+        logger.debug('Rejected press with %s of %s samples pressed', pressed, self.samples)
+        return False
+
+    def format(self) -> str:
+        return (f'Press confirmation: confirmed {self.confirmed}, rejected {self.rejected}, '
+                f'latency {self.latency.format()}')
@@ -0,0 +1,160 @@
+import logging
+import os
+import threading
+import time
+
+# Frequency of the motor PWM in Hz
+PWM_FREQUENCY = 100
+# Time udev may take to hand an exported sysfs PWM channel to the gpio group
+SYSFS_EXPORT_TIMEOUT = 2.0
+
+logger = logging.getLogger(__name__)
+
+
+class OnDemandPWM:
+    """PWM of RPi.GPIO, or its virtual stand-in, which only runs while the duty cycle is above 0.
+
+    RPi.GPIO toggles a software PWM pin from a thread of its own for as long as the PWM is started, also at 0%. Here
+    the PWM is stopped at 0% and the pin held LOW instead, so a standing motor causes no wakeups. Has the start,
+    ChangeDutyCycle and stop methods of RPi.GPIO's PWM, so a MotionRun can drive it the same way."""
+
+    def __init__(self, gpio, pin: int, frequency: float = PWM_FREQUENCY):
+        self.gpio = gpio
+        self.pin = pin
+        self.frequency = frequency
+        self.duty_cycle = 0
+        self.running = False
+        # Number of times the PWM was started and the seconds it ran, without the current run
+        self.starts = 0
+        self.running_seconds = 0.0
+        self._started_at = None
+        self._pwm = None
+        # Duty cycle changes come from the Mqtt network thread and from the MotionRun thread
+        self._lock = threading.Lock()
+        gpio.setup(pin, gpio.OUT, initial=gpio.LOW)
+
+    def start(self, duty_cycle: float):
+        self.ChangeDutyCycle(duty_cycle)
+
+    def ChangeDutyCycle(self, duty_cycle: float):
+        with self._lock:
+            if duty_cycle > 0:
+                if self.running:
+                    self._pwm.ChangeDutyCycle(duty_cycle)
+                else:
+                    self._start(duty_cycle)
+            else:
+                self._stop()
+                self.gpio.output(self.pin, self.gpio.LOW)
+            self.duty_cycle = duty_cycle
+
+    def _start(self, duty_cycle: float):
+        if self._pwm is None:
+            self._pwm = self.gpio.PWM(self.pin, self.frequency)
+        else:
+            # A stopped PWM of RPi.GPIO may come back with its default frequency
+            self._pwm.ChangeFrequency(self.frequency)
+        self._pwm.start(duty_cycle)
+        self.running = True
+        self.starts += 1
+        self._started_at = time.monotonic()
+
+    def _stop(self):
+        if not self.running:
+            return
+        self._pwm.stop()
+        self.running = False
+        self.running_seconds += time.monotonic() - self._started_at
+        self._started_at = None
+
+    def stop(self):
+        with self._lock:
+            self._stop()
+            self.duty_cycle = 0
+
+    def close(self):
+        """Stops the PWM and frees the pin."""
+        self.stop()
+        self._pwm = None
+        self.gpio.cleanup([self.pin])
+
+    def format(self) -> str:
+        running_seconds = self.running_seconds
+        if self.running:
+            running_seconds += time.monotonic() - self._started_at
+        return (f'software PWM on pin {self.pin}: {"running" if self.running else "stopped"}, '
+                f'{self.starts} starts, ran {running_seconds:.1f}s')
+
+
+class SysfsPWM:
+    """Hardware PWM channel of the SoC through /sys/class/pwm, enabled only while the duty cycle is above 0.
+
+    The pulses are timed by the PWM peripheral, so they don't jitter with the CPU load and need no thread at all. The
+    pin must be switched to its PWM function by the pwm overlay, e.g. dtoverlay=pwm,pin=18,func=2 in config.txt, and
+    is not touched through RPi.GPIO."""
+
+    def __init__(self, chip_path: str, channel: int, frequency: float = PWM_FREQUENCY):
+        self.chip_path = chip_path
+        self.channel = channel
+        self.path = os.path.join(chip_path, f'pwm{channel}')
+        self.period_ns = int(1e9 / frequency)
+        self.duty_cycle = 0
+        self.running = False
+        self.starts = 0
+        self._lock = threading.Lock()
+        self._export()
+        # The duty cycle must never exceed the period, so it is set to 0 before the period
+        self._write('duty_cycle', 0)
+        self._write('period', self.period_ns)
+
+    def _export(self):
+        if os.path.isdir(self.path):
+            return
+        with open(os.path.join(self.chip_path, 'export'), 'w') as export:
+            export.write(str(self.channel))
+        deadline = time.monotonic() + SYSFS_EXPORT_TIMEOUT
+        while not os.access(os.path.join(self.path, 'enable'), os.W_OK):
+            if time.monotonic() > deadline:
+                raise OSError(f'PWM channel {self.path} not writable after export')
+            time.sleep(0.05)
+        logger.info('Exported PWM channel %s', self.path)
+
+    def _write(self, name: str, value: int):
+        with open(os.path.join(self.path, name), 'w') as attribute:
+            attribute.write(str(value))
+
+    def start(self, duty_cycle: float):
+        self.ChangeDutyCycle(duty_cycle)
+
+    def ChangeDutyCycle(self, duty_cycle: float):
+        with self._lock:
+            if duty_cycle > 0:
+                self._write('duty_cycle', int(self.period_ns * min(duty_cycle, 100) / 100))
+                if not self.running:
+                    self._write('enable', 1)
+                    self.running = True
+                    self.starts += 1
+            else:
+                self._stop()
+            self.duty_cycle = duty_cycle
+
+    def _stop(self):
+        if self.running:
+            self._write('enable', 0)
+            self.running = False
+        self._write('duty_cycle', 0)
+
+    def stop(self):
+        with self._lock:
+            self._stop()
+            self.duty_cycle = 0
+
+    def close(self):
+        """Stops the PWM and unexports the channel."""
+        self.stop()
+        with open(os.path.join(self.chip_path, 'unexport'), 'w') as unexport:
+            unexport.write(str(self.channel))
+
+    def format(self) -> str:
+        return (f'hardware PWM {self.path}: {"running" if self.running else "stopped"}, '
+                f'{self.starts} starts')
@@ -0,0 +1,123 @@
+import atexit
+import copy
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+_STOP = object()
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """Puts records on the queue with only their message resolved, so the calling GPIO callback or Mqtt network
+    thread doesn't pay for formatting the time, the format string and the traceback, which the writer thread does.
+    The message is resolved here, as arguments like the door state can change before the writer gets to them."""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class BurstAggregator:
+    """Rate limits repeated log events. Up to burst_limit records with the same level and message are passed per
+    burst_window seconds, further ones are only counted and summarized once the window is over, e.g.
+    'Realtime state changed from RUNNING to OPEN (x37 in 120 ms)'. Records of the same template with other arguments
+    aren't repeats and pass."""
+
+    def __init__(self, burst_limit: int, burst_window: float):
+        self.burst_limit = burst_limit
+        self.burst_window = burst_window
+        # key -> [window start, records in window, last suppressed record, time of last suppressed record], in the
+        # order of the window start, so expire only needs to look at the oldest windows
+        self._windows = {}
+
+    def add(self, record) -> list:
+        """Returns the records to write for the given record, which may include a summary of an older burst."""
+        key = (record.levelno, record.getMessage())
+        window = self._windows.get(key)
+        if window is None or record.created - window[0] >= self.burst_window:
+            records = [self._summary(window)] if window and window[2] else []
+            # Removed first so the new window moves to the end
+            self._windows.pop(key, None)
+            self._windows[key] = [record.created, 1, None, None]
+            records.append(record)
+            return records
+
+        window[1] += 1
+        if window[1] <= self.burst_limit:
+            return [record]
+        window[2] = record
+        window[3] = record.created
+        return []
+
+    def expire(self, now: float) -> list:
+        """Removes the windows which are over and returns the summaries of their suppressed records."""
+        records = []
+        while self._windows:
+            key, window = next(iter(self._windows.items()))
+            if now - window[0] < self.burst_window:
+                break
+            if window[2]:
+                records.append(self._summary(window))
+            del self._windows[key]
+        return records
+
+    def _summary(self, window):
+        started, count, record, last = window
+        suppressed = count - self.burst_limit
+        summary = logging.makeLogRecord(record.__dict__)
+        summary.msg = f'{record.getMessage()} (x{suppressed} in {(last - started) * 1000:.0f} ms)'
+        summary.args = None
+        return summary
+
+
+class QueuedLogWriter(threading.Thread):
+    """Background thread writing the queued records, so slow SD card writes never delay the caller."""
+
+    def __init__(self, log_queue: queue.SimpleQueue, handler: logging.Handler, aggregator: BurstAggregator):
+        super().__init__(name='log-writer', daemon=True)
+        self.log_queue = log_queue
+        self.handler = handler
+        self.aggregator = aggregator
+
+    def run(self):
+        while True:
+            try:
+                record = self.log_queue.get(timeout=self.aggregator.burst_window)
+            except queue.Empty:
+                record = None
+            if record is _STOP:
+                self._write(self.aggregator.expire(float('inf')))
+                self.handler.close()
+                return
+            if record:
+                self._write(self.aggregator.add(record))
+            self._write(self.aggregator.expire(time.time()))
+
+    def _write(self, records):
+        for record in records:
+            self.handler.handle(record)
+
+    def stop(self):
+        self.log_queue.put(_STOP)
+        self.join()
+
+
+def setup_queued_logging(logfile: str, message_format: str, date_time_format: str, level: str,
+                         burst_limit: int, burst_window: float) -> QueuedLogWriter:
+    """Logs to logfile through a background writer thread with rate limiting of repeated events."""
+    log_handler = logging.handlers.WatchedFileHandler(logfile)
+    log_handler.setFormatter(logging.Formatter(message_format, date_time_format))
+
+    log_queue = queue.SimpleQueue()
+    writer = QueuedLogWriter(log_queue, log_handler, BurstAggregator(burst_limit, burst_window))
+    writer.start()
+    atexit.register(writer.stop)
+
+    logger = logging.getLogger()
+    logger.addHandler(LazyQueueHandler(log_queue))
+    logger.setLevel(level)
+    return writer
@@ -0,0 +1,198 @@
+import calendar
+import datetime as dt
+import logging
+import math
+import os
+import struct
+import threading
+import time
+from array import array
+
+# Sun altitude of the civil dawn and dusk in degrees
+CIVIL_TWILIGHT_ALTITUDE = -6.0
+
+# Cache file header: magic, year, latitude, longitude, open offset, close offset, open not before, open from,
+# open until; the table of the year follows
+CACHE_MAGIC = b'COOPSUN1'
+CACHE_HEADER = struct.Struct('<8sHdd5i')
+NO_TIME = -1
+
+logger = logging.getLogger(__name__)
+
+
+def parse_minutes(value) -> int:
+    """Minutes after midnight of 'HH:MM' or NO_TIME for None."""
+    if value is None:
+        return NO_TIME
+    hours, minutes = value.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+def days_in_year(year: int) -> int:
+    return 366 if calendar.isleap(year) else 365
+
+
+def civil_twilight(date: dt.date, latitude: float, longitude: float):
+    """UTC timestamps of civil dawn and dusk of date (NOAA approximation, about one minute off).
+
+    In polar summer dawn and dusk are midnight and the next midnight, in polar winter both are noon."""
+    day_of_year = date.timetuple().tm_yday
+    gamma = 2 * math.pi / 365 * (day_of_year - 1)
+    equation_of_time = 229.18 * (0.000075 + 0.001868 * math.cos(gamma) - 0.032077 * math.sin(gamma)
+                                 - 0.014615 * math.cos(2 * gamma) - 0.040849 * math.sin(2 * gamma))
+    declination = (0.006918 - 0.399912 * math.cos(gamma) + 0.070257 * math.sin(gamma)
+                   - 0.006758 * math.cos(2 * gamma) + 0.000907 * math.sin(2 * gamma)
+                   - 0.002697 * math.cos(3 * gamma) + 0.00148 * math.sin(3 * gamma))
+    latitude_rad = math.radians(latitude)
+    cos_hour_angle = ((math.sin(math.radians(CIVIL_TWILIGHT_ALTITUDE)) - math.sin(latitude_rad) * math.sin(declination))
+                      / (math.cos(latitude_rad) * math.cos(declination)))
+    midnight = calendar.timegm(date.timetuple())
+    noon_minutes = 720 - 4 * longitude - equation_of_time
+    if cos_hour_angle <= -1:
+        return midnight, midnight + 86400
+    if cos_hour_angle >= 1:
+        return midnight + int(noon_minutes * 60), midnight + int(noon_minutes * 60)
+    hour_angle = math.degrees(math.acos(cos_hour_angle))
+    return midnight + int((noon_minutes - 4 * hour_angle) * 60), midnight + int((noon_minutes + 4 * hour_angle) * 60)
+
+
+class Schedule:
+    """Opening window of every local day of a year as timestamps, so whether opening is allowed is one table lookup.
+
+    With latitude and longitude the window starts open_offset minutes after civil dawn, but not before
+    open_not_before, and ends close_offset minutes after civil dusk. Without them it's open_from to open_until."""
+
+    def __init__(self, latitude: float, longitude: float, open_offset: int, close_offset: int, open_not_before: str,
+                 open_from: str, open_until: str, cache_file: str = None):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.solar = latitude is not None and longitude is not None
+        self.open_offset = open_offset
+        self.close_offset = close_offset
+        self.open_not_before = parse_minutes(open_not_before)
+        self.open_from = parse_minutes(open_from)
+        self.open_until = parse_minutes(open_until)
+        self.cache_file = cache_file
+        self.year = None
+        # open at and close at of each day, index 2 * (day of year - 1)
+        self.table = array('q')
+        self._lock = threading.Lock()
+
+    def _key(self, year: int) -> bytes:
+        return CACHE_HEADER.pack(
+            CACHE_MAGIC, year, self.latitude or 0.0, self.longitude or 0.0, self.open_offset, self.close_offset,
+            self.open_not_before, self.open_from, self.open_until
+        )
+
+    def _local_timestamp(self, date: dt.date, minutes: int) -> int:
+        return int(time.mktime((date.year, date.month, date.day, minutes // 60, minutes % 60, 0, 0, 0, -1)))
+
+    def _compute(self, year: int) -> array:
+        table = array('q')
+        date = dt.date(year, 1, 1)
+        while date.year == year:
+            if self.solar:
+                dawn, dusk = civil_twilight(date, self.latitude, self.longitude)
+                open_at = dawn + self.open_offset * 60
+                if self.open_not_before != NO_TIME:
+                    open_at = max(open_at, self._local_timestamp(date, self.open_not_before))
+                close_at = max(open_at, dusk + self.close_offset * 60)
+            else:
+                open_at = self._local_timestamp(date, self.open_from)
+                close_at = self._local_timestamp(date, self.open_until)
+            table.extend((open_at, close_at))
+            date += dt.timedelta(days=1)
+        return table
+
+    def _load(self, year: int):
+        key = self._key(year)
+        if self.cache_file and os.path.exists(self.cache_file):
+            with open(self.cache_file, 'rb') as cache:
+                if cache.read(len(key)) == key:
+                    table = array('q')
+                    try:
+                        table.frombytes(cache.read())
+                    except ValueError:
+                        pass
+                    # A cache cut short, e.g. by a power loss while writing, is computed again
+                    if len(table) == 2 * days_in_year(year):
+                        self.table, self.year = table, year
+                        return
+        table = self._compute(year)
+        if self.cache_file:
+            # Written aside and renamed, so a crash never leaves a half written cache
+            cache_tmp = self.cache_file + '.tmp'
+            with open(cache_tmp, 'wb') as cache:
+                cache.write(key)
+                table.tofile(cache)
+            os.replace(cache_tmp, self.cache_file)
+            logger.info('Computed opening windows of %s into %s', year, self.cache_file)
+        self.table, self.year = table, year
+
+    def window(self, now: float = None):
+        """Opening window (open at, close at) of the local day of now."""
+        now = time.time() if now is None else now
+        local = time.localtime(now)
+        if local.tm_year != self.year:
+            with self._lock:
+                if local.tm_year != self.year:
+                    self._load(local.tm_year)
+        index = 2 * (local.tm_yday - 1)
+        return self.table[index], self.table[index + 1]
+
+    def opening_allowed(self, now: float = None) -> bool:
+        now = time.time() if now is None else now
+        open_at, close_at = self.window(now)
+        return open_at <= now < close_at
+
+    def next_event(self, now: float = None):
+        """Timestamp and kind ('open' or 'close') of the next window boundary after now."""
+        now = time.time() if now is None else now
+        for day in range(3):
+            open_at, close_at = self.window(now + day * 86400)
+            for timestamp, kind in ((open_at, 'open'), (close_at, 'close')):
+                if timestamp > now and open_at != close_at:
+                    return timestamp, kind
+        return None
+
+
+class ScheduleRunner(threading.Thread):
+    """Calls on_open and on_close at the boundaries of the opening window, either of them may be None."""
+
+    # Longest sleep, so clock changes are noticed
+    MAX_SLEEP = 60
+
+    def __init__(self, schedule: Schedule, on_open, on_close):
+        super().__init__(name='schedule', daemon=True)
+        self.schedule = schedule
+        self.callbacks = {'open': on_open, 'close': on_close}
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            event = self.schedule.next_event()
+            if event is None:
+                self._stopped.wait(self.MAX_SLEEP)
+                continue
+            timestamp, kind = event
+            if self._stopped.wait(min(self.MAX_SLEEP, max(0.0, timestamp - time.time()))):
+                return
+            if time.time() >= timestamp and self.callbacks[kind]:
+                logger.info('Scheduled %s at %s', kind, time.strftime('%H:%M', time.localtime(timestamp)))
+                self.callbacks[kind]()
+
+    def stop(self):
+        self._stopped.set()
+
+
+def create_schedule(cfg) -> Schedule:
+    return Schedule(
+        cfg.get_schedule_latitude(),
+        cfg.get_schedule_longitude(),
+        cfg.get_schedule_open_offset(),
+        cfg.get_schedule_close_offset(),
+        cfg.get_schedule_open_not_before(),
+        cfg.get_schedule_open_from(),
+        cfg.get_schedule_open_until(),
+        cfg.get_schedule_cache_file()
+    )
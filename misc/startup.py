@@ -0,0 +1,72 @@
+import logging
+import os
+import threading
+import time
+
+from misc.metrics import metrics
+from misc.systemd import notify_ready
+
+logger = logging.getLogger(__name__)
+
+# Phases of a start, in the order they are reported
+PHASE_IMPORTS = 'imports'
+PHASE_CONFIG = 'config'
+PHASE_GPIO = 'gpio'
+PHASE_CONNECT = 'connect'
+PHASE_SUBSCRIBE = 'subscribe'
+PHASE_READY = 'ready'
+PHASES = (PHASE_IMPORTS, PHASE_CONFIG, PHASE_GPIO, PHASE_CONNECT, PHASE_SUBSCRIBE, PHASE_READY)
+
+
+def process_started_ns() -> int:
+    """time.monotonic_ns() of the start of the process, so the interpreter start counts as well.
+
+    Falls back to now, where /proc isn't available."""
+    now_ns = time.monotonic_ns()
+    try:
+        with open('/proc/self/stat') as stat:
+            # The command in field 2 may contain spaces, the start time is field 22 in clock ticks since boot
+            start_ticks = int(stat.read().rsplit(')', 1)[1].split()[19])
+        age_ns = time.clock_gettime_ns(time.CLOCK_BOOTTIME) - start_ticks * 10 ** 9 // os.sysconf('SC_CLK_TCK')
+        return now_ns - max(0, age_ns)
+    except (OSError, ValueError, IndexError, AttributeError):
+        return now_ns
+
+
+class StartupTimer:
+    """Time of each phase of the start since the process started. Once all required phases are done, systemd is
+    notified that the script is ready and the timings are logged.
+
+    The phases run in parallel, e.g. the Mqtt connect while the GPIOs are set up, so each is reported as the time it
+    was done, not as a duration."""
+
+    def __init__(self, script_name: str, required):
+        self.script_name = script_name
+        self.started_ns = process_started_ns()
+        self.required = set(required)
+        self.done = {}
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return PHASE_READY in self.done
+
+    def mark(self, phase: str):
+        """Marks phase as done, only its first time counts, e.g. not the connect after a reconnect."""
+        with self._lock:
+            if phase in self.done:
+                return
+            seconds = self.done[phase] = (time.monotonic_ns() - self.started_ns) / 1e9
+            ready = not self.ready and self.required.issubset(self.done)
+            if ready:
+                self.done[PHASE_READY] = seconds
+        metrics.gauge('coop_door_startup_seconds', lambda: seconds, script=self.script_name, phase=phase)
+        if not ready:
+            return
+        metrics.gauge('coop_door_startup_seconds', lambda: seconds, script=self.script_name, phase=PHASE_READY)
+        logger.info('Started: %s', self.format())
+        notify_ready(f'Ready after {self.done[PHASE_READY]:.2f}s')
+
+    def format(self) -> str:
+        done = ', '.join(f'{phase} {self.done[phase]:.3f}s' for phase in PHASES if phase in self.done)
+        return f'Startup since process start: {done or "nothing done yet"}'
@@ -0,0 +1,115 @@
+import json
+import re
+import threading
+import time
+from collections import namedtuple
+
+PAYLOAD_VERSION = 1
+# Structured payloads go to this subtopic of the state and realtime state topics, the topics themselves keep the plain
+# state names for the existing consumers
+STRUCTURED_TOPIC_SUFFIX = '/v1'
+
+# Why a state was published
+CAUSE_OPEN_SENSOR = 'open_sensor'
+CAUSE_CLOSED_SENSOR = 'closed_sensor'
+CAUSE_SENSORS_RELEASED = 'sensors_released'
+CAUSE_RESYNC = 'resync'
+CAUSE_BUTTON = 'button'
+CAUSE_SCHEDULE = 'schedule'
+CAUSE_WATCHDOG = 'watchdog'
+
+# Verdicts of StateOrdering.check
+STATE_ACCEPTED = 'accepted'
+STATE_OUT_OF_ORDER = 'out of order'
+STATE_STALE = 'stale'
+
+# door: door id, source: publishing script, epoch: start of the publisher in ms since 1970, telling its runs apart, as
+# their sequence numbers restart at 1, seq: per topic and publisher, timestamp_ms: time the state was captured in ms
+# since 1970
+StatePayload = namedtuple('StatePayload', ['door', 'source', 'epoch', 'seq', 'timestamp_ms', 'state', 'cause'])
+
+# The layout StateEncoder writes, so the own payloads are decoded without the json parser
+_PAYLOAD_PATTERN = re.compile(
+    r'\{"v":1,"door":"((?:[^"\\]|\\.)*)","src":"(\w+)","epoch":(\d+),"seq":(\d+),"ts":(\d+),'
+    r'"state":"(\w+)","cause":"(\w*)"\}'
+)
+
+
+def wall_time_ms(monotonic_ns: int = None) -> int:
+    """Milliseconds since 1970 of monotonic_ns or of now."""
+    now_ns = time.time_ns()
+    if monotonic_ns is not None:
+        now_ns -= time.monotonic_ns() - monotonic_ns
+    return now_ns // 10 ** 6
+
+
+class StateEncoder:
+    """Numbers the structured payloads one script publishes, per topic."""
+
+    def __init__(self, source: str):
+        self.source = source
+        self.epoch = wall_time_ms()
+        self._seqs = {}
+        self._lock = threading.Lock()
+
+    def encode(self, topic: str, door: str, state: str, cause: str, detected_at_ns: int = None) -> str:
+        with self._lock:
+            seq = self._seqs[topic] = self._seqs.get(topic, 0) + 1
+        return json.dumps({
+            'v': PAYLOAD_VERSION, 'door': door, 'src': self.source, 'epoch': self.epoch, 'seq': seq,
+            'ts': wall_time_ms(detected_at_ns), 'state': state, 'cause': cause
+        }, separators=(',', ':'))
+
+
+def decode_state(payload: str):
+    """Returns the StatePayload of payload or None, if it isn't a structured payload of a known version."""
+    match = _PAYLOAD_PATTERN.fullmatch(payload)
+    if match:
+        door, source, epoch, seq, timestamp_ms, state, cause = match.groups()
+        if '\\' in door:
+            door = json.loads(f'"{door}"')
+        return StatePayload(door, source, int(epoch), int(seq), int(timestamp_ms), state, cause)
+    # Other producers may order or space the keys differently
+    try:
+        values = json.loads(payload)
+        if values.get('v') != PAYLOAD_VERSION:
+            return None
+        return StatePayload(values['door'], values['src'], int(values['epoch']), int(values['seq']),
+                            int(values['ts']), values['state'], values.get('cause', ''))
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+class StateOrdering:
+    """Last sequence number seen per door and publisher, so older messages are recognized, e.g. a retained state
+    arriving after a newer one or a message redelivered after a reconnect, and gaps are counted. A new epoch of a
+    publisher starts its sequence over."""
+
+    def __init__(self, max_age: float):
+        self.max_age = max_age
+        self.gaps = 0
+        self.out_of_order = 0
+        self.stale = 0
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def check(self, door_id: str, payload: StatePayload) -> str:
+        key = (door_id, payload.source)
+        with self._lock:
+            last = self._last.get(key)
+            # Another epoch is a restarted publisher, whose epoch may even be older, e.g. on a Pi without RTC booting
+            # with an earlier clock, so only the sequence numbers within an epoch are compared
+            if last is not None and payload.epoch == last[0]:
+                if payload.seq <= last[1]:
+                    self.out_of_order += 1
+                    return STATE_OUT_OF_ORDER
+                if payload.seq > last[1] + 1:
+                    self.gaps += payload.seq - last[1] - 1
+            self._last[key] = (payload.epoch, payload.seq)
+            if self.max_age and wall_time_ms() - payload.timestamp_ms > self.max_age * 1000:
+                self.stale += 1
+                return STATE_STALE
+        return STATE_ACCEPTED
+
+    def format(self) -> str:
+        return f'State messages: {self.gaps} missed, {self.out_of_order} out of order, {self.stale} stale'
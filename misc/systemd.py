@@ -0,0 +1,37 @@
+import logging
+import os
+import socket
+
+logger = logging.getLogger(__name__)
+
+
+def notify(*states: str) -> bool:
+    """Sends states like 'READY=1' to systemd over $NOTIFY_SOCKET, see sd_notify(3).
+
+    Without the variable, e.g. when started from a shell or with Type=simple, nothing is sent and False returned."""
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return False
+    if address.startswith('@'):
+        # Abstract namespace socket
+        address = '\0' + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC) as sock:
+            sock.connect(address)
+            sock.sendall('\n'.join(states).encode())
+        return True
+    except OSError as err:
+        logger.warning('Notifying systemd failed: %s', err)
+        return False
+
+
+def notify_ready(status: str = None) -> bool:
+    return notify('READY=1', f'STATUS={status}') if status else notify('READY=1')
+
+
+def notify_status(status: str) -> bool:
+    return notify(f'STATUS={status}')
+
+
+def notify_stopping() -> bool:
+    return notify('STOPPING=1')
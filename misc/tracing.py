@@ -0,0 +1,134 @@
+import bisect
+import logging
+import os
+import signal
+import threading
+import time
+from collections import namedtuple
+
+STAGE_PRESS_TO_PUBLISH = 'press_to_publish'
+STAGE_PUBLISH_TO_GPIO_HIGH = 'publish_to_gpio_high'
+STAGE_GPIO_HIGH_TO_END_STOP = 'gpio_high_to_end_stop'
+STAGE_END_STOP_TO_RESET_PINS = 'end_stop_to_reset_pins'
+
+# Mqtt v5 user properties carrying the trace through the broker
+TRACE_ID_PROPERTY = 'trace_id'
+TRACE_TIMESTAMP_PROPERTY = 'trace_ns'
+
+# Upper bounds of the histogram buckets in seconds, the last bucket takes everything above
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+logger = logging.getLogger(__name__)
+
+# timestamp_ns is time.monotonic_ns() of the hop, which is comparable between processes on the same host
+TraceContext = namedtuple('TraceContext', ['trace_id', 'timestamp_ns'])
+
+
+class LatencyHistogram:
+    """Fixed bucket latency histogram, cheap enough to be updated from callback threads."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def snapshot(self):
+        """Consistent copy of the bucket counts, count and sum."""
+        with self._lock:
+            return list(self.counts), self.count, self.sum
+
+    def format(self) -> str:
+        with self._lock:
+            if not self.count:
+                return 'no samples'
+            buckets = ', '.join(
+                f'<={bound}s: {count}' for bound, count in zip(self.buckets + ('inf',), self.counts) if count
+            )
+            return f'count {self.count}, mean {self.sum / self.count:.4f}s, max {self.max:.4f}s ({buckets})'
+
+
+class Tracer:
+    """Carries trace ids and monotonic timestamps from buttons over the coop door to the sensors and keeps
+    per-stage latency histograms. Traces travel as Mqtt v5 user properties, so the payloads stay unchanged."""
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.stages = {
+            stage: LatencyHistogram() for stage in (
+                STAGE_PRESS_TO_PUBLISH,
+                STAGE_PUBLISH_TO_GPIO_HIGH,
+                STAGE_GPIO_HIGH_TO_END_STOP,
+                STAGE_END_STOP_TO_RESET_PINS
+            )
+        }
+
+    @staticmethod
+    def start_trace(timestamp_ns: int = None) -> TraceContext:
+        return TraceContext(os.urandom(8).hex(), timestamp_ns or time.monotonic_ns())
+
+    def properties(self, trace: TraceContext):
+        """Publish properties for the given trace or None, when tracing is disabled."""
+        if not self.enabled or trace is None:
+            return None
+
+        from paho.mqtt.packettypes import PacketTypes
+        from paho.mqtt.properties import Properties
+
+        properties = Properties(PacketTypes.PUBLISH)
+        properties.UserProperty = [
+            (TRACE_ID_PROPERTY, trace.trace_id),
+            (TRACE_TIMESTAMP_PROPERTY, str(trace.timestamp_ns))
+        ]
+        return properties
+
+    def from_message(self, message):
+        """The trace a received message carries or None."""
+        if not self.enabled or message.properties is None:
+            return None
+
+        user_properties = dict(getattr(message.properties, 'UserProperty', None) or [])
+        if TRACE_ID_PROPERTY not in user_properties or TRACE_TIMESTAMP_PROPERTY not in user_properties:
+            return None
+        try:
+            return TraceContext(user_properties[TRACE_ID_PROPERTY], int(user_properties[TRACE_TIMESTAMP_PROPERTY]))
+        except ValueError:
+            return None
+
+    def record(self, stage: str, start_ns: int, end_ns: int, trace_id: str = None):
+        if not self.enabled or start_ns is None or end_ns is None:
+            return
+        seconds = (end_ns - start_ns) / 1e9
+        self.stages[stage].observe(seconds)
+        logger.debug('Trace %s: %s took %.4fs', trace_id, stage, seconds)
+
+    def dump(self) -> str:
+        return '\n'.join(f'{stage}: {histogram.format()}' for stage, histogram in self.stages.items())
+
+    def install_dump_handler(self, *extra_dumps, signum=signal.SIGUSR1):
+        """Logs the latency histograms whenever the process receives signum, e.g. by kill -USR1 <pid>.
+        extra_dumps are callables returning further statistics of the script to be logged with them."""
+        def dump(received, frame):
+            logger.info('Latency histograms:\n%s', self.dump())
+            for extra_dump in extra_dumps:
+                logger.info('%s', extra_dump())
+
+        signal.signal(signum, dump)
+
+
+def create_tracer(cfg) -> Tracer:
+    enabled = cfg.get_tracing_enabled()
+    if enabled and cfg.get_mqtt_protocol() != '5':
+        raise ValueError('Tracing needs mqtt protocol 5 to carry the traces as user properties')
+    return Tracer(enabled)
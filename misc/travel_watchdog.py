@@ -0,0 +1,115 @@
+import json
+import logging
+import math
+import os
+import threading
+
+from misc.file_writer import file_writer
+
+logger = logging.getLogger(__name__)
+
+
+class TravelStatistics:
+    """Mean and variance of the travel time of one door and direction, updated with Welford's algorithm, so every
+    completed run counts in constant memory."""
+
+    __slots__ = ('count', 'mean', 'm2')
+
+    def __init__(self, count: int = 0, mean: float = 0.0, m2: float = 0.0):
+        self.count = count
+        self.mean = mean
+        # Sum of the squared differences from the mean
+        self.m2 = m2
+
+    def update(self, seconds: float):
+        self.count += 1
+        delta = seconds - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (seconds - self.mean)
+
+    @property
+    def stddev(self) -> float:
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+    def to_json(self) -> dict:
+        return {'count': self.count, 'mean': self.mean, 'm2': self.m2}
+
+
+class TravelWatchdog:
+    """Bounds the time the motor of a door is driven in one run.
+
+    Learns the travel time per door and direction from every run reaching its end stop. Once min_runs are learned,
+    a run may take the mean plus the larger of margin times the mean and sigmas standard deviations, before that and
+    at most max_travel_time. A run exceeding it stops the motor of its door, see CoopDoorMotor.arm_watchdog, and
+    on_fault is called with the door. The statistics are stored as json by the file writer, so they survive restarts
+    without a stopping motor waiting for the file."""
+
+    def __init__(self, margin: float, sigmas: float, min_runs: int, max_travel_time: float,
+                 statistics_file: str = None):
+        self.margin = margin
+        self.sigmas = sigmas
+        self.min_runs = min_runs
+        self.max_travel_time = max_travel_time
+        self.statistics_file = statistics_file
+        self.on_fault = None
+        self.timeouts = 0
+        self._statistics = {}
+        self._lock = threading.Lock()
+        if statistics_file and os.path.exists(statistics_file):
+            try:
+                with open(statistics_file) as statistics:
+                    for door_id, directions in json.load(statistics).items():
+                        self._statistics[door_id] = {
+                            direction: TravelStatistics(**values) for direction, values in directions.items()
+                        }
+            except (OSError, ValueError, TypeError, AttributeError) as err:
+                self._statistics = {}
+                logger.warning('Starting without travel statistics, %s could not be read: %s', statistics_file, err)
+
+    def statistics(self, door_id: str, direction: str):
+        return self._statistics.get(door_id, {}).get(direction)
+
+    def limit(self, door_id: str, direction: str) -> float:
+        """Seconds a run of door_id in direction may take at most."""
+        statistics = self.statistics(door_id, direction)
+        if statistics is None or statistics.count < self.min_runs:
+            return self.max_travel_time
+        return min(
+            self.max_travel_time,
+            statistics.mean + max(self.margin * statistics.mean, self.sigmas * statistics.stddev)
+        )
+
+    def learn(self, door_id: str, direction: str, seconds: float):
+        with self._lock:
+            self._statistics.setdefault(door_id, {}).setdefault(direction, TravelStatistics()).update(seconds)
+            if self.statistics_file:
+                file_writer().replace(self.statistics_file, json.dumps(
+                    {door_id: {direction: values.to_json() for direction, values in directions.items()}
+                     for door_id, directions in self._statistics.items()}
+                ))
+
+    def fault(self, door):
+        self.timeouts += 1
+        if self.on_fault:
+            self.on_fault(door)
+
+    def format(self) -> str:
+        lines = [f'Travel watchdog: {self.timeouts} timeouts']
+        for door_id, directions in sorted(self._statistics.items()):
+            for direction, statistics in sorted(directions.items()):
+                lines.append(f'{door_id} {direction}: {statistics.count} runs, mean {statistics.mean:.2f}s, '
+                             f'stddev {statistics.stddev:.2f}s, limit {self.limit(door_id, direction):.2f}s')
+        return '\n'.join(lines)
+
+
+def create_travel_watchdog(cfg):
+    """Travel watchdog as configured or None, when it's disabled."""
+    if not cfg.get_coop_door_watchdog_enabled():
+        return None
+    return TravelWatchdog(
+        cfg.get_coop_door_watchdog_margin(),
+        cfg.get_coop_door_watchdog_sigmas(),
+        cfg.get_coop_door_watchdog_min_runs(),
+        cfg.get_coop_door_watchdog_max_travel_time(),
+        cfg.get_coop_door_watchdog_statistics_file()
+    )
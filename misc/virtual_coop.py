@@ -0,0 +1,303 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+
+HIGH = 1
+LOW = 0
+
+# Position of a virtual door, 0.0 is closed and 1.0 is open
+POSITION_CLOSED = 0.0
+POSITION_OPEN = 1.0
+
+
+class VirtualScheduler:
+    """Single thread running the timed events of the virtual coop, e.g. door arrivals and reed sensor bounces."""
+
+    def __init__(self):
+        self._queue = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='virtual-coop', daemon=True)
+        self._thread.start()
+
+    def call_at(self, when: float, callback, *args) -> list:
+        event = [when, next(self._counter), callback, args]
+        with self._condition:
+            heapq.heappush(self._queue, event)
+            self._condition.notify()
+        return event
+
+    def call_later(self, delay: float, callback, *args) -> list:
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    @staticmethod
+    def cancel(event: list):
+        # Cancelled events stay in the heap and are skipped when due
+        event[2] = None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue or self._queue[0][0] > time.monotonic():
+                    timeout = self._queue[0][0] - time.monotonic() if self._queue else None
+                    self._condition.wait(timeout)
+                _, _, callback, args = heapq.heappop(self._queue)
+            if callback:
+                callback(*args)
+
+
+class VirtualInputPin:
+    """Level of a simulated input line; listeners are called on every edge including bounces."""
+
+    def __init__(self, pin: int, level: int = HIGH):
+        self.pin = pin
+        self.level = level
+        self.listeners = []
+
+    def set_level(self, level: int):
+        if level == self.level:
+            return
+        self.level = level
+        for listener in self.listeners:
+            listener(level)
+
+
+class VirtualDoor:
+    """Door driven by the motor pins. It moves at a speed relative to the duty cycle of the speed pin and
+    activates its reed sensors (pulled up, so LOW means active) with bounces when reaching an end stop."""
+
+    def __init__(self, coop, open_pin: int, close_pin: int, speed_pin: int,
+                 opened_sensor: VirtualInputPin = None, closed_sensor: VirtualInputPin = None):
+        self.coop = coop
+        self.open_pin = open_pin
+        self.close_pin = close_pin
+        self.speed_pin = speed_pin
+        self.opened_sensor = opened_sensor
+        self.closed_sensor = closed_sensor
+        self.position = POSITION_CLOSED
+        self.velocity = 0.0
+        self.updated_at = time.monotonic()
+        self._arrival = None
+        if closed_sensor:
+            closed_sensor.level = LOW
+
+    def _integrate(self, now: float):
+        self.position += self.velocity * (now - self.updated_at)
+        self.position = min(POSITION_OPEN, max(POSITION_CLOSED, self.position))
+        self.updated_at = now
+
+    def update_motor(self):
+        coop = self.coop
+        with coop.lock:
+            now = time.monotonic()
+            self._integrate(now)
+            if self._arrival:
+                coop.scheduler.cancel(self._arrival)
+                self._arrival = None
+
+            opening = coop.outputs.get(self.open_pin) == HIGH
+            closing = coop.outputs.get(self.close_pin) == HIGH
+            speed = coop.duty_cycles.get(self.speed_pin, 0) / 100 / coop.travel_time
+            if opening == closing or speed <= 0:
+                self.velocity = 0.0
+                return
+
+            self.velocity = speed if opening else -speed
+            target = POSITION_OPEN if opening else POSITION_CLOSED
+            if self.position == target:
+                return
+
+            # Leaving an end stop releases its reed sensor
+            if self.position == POSITION_CLOSED and self.closed_sensor:
+                coop.bounce(self.closed_sensor, HIGH)
+            elif self.position == POSITION_OPEN and self.opened_sensor:
+                coop.bounce(self.opened_sensor, HIGH)
+
+            arrival_time = now + abs(target - self.position) / speed
+            self._arrival = coop.scheduler.call_at(arrival_time, self._arrive, target)
+
+    def _arrive(self, target: float):
+        coop = self.coop
+        with coop.lock:
+            self._integrate(time.monotonic())
+            self.position = target
+            self._arrival = None
+        sensor = self.opened_sensor if target == POSITION_OPEN else self.closed_sensor
+        if sensor:
+            coop.bounce(sensor, LOW)
+
+
+class VirtualGpio:
+    """Stand-in for the parts of RPi.GPIO used by the coop door scripts."""
+
+    BCM = 'BCM'
+    OUT = 'OUT'
+    IN = 'IN'
+    HIGH = HIGH
+    LOW = LOW
+
+    def __init__(self, coop):
+        self.coop = coop
+        coop_gpio = self
+
+        class PWM:
+            def __init__(self, pin: int, frequency: float):
+                self.pin = pin
+                self.frequency = frequency
+
+            def start(self, duty_cycle: float):
+                coop_gpio.coop.set_duty_cycle(self.pin, duty_cycle)
+
+            def ChangeDutyCycle(self, duty_cycle: float):
+                coop_gpio.coop.set_duty_cycle(self.pin, duty_cycle)
+
+            def ChangeFrequency(self, frequency: float):
+                self.frequency = frequency
+
+            def stop(self):
+                coop_gpio.coop.set_duty_cycle(self.pin, 0)
+
+        self.PWM = PWM
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, enabled):
+        pass
+
+    def setup(self, channels, mode, initial=LOW, pull_up_down=None):
+        if mode != self.OUT:
+            return
+        for channel in channels if isinstance(channels, (list, tuple)) else [channels]:
+            self.coop.set_output(channel, initial)
+
+    def output(self, channel: int, value: int):
+        self.coop.set_output(channel, value)
+
+    def input(self, channel: int) -> int:
+        if channel in self.coop.inputs:
+            return self.coop.inputs[channel].level
+        return self.coop.outputs.get(channel, LOW)
+
+    def cleanup(self, channels=None):
+        if channels is None:
+            channels = list(self.coop.outputs)
+        for channel in channels if isinstance(channels, (list, tuple)) else [channels]:
+            self.coop.set_output(channel, LOW)
+
+
+class VirtualButton:
+    """Stand-in for gpiozero.Button on a virtual input pin, debounced the same way: edges within
+    bounce_time after the last accepted edge are ignored."""
+
+    def __init__(self, coop, pin: int, pull_up: bool = True, bounce_time: float = None):
+        self.coop = coop
+        self.pin = pin
+        self.pull_up = pull_up
+        self.bounce_time = bounce_time
+        self.when_pressed = None
+        self.when_released = None
+        self._input = coop.input_pin(pin)
+        self._last_edge = None
+        self._input.listeners.append(self._on_edge)
+
+    @property
+    def is_pressed(self) -> bool:
+        return (self._input.level == LOW) == self.pull_up
+
+    def _on_edge(self, level: int):
+        now = time.monotonic()
+        if self.bounce_time and self._last_edge is not None and now - self._last_edge < self.bounce_time:
+            return
+        self._last_edge = now
+        callback = self.when_pressed if self.is_pressed else self.when_released
+        if callback:
+            callback()
+
+    def close(self):
+        self._input.listeners.remove(self._on_edge)
+
+
+class VirtualCoop:
+    """Simulated coop hardware: outputs, PWM duty cycles, doors and reed sensors driven in one process.
+
+    travel_time is the time in seconds a door needs from closed to open at 100% duty cycle. Every reed sensor
+    change is followed by bounce_count bounces, bounce_interval seconds apart. Every pin change is recorded with
+    its monotonic timestamp in history, so latencies can be measured without a Raspberry Pi."""
+
+    def __init__(self, travel_time: float = 6.0, bounce_count: int = 3, bounce_interval: float = 0.002,
+                 history_size: int = 10000):
+        self.travel_time = travel_time
+        self.bounce_count = bounce_count
+        self.bounce_interval = bounce_interval
+        self.lock = threading.RLock()
+        self.scheduler = VirtualScheduler()
+        self.outputs = {}
+        self.duty_cycles = {}
+        self.inputs = {}
+        self.doors = []
+        self.history = deque(maxlen=history_size)
+        self.gpio = VirtualGpio(self)
+
+    def input_pin(self, pin: int) -> VirtualInputPin:
+        with self.lock:
+            if pin not in self.inputs:
+                self.inputs[pin] = VirtualInputPin(pin)
+                self.inputs[pin].listeners.append(lambda level, pin=pin: self._record(pin, level))
+            return self.inputs[pin]
+
+    def add_door(self, open_pin: int, close_pin: int, speed_pin: int,
+                 opened_sensor_pin: int = None, closed_sensor_pin: int = None) -> VirtualDoor:
+        door = VirtualDoor(
+            self, open_pin, close_pin, speed_pin,
+            self.input_pin(opened_sensor_pin) if opened_sensor_pin is not None else None,
+            self.input_pin(closed_sensor_pin) if closed_sensor_pin is not None else None
+        )
+        self.doors.append(door)
+        return door
+
+    def button(self, pin: int, pull_up: bool = True, bounce_time: float = None) -> VirtualButton:
+        return VirtualButton(self, pin, pull_up=pull_up, bounce_time=bounce_time)
+
+    def _record(self, pin: int, value):
+        self.history.append((time.monotonic(), pin, value))
+
+    def _doors_on(self, pin: int):
+        return [door for door in self.doors if pin in (door.open_pin, door.close_pin, door.speed_pin)]
+
+    def set_output(self, pin: int, value: int):
+        with self.lock:
+            if self.outputs.get(pin) == value:
+                return
+            self.outputs[pin] = value
+            self._record(pin, value)
+            for door in self._doors_on(pin):
+                door.update_motor()
+
+    def set_duty_cycle(self, pin: int, duty_cycle: float):
+        with self.lock:
+            if self.duty_cycles.get(pin) == duty_cycle:
+                return
+            self.duty_cycles[pin] = duty_cycle
+            self._record(pin, f'{duty_cycle}%')
+            for door in self._doors_on(pin):
+                door.update_motor()
+
+    def bounce(self, sensor: VirtualInputPin, level: int):
+        # Edges are delivered from the scheduler thread, like gpiozero calls back from its own thread
+        other = HIGH if level == LOW else LOW
+        for i in range(2 * self.bounce_count + 1):
+            self.scheduler.call_later(i * self.bounce_interval, sensor.set_level, other if i % 2 else level)
+
+    def press(self, pin: int, hold_time: float = 0.1, delay: float = 0.0):
+        """Scripted button press: the (pulled up) pin goes LOW after delay seconds for hold_time seconds."""
+        sensor = self.input_pin(pin)
+        self.scheduler.call_later(delay, sensor.set_level, LOW)
+        self.scheduler.call_later(delay + hold_time, sensor.set_level, HIGH)
+
+    def script(self, presses):
+        """Schedules several presses given as (delay, pin, hold_time) tuples."""
+        for delay, pin, hold_time in presses:
+            self.press(pin, hold_time=hold_time, delay=delay)
@@ -0,0 +1,280 @@
+import itertools
+import queue
+import threading
+import time
+
+# Messages queued per client before the broker drops new ones, like max_queued_messages of mosquitto
+DEFAULT_MAX_QUEUED = 1000
+# Return codes of paho
+MQTT_ERR_SUCCESS = 0
+MQTT_ERR_NO_CONN = 4
+
+_virtual_broker = None
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    for index, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if index >= len(topic_levels) or (level != '+' and level != topic_levels[index]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class VirtualReasonCode:
+    """Stands in for paho's ReasonCode, compares equal to its value like the real one."""
+
+    def __init__(self, value: int = 0):
+        self.value = value
+        self.is_failure = value >= 0x80
+
+    def __eq__(self, other):
+        return self.value == (other.value if isinstance(other, VirtualReasonCode) else other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'VirtualReasonCode({self.value})'
+
+
+class VirtualConnectFlags:
+
+    def __init__(self, session_present: bool):
+        self.session_present = session_present
+
+
+class VirtualMessage:
+    """Received message with the attributes of paho's MQTTMessage. timestamp is the time.monotonic() of the publish,
+    not of the receipt as in paho, so the queueing in the broker stand-in can be measured. sender is the client id
+    of the publisher, None for retained messages."""
+
+    __slots__ = ('topic', 'payload', 'qos', 'retain', 'mid', 'properties', 'timestamp', 'sender')
+
+    def __init__(self, topic: str, payload: bytes, qos: int, retain: bool, mid: int, properties, timestamp: float,
+                 sender: str = None):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.mid = mid
+        self.properties = properties
+        self.timestamp = timestamp
+        self.sender = sender
+
+
+class VirtualMessageInfo:
+
+    def __init__(self, mid: int, rc: int):
+        self.mid = mid
+        self.rc = rc
+
+    def is_published(self) -> bool:
+        return self.rc == MQTT_ERR_SUCCESS
+
+    def wait_for_publish(self, timeout: float = None):
+        pass
+
+
+class VirtualClient:
+    """In-process stand-in for paho.mqtt.client.Client with the part of its API the scripts use.
+
+    Like paho, every callback runs on the network thread of the client, one after the other, so a slow on_message
+    delays all messages behind it. Messages wait for that thread in a queue of the broker limited to max_queued."""
+
+    def __init__(self, broker, client_id: str):
+        self.broker = broker
+        self.client_id = client_id
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.on_subscribe = None
+        self.on_unsubscribe = None
+        self.on_publish = None
+        self.connected = False
+        self.inbox = queue.Queue()
+        # Messages in the inbox, which also holds connects and subscribes
+        self.queued = 0
+        self.max_queued_seen = 0
+        self._queued_lock = threading.Lock()
+        self._thread = None
+
+    # Configuration calls of paho without an effect here
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def reconnect_delay_set(self, min_delay: float = 1, max_delay: float = 120):
+        pass
+
+    def connect_async(self, host: str = None, port: int = 1883, keepalive: int = 60, **kwargs):
+        self.inbox.put((self._connect, ()))
+
+    def connect(self, host: str = None, port: int = 1883, keepalive: int = 60, **kwargs):
+        self._connect()
+        return 0
+
+    def _connect(self):
+        self.broker.connect(self)
+        self.connected = True
+        self._callback(self.on_connect, VirtualConnectFlags(False), VirtualReasonCode(0), None)
+
+    def is_connected(self) -> bool:
+        return self.connected
+
+    def disconnect(self, *args, **kwargs):
+        self.inbox.put((self._disconnect, ()))
+        return 0
+
+    def _disconnect(self):
+        if self.connected:
+            self.connected = False
+            self.broker.disconnect(self)
+            self._callback(self.on_disconnect, None, VirtualReasonCode(0), None)
+        raise StopIteration
+
+    def subscribe(self, topic: str, qos: int = 0, **kwargs):
+        mid = self.broker.next_mid()
+        self.inbox.put((self._subscribe, (topic, qos, mid)))
+        return 0, mid
+
+    def _subscribe(self, topic: str, qos: int, mid: int):
+        self.broker.subscribe(self, topic)
+        self._callback(self.on_subscribe, mid, [VirtualReasonCode(qos)], None)
+        self.broker.deliver_retained(self, topic)
+
+    def unsubscribe(self, topic: str, **kwargs):
+        mid = self.broker.next_mid()
+        self.broker.unsubscribe(self, topic)
+        return 0, mid
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False, properties=None):
+        if not self.connected:
+            return VirtualMessageInfo(self.broker.next_mid(), MQTT_ERR_NO_CONN)
+        if isinstance(payload, str):
+            payload = payload.encode()
+        mid = self.broker.publish(topic, payload or b'', qos, retain, properties, self.client_id)
+        return VirtualMessageInfo(mid, MQTT_ERR_SUCCESS)
+
+    def deliver(self, message: VirtualMessage) -> bool:
+        """Called by the broker, False when the queue of this client is full."""
+        with self._queued_lock:
+            if self.queued >= self.broker.max_queued:
+                return False
+            self.queued += 1
+            self.max_queued_seen = max(self.max_queued_seen, self.queued)
+        self.inbox.put((self._receive, (message,)))
+        return True
+
+    def _receive(self, message: VirtualMessage):
+        with self._queued_lock:
+            self.queued -= 1
+        started_ns = time.monotonic_ns()
+        self._callback(self.on_message, message)
+        self.broker.delivered(self, message, started_ns, time.monotonic_ns())
+
+    def _callback(self, callback, *args):
+        if callback:
+            callback(self, None, *args)
+
+    def loop_start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.loop_forever, name=f'virtual-mqtt-{self.client_id}',
+                                            daemon=True)
+            self._thread.start()
+
+    def loop_stop(self):
+        if self._thread is not None:
+            self.inbox.put((self._stop, ()))
+            if self._thread is not threading.current_thread():
+                self._thread.join()
+            self._thread = None
+
+    def _stop(self):
+        raise StopIteration
+
+    def loop_forever(self, retry_first_connection: bool = False):
+        while True:
+            work, args = self.inbox.get()
+            try:
+                work(*args)
+            except StopIteration:
+                return
+
+
+class VirtualBroker:
+    """Routes messages between the VirtualClients of one process, keeps retained messages and counts the messages it
+    had to drop. observer, if set, is called with (client, message, started_ns, finished_ns) after each on_message."""
+
+    def __init__(self, max_queued: int = DEFAULT_MAX_QUEUED):
+        self.max_queued = max_queued
+        self.clients = {}
+        self.subscriptions = {}
+        self.retained = {}
+        self.dropped = 0
+        self.observer = None
+        self._mids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def next_mid(self) -> int:
+        return next(self._mids)
+
+    def client(self, client_id: str) -> VirtualClient:
+        return VirtualClient(self, client_id)
+
+    def connect(self, client: VirtualClient):
+        with self._lock:
+            self.clients[client.client_id] = client
+
+    def disconnect(self, client: VirtualClient):
+        with self._lock:
+            self.clients.pop(client.client_id, None)
+            for subscribers in self.subscriptions.values():
+                subscribers.discard(client)
+
+    def subscribe(self, client: VirtualClient, topic_filter: str):
+        with self._lock:
+            self.subscriptions.setdefault(topic_filter, set()).add(client)
+
+    def unsubscribe(self, client: VirtualClient, topic_filter: str):
+        with self._lock:
+            self.subscriptions.get(topic_filter, set()).discard(client)
+
+    def publish(self, topic: str, payload: bytes, qos: int, retain: bool, properties, sender: str = None) -> int:
+        mid = self.next_mid()
+        timestamp = time.monotonic()
+        with self._lock:
+            if retain:
+                if payload:
+                    self.retained[topic] = (payload, qos, properties)
+                else:
+                    self.retained.pop(topic, None)
+            subscribers = {client for topic_filter, clients in self.subscriptions.items()
+                           if topic_matches(topic_filter, topic) for client in clients}
+            for client in subscribers:
+                # Retain is only set for messages delivered because of a new subscription
+                if not client.deliver(VirtualMessage(topic, payload, qos, False, mid, properties, timestamp, sender)):
+                    self.dropped += 1
+        return mid
+
+    def deliver_retained(self, client: VirtualClient, topic_filter: str):
+        with self._lock:
+            retained = [(topic, message) for topic, message in self.retained.items()
+                        if topic_matches(topic_filter, topic)]
+        for topic, (payload, qos, properties) in retained:
+            if not client.deliver(VirtualMessage(topic, payload, qos, True, self.next_mid(), properties,
+                                                 time.monotonic())):
+                self.dropped += 1
+
+    def delivered(self, client: VirtualClient, message: VirtualMessage, started_ns: int, finished_ns: int):
+        observer = self.observer
+        if observer:
+            observer(client, message, started_ns, finished_ns)
+
+
+def get_virtual_broker() -> VirtualBroker:
+    """Returns the broker stand-in shared by all scripts of this process."""
+    global _virtual_broker
+    if _virtual_broker is None:
+        _virtual_broker = VirtualBroker()
+    return _virtual_broker
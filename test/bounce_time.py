@@ -1,8 +1,19 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+"""Finds the best bounce time for the reed sensors.
+
+    python test/bounce_time.py capture [trace file]
+        Closes and opens the door once and records every sensor edge with its timestamp into the trace file.
+
+    python test/bounce_time.py analyze [trace file] [bounce time ...]
+        Evaluates any number of bounce times on the recorded trace, without moving the door again.
+"""
+
+import bisect
+import struct
+import sys
 import time
-from gpiozero import Button, OutputDevice
 
 # Pins für Motor (Türbewegung)
 MOTOR_OPEN_PIN = 16
@@ -18,25 +29,30 @@ COOP_DOOR_UP_TIME = 8
 # Test-Bouncezeiten in Sekunden
 BOUNCE_TIMES = [0.005, 0.01, 0.02, 0.05, 0.1]
 
-# Motorsteuerung
-motor_open = OutputDevice(MOTOR_OPEN_PIN, active_high=True, initial_value=False)
-motor_close = OutputDevice(MOTOR_CLOSE_PIN, active_high=True, initial_value=False)
+DEFAULT_TRACE_FILE = 'bounce_trace.bin'
 
-# Counter
-event_counts = {}
+# Trace-Datei: Kopf, danach ein Eintrag pro Flanke (monotone Zeit in ns, Pin, 1 = gedrückt)
+TRACE_MAGIC = b'CDBT\x01'
+TRACE_RECORD = struct.Struct('<QBB')
 
-def run_test(bounce_time):
-    print(f"\n[=== Starting test with bounce_time={bounce_time:.3f}s ===]")
+# Flanken mit größerem Abstand gehören zu verschiedenen echten Zustandswechseln
+TRANSITION_GAP = 0.5
 
-    counts = {"open_pressed": 0, "open_released": 0, "close_pressed": 0, "close_released": 0}
 
-    open_sensor = Button(SENSOR_OPEN_PIN, pull_up=True, bounce_time=bounce_time)
-    close_sensor = Button(SENSOR_CLOSE_PIN, pull_up=True, bounce_time=bounce_time)
+def capture(trace_file):
+    from gpiozero import Button, OutputDevice
 
-    open_sensor.when_pressed = lambda: handle_event("OPEN_SENSOR PRESSED", bounce_time, counts, "open_pressed")
-    open_sensor.when_released = lambda: handle_event("OPEN_SENSOR RELEASED", bounce_time, counts, "open_released")
-    close_sensor.when_pressed = lambda: handle_event("CLOSE_SENSOR PRESSED", bounce_time, counts, "close_pressed")
-    close_sensor.when_released = lambda: handle_event("CLOSE_SENSOR RELEASED", bounce_time, counts, "close_released")
+    motor_open = OutputDevice(MOTOR_OPEN_PIN, active_high=True, initial_value=False)
+    motor_close = OutputDevice(MOTOR_CLOSE_PIN, active_high=True, initial_value=False)
+
+    # Ohne bounce_time meldet gpiozero jede Flanke
+    edges = []
+    open_sensor = Button(SENSOR_OPEN_PIN, pull_up=True, bounce_time=None)
+    close_sensor = Button(SENSOR_CLOSE_PIN, pull_up=True, bounce_time=None)
+    open_sensor.when_pressed = lambda: edges.append((time.monotonic_ns(), SENSOR_OPEN_PIN, 1))
+    open_sensor.when_released = lambda: edges.append((time.monotonic_ns(), SENSOR_OPEN_PIN, 0))
+    close_sensor.when_pressed = lambda: edges.append((time.monotonic_ns(), SENSOR_CLOSE_PIN, 1))
+    close_sensor.when_released = lambda: edges.append((time.monotonic_ns(), SENSOR_CLOSE_PIN, 0))
 
     # Down
     print(">>> Coop Door DOWN")
@@ -52,26 +68,114 @@ def run_test(bounce_time):
 
     time.sleep(1)  # kurze Pause
 
-    event_counts[bounce_time] = counts
-    print(f"[=== Test with bounce_time={bounce_time:.3f}s finished ===]\n")
+    with open(trace_file, 'wb') as trace:
+        trace.write(TRACE_MAGIC)
+        for edge in sorted(edges):
+            trace.write(TRACE_RECORD.pack(*edge))
+    print(f"Recorded {len(edges)} edges to {trace_file}")
+
+
+def read_trace(trace_file):
+    with open(trace_file, 'rb') as trace:
+        data = trace.read()
+    if not data.startswith(TRACE_MAGIC):
+        raise ValueError(f"{trace_file} is no bounce time trace")
+
+    edges = {}
+    for timestamp_ns, pin, pressed in TRACE_RECORD.iter_unpack(data[len(TRACE_MAGIC):]):
+        edges.setdefault(pin, []).append((timestamp_ns / 1e9, pressed))
+    return edges
+
+
+class SensorTrace:
+    """Edges of one sensor split into real transitions, prepared once so every bounce time is evaluated by
+    binary searches instead of replaying the edges."""
+
+    def __init__(self, edges):
+        self.edges = edges
+        self.transitions = []
+        for index, (timestamp, _) in enumerate(edges):
+            if index == 0 or timestamp - edges[index - 1][0] > TRANSITION_GAP:
+                self.transitions.append([])
+            self.transitions[-1].append(index)
+
+        # Per transition: running maximum of the gaps after each edge and the time of that edge since the first
+        # edge. The stable state is committed after the first gap >= bounce time, found by bisecting the maximum.
+        self.prefix_max_gaps = []
+        self.offsets = []
+        gaps_within_transitions = []
+        for transition in self.transitions:
+            first_timestamp = edges[transition[0]][0]
+            prefix_max_gaps = []
+            running_max = 0.0
+            for index in transition[:-1]:
+                gap = edges[index + 1][0] - edges[index][0]
+                gaps_within_transitions.append(gap)
+                running_max = max(running_max, gap)
+                prefix_max_gaps.append(running_max)
+            self.prefix_max_gaps.append(prefix_max_gaps)
+            self.offsets.append([edges[index][0] - first_timestamp for index in transition])
+        self.sorted_gaps = sorted(gaps_within_transitions)
+
+    def settle(self, bounce_time):
+        """Software debouncing like misc/debounce: commit once no edge was seen for bounce_time."""
+        spurious = len(self.sorted_gaps) - bisect.bisect_left(self.sorted_gaps, bounce_time)
+        delays = []
+        for prefix_max_gaps, offsets in zip(self.prefix_max_gaps, self.offsets):
+            committed = bisect.bisect_left(prefix_max_gaps, bounce_time)
+            delays.append(offsets[committed] + bounce_time)
+        return spurious, delays
+
+    def lockout(self, bounce_time):
+        """gpiozero bounce_time: edges within bounce_time after the last reported edge are dropped, so there is no
+        delay, but a bounce may be reported as the final state."""
+        spurious = 0
+        wrong_final_states = 0
+        for transition in self.transitions:
+            last_reported = None
+            reported_state = None
+            for index in transition:
+                timestamp, pressed = self.edges[index]
+                if last_reported is None or timestamp - last_reported >= bounce_time:
+                    if last_reported is not None:
+                        spurious += 1
+                    last_reported = timestamp
+                    reported_state = pressed
+            if reported_state != self.edges[transition[-1]][1]:
+                wrong_final_states += 1
+        return spurious, wrong_final_states
+
+
+def analyze(trace_file, bounce_times):
+    start = time.perf_counter()
+    sensors = {pin: SensorTrace(edges) for pin, edges in read_trace(trace_file).items()}
+    names = {SENSOR_OPEN_PIN: 'OPEN', SENSOR_CLOSE_PIN: 'CLOSE'}
+
+    print("\n=== Statistik über alle Bouncezeiten ===")
+    for pin, sensor in sorted(sensors.items()):
+        bounces = len(sensor.edges) - len(sensor.transitions)
+        print(f"{names.get(pin, pin)} sensor: {len(sensor.edges)} edges, {len(sensor.transitions)} transitions, "
+              f"{bounces} bounces")
+        for bt in bounce_times:
+            settle_spurious, delays = sensor.settle(bt)
+            lockout_spurious, wrong_final_states = sensor.lockout(bt)
+            max_delay = max(delays) if delays else 0.0
+            print(f"  bounce_time={bt:.3f}s → settle: spurious={settle_spurious}, max delay={max_delay * 1000:.1f} ms | "
+                  f"gpiozero: spurious={lockout_spurious}, wrong final state={wrong_final_states}")
+    print(f"\nAnalyzed {len(bounce_times)} bounce times in {(time.perf_counter() - start) * 1000:.1f} ms")
 
-def handle_event(msg, bt, counts, key):
-    timestamp = time.strftime("%H:%M:%S")
-    print(f"[{timestamp}] [{msg}] (bt={bt:.3f})")
-    counts[key] += 1
 
 def main():
-    for bt in BOUNCE_TIMES:
-        run_test(bt)
-
-    print("\n=== Statistik über alle Tests ===")
-    for bt, counts in event_counts.items():
-        print(f"bounce_time={bt:.3f}s → OPEN pressed={counts['open_pressed']}, "
-              f"OPEN released={counts['open_released']}, "
-              f"CLOSE pressed={counts['close_pressed']}, "
-              f"CLOSE released={counts['close_released']}")
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'capture'
+    trace_file = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_TRACE_FILE
+    if mode == 'capture':
+        capture(trace_file)
+    elif mode == 'analyze':
+        bounce_times = [float(bt) for bt in sys.argv[3:]] or BOUNCE_TIMES
+        analyze(trace_file, bounce_times)
+    else:
+        print(__doc__)
 
-    print("\nAlle Tests abgeschlossen! Bitte Ergebnisse vergleichen.")
 
 if __name__ == "__main__":
     main()
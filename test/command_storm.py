@@ -0,0 +1,333 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""Floods coop_door.py with commands and states, like a misbehaving automation rule, and measures how it copes.
+
+    python test/command_storm.py [scenario ...] [--combined] [--baseline FILE] [--save-baseline FILE]
+        Runs the given scenarios (all without any) and reports throughput, queueing delay, dropped messages and
+        the command to pin latency. --save-baseline stores the results, --baseline compares them to stored ones
+        and exits with 1 on a regression.
+
+Each scenario runs coop_door.py in a fresh process with virtual hardware and the broker stand-in of
+misc/virtual_mqtt.py, so no Raspberry Pi and no broker are needed. The stand-in queues up to max_queued messages
+for coop_door.py like a broker would, messages beyond are dropped.
+"""
+
+import argparse
+import bisect
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque, namedtuple
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMMAND_TOPIC = 'storm/coopdoor/command'
+STATE_TOPIC = 'storm/coopdoor/state'
+REALTIME_STATE_TOPIC = 'storm/coopdoor/state/realtime'
+
+# Client id of the publisher of the storm and the end of the one of coop_door.py
+STORM_CLIENT_ID = 'storm'
+COOP_DOOR_CLIENT_SUFFIX = '-coop_door'
+
+# Motor pins of the virtual door, every change of them is recorded by the virtual coop
+OPEN_PIN = 16
+CLOSE_PIN = 20
+SPEED_PIN = 21
+
+# messages are (topic, payload) sent in turn, rate in messages per second, 0 sends as fast as possible
+Scenario = namedtuple('Scenario', 'description messages rate count')
+
+SCENARIOS = {
+    'commands': Scenario(
+        'OPEN, STOP and CLOSE in turn',
+        [(COMMAND_TOPIC, 'OPEN'), (COMMAND_TOPIC, 'STOP'), (COMMAND_TOPIC, 'CLOSE'), (COMMAND_TOPIC, 'STOP')],
+        500, 2000
+    ),
+    'duplicates': Scenario(
+        'the same OPEN again and again, with a CLOSE now and then',
+        [(COMMAND_TOPIC, 'OPEN')] * 49 + [(COMMAND_TOPIC, 'CLOSE')],
+        500, 2000
+    ),
+    'states': Scenario(
+        'sensor states mixed with commands',
+        [(STATE_TOPIC, 'RUNNING'), (COMMAND_TOPIC, 'OPEN'), (STATE_TOPIC, 'OPEN'), (STATE_TOPIC, 'RUNNING'),
+         (COMMAND_TOPIC, 'CLOSE'), (STATE_TOPIC, 'CLOSED')],
+        500, 2000
+    ),
+    'burst': Scenario(
+        'commands as fast as they can be published',
+        [(COMMAND_TOPIC, 'OPEN'), (COMMAND_TOPIC, 'CLOSE'), (COMMAND_TOPIC, 'STOP')],
+        0, 5000
+    )
+}
+
+# Result keys compared to the baseline: True if higher is better
+COMPARED_RESULTS = {
+    'throughput': True,
+    'dropped': False,
+    'queue_delay_p99_ms': False,
+    'queue_delay_max_ms': False,
+    'command_to_pin_p99_ms': False,
+    'command_to_pin_max_ms': False
+}
+
+# Longest wait for coop_door.py to get ready and to work off its queue
+READY_TIMEOUT = 30
+DRAIN_TIMEOUT = 60
+
+CONFIG_TEMPLATE = """
+[MQTT]
+backend = virtual
+broker = virtual
+username = storm
+password = storm
+topic_command = {command_topic}
+topic_state = {state_topic}
+topic_realtime_state = {realtime_state_topic}
+qos = {qos}
+
+[COOP_DOOR_LOGGING]
+logfile = {directory}/coop_door.log
+level = {log_level}
+message_format: %(asctime)s: %(message)s
+date_time_format: %Y-%m-%d %H:%M:%S
+
+[COOP_DOOR_SENSORS_LOGGING]
+logfile = {directory}/coop_door_sensors.log
+level = {log_level}
+message_format: %(asctime)s: %(message)s
+date_time_format: %Y-%m-%d %H:%M:%S
+
+[COOP_DOOR]
+open_pin = {open_pin}
+close_pin = {close_pin}
+speed_pin = {speed_pin}
+combined_sensors = {combined}
+
+[COOP_DOOR_SENSORS]
+open_pin = 19
+close_pin = 26
+
+[HARDWARE]
+backend = virtual
+virtual_travel_time = {travel_time}
+
+[CONFIG]
+reload_interval = 0
+"""
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class DeliveryRecorder:
+    """Observer of the broker stand-in, keeps publish time, start and end of on_message of every storm message
+    received by coop_door.py."""
+
+    def __init__(self):
+        self.deliveries = []
+
+    def __call__(self, client, message, started_ns, finished_ns):
+        if message.sender == STORM_CLIENT_ID and client.client_id.endswith(COOP_DOOR_CLIENT_SUFFIX):
+            # Only called from the network thread of coop_door.py
+            self.deliveries.append((message.timestamp, started_ns / 1e9, finished_ns / 1e9, message.topic))
+
+
+def run_storm(scenario, coop_door, broker, recorder, results):
+    try:
+        deadline = time.monotonic() + READY_TIMEOUT
+        while not coop_door.startup.ready:
+            if time.monotonic() > deadline:
+                raise TimeoutError('coop_door.py did not get ready')
+            time.sleep(0.01)
+
+        producer = broker.client(STORM_CLIENT_ID)
+        producer.connect()
+        interval = 1 / scenario.rate if scenario.rate else 0
+        started = time.monotonic()
+        for index in range(scenario.count):
+            if interval:
+                delay = started + index * interval - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            topic, payload = scenario.messages[index % len(scenario.messages)]
+            producer.publish(topic, payload, qos=1)
+        results['publish_seconds'] = round(time.monotonic() - started, 3)
+
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while len(recorder.deliveries) + broker.dropped < scenario.count and time.monotonic() < deadline:
+            time.sleep(0.01)
+    except Exception as err:
+        results['error'] = repr(err)
+    finally:
+        os.kill(os.getpid(), signal.SIGINT)
+
+
+def evaluate(scenario, recorder, broker, history, coop_client):
+    deliveries = sorted(recorder.deliveries)
+    change_times = sorted(timestamp for timestamp, pin, _ in history if pin in (OPEN_PIN, CLOSE_PIN, SPEED_PIN))
+
+    queue_delays = sorted(started - published for published, started, _, _ in deliveries)
+    handling_times = sorted(finished - started for _, started, finished, _ in deliveries)
+    command_to_pin = []
+    for published, started, finished, topic in deliveries:
+        if topic != COMMAND_TOPIC:
+            continue
+        # The first motor pin change while coop_door.py handled the command
+        index = bisect.bisect_left(change_times, started)
+        if index < len(change_times) and change_times[index] <= finished:
+            command_to_pin.append(change_times[index] - published)
+    command_to_pin.sort()
+
+    elapsed = (deliveries[-1][2] - deliveries[0][0]) if deliveries else 0.0
+    return {
+        'description': scenario.description,
+        'published': scenario.count,
+        'delivered': len(deliveries),
+        'dropped': broker.dropped,
+        'max_queue_depth': coop_client.max_queued_seen,
+        'throughput': round(len(deliveries) / elapsed, 1) if elapsed else 0.0,
+        'queue_delay_p50_ms': round(percentile(queue_delays, 0.5) * 1000, 3),
+        'queue_delay_p99_ms': round(percentile(queue_delays, 0.99) * 1000, 3),
+        'queue_delay_max_ms': round(queue_delays[-1] * 1000, 3) if queue_delays else 0.0,
+        'handling_p50_ms': round(percentile(handling_times, 0.5) * 1000, 3),
+        'handling_max_ms': round(handling_times[-1] * 1000, 3) if handling_times else 0.0,
+        'commands_moving_pins': len(command_to_pin),
+        'command_to_pin_p50_ms': round(percentile(command_to_pin, 0.5) * 1000, 3),
+        'command_to_pin_p99_ms': round(percentile(command_to_pin, 0.99) * 1000, 3),
+        'command_to_pin_max_ms': round(command_to_pin[-1] * 1000, 3) if command_to_pin else 0.0,
+        'motor_pin_writes': len(change_times)
+    }
+
+
+def run_scenario(name, args):
+    """Runs coop_door.py with one scenario in this process and prints its results as JSON."""
+    scenario = SCENARIOS[name]
+    directory = tempfile.mkdtemp(prefix='command_storm_')
+    config_file = os.path.join(directory, 'config.ini')
+    with open(config_file, 'w') as config:
+        config.write(CONFIG_TEMPLATE.format(
+            command_topic=COMMAND_TOPIC, state_topic=STATE_TOPIC, realtime_state_topic=REALTIME_STATE_TOPIC,
+            qos=1, directory=directory, log_level=args.log_level, open_pin=OPEN_PIN, close_pin=CLOSE_PIN,
+            speed_pin=SPEED_PIN, combined=str(args.combined).lower(), travel_time=args.travel_time
+        ))
+    os.environ['COOP_DOOR_CONFIG'] = config_file
+    sys.path.insert(0, REPO_DIR)
+
+    import coop_door
+    from misc.hardware import get_virtual_coop
+    from misc.virtual_mqtt import get_virtual_broker
+
+    broker = get_virtual_broker()
+    broker.max_queued = args.max_queued
+    recorder = DeliveryRecorder()
+    broker.observer = recorder
+    virtual_coop = get_virtual_coop(coop_door.cfg)
+    virtual_coop.history = deque(maxlen=10 * scenario.count + 1000)
+
+    results = {}
+    threading.Thread(target=run_storm, args=(scenario, coop_door, broker, recorder, results), name='storm',
+                     daemon=True).start()
+    coop_door.main()
+
+    if 'error' in results:
+        print(json.dumps({'error': results['error']}))
+        return
+    results.update(evaluate(scenario, recorder, broker, list(virtual_coop.history), coop_door.client))
+    print(json.dumps(results))
+
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def print_results(name, result, baseline, tolerance):
+    print(f"\n{name}: {result['description']}")
+    regressions = 0
+    for key, value in result.items():
+        if key == 'description':
+            continue
+        line = f'  {key:24} {value:>12}'
+        if baseline and key in COMPARED_RESULTS and key in baseline:
+            previous = baseline[key]
+            higher_is_better = COMPARED_RESULTS[key]
+            change = (value - previous) / previous * 100 if previous else 0.0
+            worse = value < previous if higher_is_better else value > previous
+            # Small absolute changes, e.g. of dropped messages from 0 to 1, are no regressions of 100%
+            if worse and abs(change) > tolerance and abs(value - previous) > 1:
+                line += f'   baseline {previous:>12}  {change:+.0f}%  REGRESSION'
+                regressions += 1
+            else:
+                line += f'   baseline {previous:>12}  {change:+.0f}%'
+        print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenarios', nargs='*', help=f"scenarios to run, all by default: {', '.join(SCENARIOS)}")
+    parser.add_argument('--combined', action='store_true', help='run the sensors inside coop_door.py')
+    parser.add_argument('--max-queued', type=int, default=1000, help='messages the broker queues for coop_door.py')
+    parser.add_argument('--travel-time', type=float, default=1.0, help='seconds the virtual door needs to open')
+    parser.add_argument('--log-level', default='INFO', help='log level of coop_door.py')
+    parser.add_argument('--baseline', help='compare to the results stored in this file')
+    parser.add_argument('--save-baseline', help='store the results in this file')
+    parser.add_argument('--tolerance', type=float, default=25.0, help='percent a result may get worse')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_scenario(args.run, args)
+        return
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios {', '.join(unknown)}, choose from {', '.join(SCENARIOS)}")
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            stored = json.load(baseline_file)
+        baseline = stored['results']
+        print(f"Comparing to baseline of version {stored['version']}")
+
+    options = ['--max-queued', str(args.max_queued), '--travel-time', str(args.travel_time),
+               '--log-level', args.log_level] + (['--combined'] if args.combined else [])
+    if baseline and stored['options'] != options:
+        print(f"The baseline was run with other options: {' '.join(stored['options'])}")
+    results = {}
+    regressions = 0
+    for name in args.scenarios or SCENARIOS:
+        # A fresh process per scenario, so every run starts with a fresh coop_door.py
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--run', name] + options,
+                                capture_output=True, text=True)
+        lines = output.stdout.strip().splitlines()
+        result = json.loads(lines[-1]) if lines else {'error': output.stderr.strip()[-2000:]}
+        if 'error' in result:
+            print(f"\n{name}: failed with {result['error']}")
+            regressions += 1
+            continue
+        results[name] = result
+        regressions += print_results(name, result, baseline.get(name), args.tolerance)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump({'version': git_version(), 'options': options, 'results': results}, baseline_file, indent=2)
+        print(f'\nStored results as baseline in {args.save_baseline}')
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()